@@ -0,0 +1,239 @@
+import os
+import sys
+import rpyc
+import yaml
+import random
+import asyncio
+import logging
+import itertools
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# The ring snapshot is shared with KVClient, and the binary protocol client with the storage nodes
+sys.path.insert(0, path)
+sys.path.insert(0, os.path.abspath(os.path.join(path, '..', 'server')))
+from ring_snapshot import RingSnapshot
+from binary_protocol import NodeConnection
+
+# Statuses a storage node answers with when it is (virtually) down, or when the request was
+# routed with an older ring than the node's
+NOT_ACTIVE = -2
+STALE_EPOCH = -3
+
+
+# asyncio client that keeps many requests in flight at once; max_in_flight bounds how many.
+# With direct_routing, single-key requests go straight to a coordinator of the key over the
+# binary protocol, routed with the ring snapshot like KVClient does over rpyc. One connection
+# per node carries any number of requests and the node works on all of them at once, so the
+# number of nodes does not bound the concurrency. Everything else (multi-key requests, init,
+# and keys none of whose replicas answered) goes to the load balancer, which serves the
+# requests of one rpyc connection in order. Those are pipelined over `connections`
+# connections, by default one per 8 requests allowed in flight, and a background thread per
+# connection reads the replies and resolves the future of the request each one belongs to.
+class AsyncKVClient:
+    def __init__(self, connections=None, max_in_flight=256, timeout=30.0):
+        with open(file=path + "/client_config.yml", mode='r', encoding="utf-8") as file:
+            config = yaml.safe_load(file)
+            loadBalancerHost = config["lb_host"]
+            loadBalancerPort = config["lb_port"]
+            self.server_list = config["server_list"]
+            self.direct_routing: bool = config["direct_routing"]
+            self.binary_port_offset: int = config["binary_port_offset"]
+
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.timeouts = 0
+
+        # Bound to the caller's event loop on first use, and again if it runs on a new loop
+        self.loop = None
+        self.semaphore = None
+        self.ring_lock = None
+        self.ring = None
+        self.node_conns = dict()        # (host, binary port) -> NodeConnection
+        self.connecting = dict()        # (host, binary port) -> task opening the connection
+
+        self.conns = list()
+        self.serving_threads = list()
+        for _ in range(connections or max(4, max_in_flight // 8)):
+            conn = rpyc.connect(loadBalancerHost, loadBalancerPort, config={"sync_request_timeout": timeout})
+            self.conns.append(conn)
+            # Blocks on the socket instead of polling, so replies are picked up as soon as they arrive
+            self.serving_threads.append(rpyc.BgServingThread(conn, serve_interval=1.0, sleep_interval=0))
+        self.next_conn = itertools.cycle(self.conns)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._close_nodes()
+        self.close()
+
+    # Connections, locks and the semaphore only work on the loop they were made on; a caller
+    # that runs each batch of requests with asyncio.run gets a new loop every time
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.ring_lock = asyncio.Lock()
+            self.node_conns = dict()
+            self.connecting = dict()
+
+    async def _call(self, name, request, *args, timeout=None):
+        """
+        Runs one request within the max_in_flight and timeout bounds.
+
+        Raises:
+            asyncio.TimeoutError: If no reply arrived within the timeout
+        """
+        self._bind_loop()
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                return await asyncio.wait_for(request(*args), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logging.error(f"{name} timed out after {timeout or self.timeout} seconds")
+                raise
+            finally:
+                self.in_flight -= 1
+
+    # Sends one request to the load balancer without waiting for the replies to earlier ones
+    async def _callLoadBalancer(self, method, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        result = rpyc.async_(getattr(next(self.next_conn).root, method))(*args)
+        result.add_callback(lambda reply: loop.call_soon_threadsafe(self._resolve, future, reply))
+        return await future
+
+    # Runs on the event loop once a reply came in; replies to timed out requests are dropped
+    @staticmethod
+    def _resolve(future, reply):
+        if future.done():
+            return
+        try:
+            future.set_result(reply.value)
+        except Exception as e:
+            future.set_exception(e)
+
+    # Fetches the versioned ring snapshot published by the load balancer, once for all the
+    # requests that found it missing
+    async def _refresh_ring(self):
+        async with self.ring_lock:
+            if self.ring is None:
+                self.ring = RingSnapshot(await self._callLoadBalancer("exposed_ring"))
+                logging.debug(f"Ring snapshot refreshed, epoch {self.ring.epoch}")
+
+    # The connection to a node's binary protocol port, opened once however many requests wait for it
+    async def _node(self, host, port):
+        address = (host, int(port) + self.binary_port_offset)
+        conn = self.node_conns.get(address)
+        if conn is not None and not conn.reader_task.done():
+            return conn
+        task = self.connecting.get(address)
+        if task is None:
+            task = self.connecting[address] = asyncio.get_running_loop().create_task(self._connect(address))
+        # Shielded, so a request timing out does not abort the connection the others wait for
+        return await asyncio.shield(task)
+
+    # Publishes the connection before the requests waiting for it resume, so none opens another
+    async def _connect(self, address):
+        try:
+            conn = self.node_conns[address] = await NodeConnection.connect(*address)
+            return conn
+        finally:
+            del self.connecting[address]
+
+    # Same routing as KVClient._callDirect: the first live node among the first N entries of the
+    # key's preference list, in random order with spread, refreshing a stale ring snapshot and
+    # retrying once. send(conn, translated_order, epoch) sends the request on a node connection.
+    # Returns None if no node could serve it, so the caller can fall back to the load balancer.
+    async def _callDirect(self, key, send, spread=False):
+        for attempt in range(2):
+            if self.ring is None:
+                await self._refresh_ring()
+            ring = self.ring
+            if not ring.hashes:
+                # Not initialized yet; fetch the ring again next time rather than keep it empty
+                self.ring = None
+                return None
+            intended_server_order, translated_order = ring.preference_list(key)
+
+            candidates = list(intended_server_order[:ring.N])
+            if spread:
+                random.shuffle(candidates)
+
+            stale = False
+            for host, port in candidates:
+                try:
+                    response = await send(await self._node(host, port), translated_order, ring.epoch)
+                except Exception as e:
+                    logging.error(f"Error sending request for {key} to server {host}:{port}: {e}")
+                    continue
+
+                status = response[1] if isinstance(response, tuple) else response
+                if status == STALE_EPOCH:
+                    stale = True
+                    break
+                if status == NOT_ACTIVE:
+                    continue
+                return response
+
+            if not stale:
+                return None
+            logging.debug(f"Ring epoch {ring.epoch} is stale, refreshing")
+            if self.ring is ring:
+                self.ring = None
+        return None
+
+    async def _get(self, key):
+        if self.direct_routing:
+            response = await self._callDirect(key, lambda conn, order, epoch: conn.get(key, order, epoch), spread=True)
+            if response is not None:
+                return response
+        return await self._callLoadBalancer("exposed_get", key)
+
+    async def _put(self, key, value):
+        if self.direct_routing:
+            response = await self._callDirect(
+                key, lambda conn, order, epoch: conn.coordinator_put(key, value, order, epoch))
+            if response is not None:
+                return response
+        return await self._callLoadBalancer("exposed_put", key, value)
+
+    # Membership changes made through this client drop its ring snapshot right away
+    async def kv_init(self) -> int:
+        self.ring = None
+        return await self._call("init", self._callLoadBalancer, "exposed_init", self.server_list)
+
+    async def kv_get(self, key: str, timeout: float = None) -> tuple:
+        return tuple(await self._call("get", self._get, key, timeout=timeout))
+
+    async def kv_put(self, key: str, value: any, timeout: float = None) -> int:
+        return await self._call("put", self._put, key, value, timeout=timeout)
+
+    async def kv_multi_get(self, keys: list, timeout: float = None) -> list:
+        results = await self._call("multi_get", self._callLoadBalancer, "exposed_multi_get", tuple(keys), timeout=timeout)
+        return [tuple(result) for result in results]
+
+    async def kv_multi_put(self, items: dict, timeout: float = None) -> list:
+        return list(await self._call("multi_put", self._callLoadBalancer, "exposed_multi_put", tuple(items.items()),
+                                     timeout=timeout))
+
+    async def kv_shutdown(self) -> int:
+        return await self._call("shutdown", self._callLoadBalancer, "exposed_destroy")
+
+    async def _close_nodes(self):
+        for conn in list(self.node_conns.values()):
+            await conn.close()
+        self.node_conns = dict()
+
+    def close(self) -> None:
+        for serving_thread in self.serving_threads:
+            try:
+                serving_thread.stop()
+            except Exception:
+                pass
+        for conn in self.conns:
+            conn.close()
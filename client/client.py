@@ -1,11 +1,23 @@
 import os
+import sys
 import rpyc
 import yaml
+import random
 import logging
 
 path = os.path.dirname(os.path.abspath(__file__))
+
+# The ring snapshot is shared with the async client
+sys.path.insert(0, path)
+from ring_snapshot import RingSnapshot
+
 logging.basicConfig( level=logging.DEBUG, filename=f"{path}/client.log", filemode='w')
 
+# Statuses a storage node answers with when it is (virtually) down, or when the request was
+# routed with an older ring than the node's
+NOT_ACTIVE = -2
+STALE_EPOCH = -3
+
 class KVClient():
     def __init__(self):
         with open(file="client/client_config.yml", mode='r', encoding="utf-8") as file:
@@ -13,23 +25,109 @@ class KVClient():
             loadBalancerHost = config["lb_host"]
             loadBalancerPort = config["lb_port"]
             self.server_list = config["server_list"]
+            self.direct_routing: bool = config["direct_routing"]
         self.conn = rpyc.connect(loadBalancerHost, loadBalancerPort)
 
+        # Cached ring snapshot used to send single-key requests straight to a coordinator
+        self.ring = None
+        self.node_conns = dict()
+
+    # Fetches the versioned ring snapshot published by the load balancer
+    def _refresh_ring(self) -> None:
+        self.ring = RingSnapshot(self.conn.root.exposed_ring())
+        logging.debug(f"Ring snapshot refreshed, epoch {self.ring.epoch}")
+
+    def _node(self, host, port):
+        conn = self.node_conns.get((host, port))
+        if conn is None or conn.closed:
+            conn = rpyc.connect(host, int(port))
+            self.node_conns[(host, port)] = conn
+        return conn
+
+    # Sends the request straight to the first live node among the first N entries of the key's
+    # preference list. With spread the N entries are tried in random order, so reads of a key,
+    # a hot one above all, are coordinated by all of its replicas rather than always the first.
+    # A node that rejects the request as routed with a stale ring makes the client refresh its
+    # snapshot and retry once. Returns None if no node could serve it, so the caller can fall
+    # back to the load balancer.
+    def _callDirect(self, key: str, method: str, *args, spread=False):
+        for attempt in range(2):
+            if self.ring is None:
+                self._refresh_ring()
+            if not self.ring.hashes:
+                # Not initialized yet; fetch the ring again next time rather than keep it empty
+                self.ring = None
+                return None
+            intended_server_order, translated_order = self.ring.preference_list(key)
+
+            candidates = list(intended_server_order[:self.ring.N])
+            if spread:
+                random.shuffle(candidates)
+
+            stale = False
+            for host, port in candidates:
+                try:
+                    response = getattr(self._node(host, port).root, method)(
+                        key, *args, translated_order, self.ring.epoch)
+                except Exception as e:
+                    logging.error(f"Error calling {method} on server {host}:{port}: {e}")
+                    self.node_conns.pop((host, port), None)
+                    continue
+
+                status = response[1] if isinstance(response, tuple) else response
+                if status == STALE_EPOCH:
+                    stale = True
+                    break
+                if status == NOT_ACTIVE:
+                    continue
+                return response
+
+            if not stale:
+                return None
+            logging.debug(f"Ring epoch {self.ring.epoch} is stale, refreshing")
+            self.ring = None
+        return None
+
+    # Membership changes made through this client drop its ring snapshot right away, rather
+    # than wait for a node to reject a request as routed with a stale ring
     def kv_init(self) -> None:
+        self.ring = None
         return self.conn.root.exposed_init(self.server_list)
 
     def kv_get(self, key: str) -> any:
+        if self.direct_routing:
+            response = self._callDirect(key, "get", spread=True)
+            if response is not None:
+                return response
         return self.conn.root.exposed_get(key)
 
     def kv_put(self, key: str, value: any) -> any:
+        if self.direct_routing:
+            response = self._callDirect(key, "coordinator_put", value)
+            if response is not None:
+                return response
         return self.conn.root.exposed_put(key, value)
 
+    def kv_multi_get(self, keys: list) -> list:
+        return list(self.conn.root.exposed_multi_get(tuple(keys)))
+
+    def kv_multi_put(self, items: dict) -> list:
+        return list(self.conn.root.exposed_multi_put(tuple(items.items())))
+
     def kv_shutdown(self) -> None:
         return self.conn.root.exposed_destroy()
     
     # For testing
     def toggle_server(self, host: str, port: int) -> None:
         return self.conn.root.exposed_toggle_server(host, port)
+
+    def add_node(self, host: str, port: int) -> int:
+        self.ring = None
+        return self.conn.root.exposed_add_node(host, port)
+
+    def remove_node(self, host: str, port: int) -> int:
+        self.ring = None
+        return self.conn.root.exposed_remove_node(host, port)
     
     def _is_valid_key(self, key: str) -> bool:
         """
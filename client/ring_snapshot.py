@@ -0,0 +1,23 @@
+import bisect
+from hashlib import md5
+
+
+# Versioned snapshot of the ring published by the load balancer (exposed_ring), used by the
+# clients to route single-key requests straight to the key's coordinators
+class RingSnapshot:
+    def __init__(self, reply):
+        epoch, N, ring, routing_tables = reply
+        self.epoch = epoch
+        self.N = N
+        self.hashes = [entry[0] for entry in ring]
+        self.vnodes = [tuple(entry[1:]) for entry in ring]
+        self.tables = {tuple(server): (tables, translated) for server, tables, translated in routing_tables}
+
+    # Same lookup as the load balancer: the first virtual node at or after the key's hash.
+    # Returns the key's preference list as the client reaches the nodes, and as they reach each other.
+    def preference_list(self, key: str):
+        keyHash = int(md5(key.encode("utf-8")).hexdigest(), base=16)
+        index = bisect.bisect_left(self.hashes, keyHash) % len(self.hashes)
+        host, port, vNodeNum = self.vnodes[index]
+        tables, translated = self.tables[(host, port)]
+        return tables[vNodeNum], translated[vNodeNum]
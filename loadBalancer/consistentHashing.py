@@ -1,8 +1,13 @@
 import os
+import sys
+import socket
+import threading
 import logging
 import yaml
 import rpyc
+import bisect
 import random as rnd
+import concurrent.futures
 from hashlib import md5
 from typing import Dict, List
 from rpyc.utils.server import ThreadedServer
@@ -10,14 +15,33 @@ from rpyc.utils.server import ThreadedServer
 curPath: str = os.path.dirname(os.path.abspath(__file__))
 logging.basicConfig(level=logging.DEBUG, filename=f"{curPath}/LB.log", filemode='w')
 
+# The connection pool, failure detector, hot key tracker, peer load tracker and read cache
+# are shared with the storage nodes
+sys.path.insert(0, os.path.abspath(os.path.join(curPath, '..', 'server')))
+from connection_pool import ConnectionPool
+from failure_detector import FailureDetector
+from hot_keys import HotKeyTracker
+from peer_load import PeerLoad
+from read_cache import ReadCache
+
+# Status a storage node answers with when it is (virtually) down
+NOT_ACTIVE = -2
+
 # Request-Router/ Load Balancer class
 # Implements a consistent hashing mechanism for a distributed key-value store.
 # It provides methods to manage the ring of servers, create routing tables, and handle client requests
 class consistentHashing(rpyc.Service):
     def __init__(self):
         self.ring: Dict[int, any] = dict()
-        self.sortedServers = list()                         # (serverHash, (host, port, vNodeNum))
+        self.ringHashes: List[int] = list()                 # sorted hashes of the virtual nodes
+        self.ringVNodes: List = list()                      # (host, port, vNodeNum) at the same positions
+        self.preferenceLists: List = list()                 # (preference list, translated list) at the same positions
+        self.listSize: int = 0                              # servers per preference list
+        self.ringLock = threading.RLock()                   # guards the ring arrays during membership changes
         self.server_list: List = list()
+        self.routingTables: Dict = dict()                   # (host, port) -> preference list per vNode
+        self.epoch: int = 0                                 # version of the ring, bumped on every change
+        self.replicaRanges: Dict = dict()                   # (host, port) -> ring segments last sent to the server
         self.configPath = curPath + "/lb_config.yml"
 
         with open(file=self.configPath, mode='r', encoding="utf-8") as file:
@@ -25,6 +49,48 @@ class consistentHashing(rpyc.Service):
             self.vNode: int = config["vNodes"]
             self.hashRandom: bool = config["hashRandom"]
             self.N: int = config["N"]                       # Replication factor
+            self.preferenceListSize: int = config["preferenceListSize"]
+            pool_config = config["connection_pool"]
+            detector_config = config["failure_detector"]
+            batch_config = config["batch"]
+            cache_config = config["read_cache"]
+            hot_keys_config = config["hot_keys"]
+            selection_config = config["peer_selection"]
+
+        self.pool = ConnectionPool(
+            max_size=pool_config["max_size"],
+            idle_timeout=pool_config["idle_timeout"],
+            health_check_interval=pool_config["health_check_interval"],
+            connect_timeout=pool_config["connect_timeout"],
+            request_timeout=pool_config["request_timeout"],
+        )
+        self.detector = FailureDetector(
+            self.pool,
+            interval=detector_config["interval"],
+            timeout=detector_config["timeout"],
+            suspect_after=detector_config["suspect_after"],
+            down_after=detector_config["down_after"],
+        )
+        self.batch_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=batch_config["workers"], thread_name_prefix="batch")
+        self.batch_max_keys: int = batch_config["max_keys"]
+        self.routing_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="routing")
+        self.cache = ReadCache(
+            enabled=cache_config["enabled"],
+            max_entries=cache_config["max_entries"],
+            ttl=cache_config["ttl"],
+        )
+        self.hotKeys = HotKeyTracker(
+            width=hot_keys_config["width"],
+            depth=hot_keys_config["depth"],
+            decay_interval=hot_keys_config["decay_interval"],
+            hot_fraction=hot_keys_config["hot_fraction"],
+            min_count=hot_keys_config["min_count"],
+            top_k=hot_keys_config["top_k"],
+        )
+        self.spreadHotReads: bool = hot_keys_config["spread_reads"]
+        self.peerLoad = PeerLoad(alpha=selection_config["alpha"], half_life=selection_config["half_life"])
+        self.latencyAware: bool = selection_config["latency_aware"]
 
     def _createHash(self, key: str, random: bool = False) -> int:
         # if random:
@@ -32,9 +98,7 @@ class consistentHashing(rpyc.Service):
         #     noise = rnd.randint(0, 2**32)
         #     key = f"{key}_{noise}"
 
-        hexHash = (md5(string=key.encode("utf-8"))).hexdigest()
-        intHash = int(hexHash, base=16)
-        return abs(intHash)
+        return int.from_bytes(md5(key.encode("utf-8")).digest(), "big")
 
     # Translates localhost addresses to container addresses.
     def _translate_address(self, host, port):
@@ -44,52 +108,144 @@ class consistentHashing(rpyc.Service):
             return f"172.16.238.1{container_id}", 9000
         return host, port
 
-    # Create the preference list for the nodes
+    # The preference list of the virtual node at the given ring position: the distinct servers
+    # met walking the ring clockwise from it, up to listSize of them. The first N are the
+    # replicas of the keys the virtual node coordinates, the rest are handoff candidates.
+    def _computePreferenceList(self, position: int, listSize: int) -> List:
+        ringSize = len(self.ringVNodes)
+        order = list()
+        for i in range(ringSize):
+            nextHost, nextPort, _ = self.ringVNodes[(position + i) % ringSize]
+            if (nextHost, nextPort) not in order:
+                order.append((nextHost, nextPort))
+                if len(order) == listSize:
+                    break
+        return order
+
+    def _listSize(self) -> int:
+        return min(self.preferenceListSize, len(set((host, port) for host, port, _ in self.ringVNodes)))
+
+    # Computes the preference list of every virtual node. The translated list sent along with
+    # every request is computed here once instead of per request.
     def _createRoutingTable(self) -> None:
         logging.debug("Creating the routing table for the servers.")
 
-        # Initialize the routing table dictionary
-        routingTables = { (host, port): [[] for _ in range(self.vNode)] for _, (host, port, _) in self.sortedServers }
-
-        # Iterate over each server in the sorted list of servers
-        for serverIndex in range(len(self.sortedServers)):
-            serverInfo = self.sortedServers[serverIndex][1]
-            host, port, vNodeNum = serverInfo
-
-            uniqueServers = set()
-            # Traverse the sortedServers list in a circular manner
-            for i in range(len(self.sortedServers)):
-                index = (serverIndex + i) % len(self.sortedServers)
-                nextServerInfo = self.sortedServers[index][1]
-                nextHost, nextPort, _ = nextServerInfo
-
-                if (nextHost, nextPort) not in uniqueServers:
-                    uniqueServers.add((nextHost, nextPort))
-                    routingTables[(host, port)][vNodeNum].append((nextHost, nextPort))
-
-        # Log the routing tables for each server
-        for (host, port), table in routingTables.items():
-            logging.debug(f"Routing table for {host}:{port}: {table}")
+        self.listSize = self._listSize()
+        preferenceLists = list()
+        routingTables = { (host, port): [None] * self.vNode for host, port, _ in self.ringVNodes }
+        for position, (host, port, vNodeNum) in enumerate(self.ringVNodes):
+            order = self._computePreferenceList(position, self.listSize)
+            translated = [self._translate_address(h, p) for h, p in order]
+            preferenceLists.append((order, translated))
+            routingTables[(host, port)][vNodeNum] = order
 
         # Store the routing tables
+        self.preferenceLists = preferenceLists
         self.routingTables = routingTables
-        
-        # Send routing tables to each server
-        for (host, port), table in routingTables.items():
-            translated_table = [[self._translate_address(h, p) for h, p in entry] for entry in table]
+        self.epoch += 1
+        logging.debug(f"Routing table created for {len(routingTables)} servers, epoch {self.epoch}.")
+
+    # Hashes of the virtual nodes whose preference lists can reach the given ring position.
+    # Walking back from it, a virtual node is affected as long as fewer than listSize distinct
+    # servers lie between it and the position; beyond that its list is complete before it.
+    def _precedingHashes(self, ringIndex: int, listSize: int) -> List[int]:
+        ringSize = len(self.ringHashes)
+        position = bisect.bisect_left(self.ringHashes, ringIndex)
+        seen = set()
+        hashes = list()
+        for i in range(1, ringSize):
+            previous = (position - i) % ringSize
+            host, port, _ = self.ringVNodes[previous]
+            seen.add((host, port))
+            if len(seen) >= listSize:
+                break
+            hashes.append(self.ringHashes[previous])
+        return hashes
+
+    # Recomputes the preference lists of the given virtual nodes and bumps the ring epoch.
+    # Returns the changed entries as {(host, port): [vNodeNum]}.
+    def _updatePreferenceLists(self, affectedHashes) -> Dict:
+        changed = dict()
+        for ringIndex in affectedHashes:
+            position = bisect.bisect_left(self.ringHashes, ringIndex)
+            if position == len(self.ringHashes) or self.ringHashes[position] != ringIndex:
+                continue    # the virtual node itself was removed
+            host, port, vNodeNum = self.ringVNodes[position]
+            order = self._computePreferenceList(position, self.listSize)
+            previous = self.preferenceLists[position]
+            if previous is not None and previous[0] == order:
+                continue
+            self.preferenceLists[position] = (order, [self._translate_address(h, p) for h, p in order])
+            self.routingTables.setdefault((host, port), [None] * self.vNode)[vNodeNum] = order
+            changed.setdefault((host, port), []).append(vNodeNum)
+
+        self.epoch += 1
+        logging.debug(f"{sum(len(v) for v in changed.values())} preference lists changed, epoch {self.epoch}.")
+        return changed
+
+    # Sends every server its routing table, one preference list per virtual node of the server
+    def _sendRoutingTables(self) -> None:
+        self._pushRoutingUpdates({ server: None for server in self.routingTables })
+
+    # Sends routing changes to all servers in parallel, tagged with the current epoch. updates
+    # maps a server to the vNodeNums whose entries changed, or to None for its full table.
+    # Servers without changes still get the new epoch, so they reject stale client routes.
+    # A server that misses an incremental update is sent its full table instead.
+    def _pushRoutingUpdates(self, updates: Dict) -> None:
+        def push(host, port, vNodeNums):
+            table = self.routingTables[(host, port)]
+            translate = lambda entry: tuple(self._translate_address(h, p) for h, p in entry)
+            if vNodeNums is not None:
+                try:
+                    entries = tuple((vNodeNum, translate(table[vNodeNum])) for vNodeNum in vNodeNums)
+                    self.pool.call(host, port, "update_routing_table", entries, epoch)
+                    return
+                except Exception as e:
+                    logging.error(f"Failed to update routing table of {host}:{port}, resending it in full: {e}")
             try:
-                conn = rpyc.connect(host, port)
-                conn.root.set_routing_table(translated_table)
-                conn.close()
+                self.pool.call(host, port, "set_routing_table", tuple(translate(entry) for entry in table), epoch)
             except Exception as e:
                 logging.error(f"Failed to send routing table to {host}:{port}: {e}")
-        
-        logging.debug("Routing table sent.")
+
+        epoch = self.epoch
+        futures = [self.routing_executor.submit(push, host, port, updates.get((host, port), ()))
+                   for host, port in self.routingTables]
+        concurrent.futures.wait(futures)
+        logging.debug(f"Routing updates for epoch {epoch} sent.")
         logging.debug("------"*4)
 
+    # The ring segments (start, end] each server is one of the N replicas of, as
+    # (start, end, replicas) with the translated addresses of all replicas of the segment.
+    # Servers keep a Merkle tree per segment and sync it with the other replicas.
+    def _replicaRanges(self) -> Dict:
+        ranges = dict()
+        for position, end in enumerate(self.ringHashes):
+            start = self.ringHashes[position - 1]
+            replicas = self.preferenceLists[position][0][:self.N]
+            translated = tuple(self._translate_address(h, p) for h, p in replicas)
+            for server in replicas:
+                ranges.setdefault(server, []).append((start, end, translated))
+        return { server: tuple(entries) for server, entries in ranges.items() }
+
+    # Sends the servers whose replica ranges changed since the last push their new ranges
+    def _pushReplicaRanges(self, ranges: Dict) -> None:
+        def push(host, port, entries):
+            try:
+                self.pool.call(host, port, "set_replica_ranges", entries, epoch)
+                self.replicaRanges[(host, port)] = entries
+            except Exception as e:
+                logging.error(f"Failed to send replica ranges to {host}:{port}: {e}")
+
+        epoch = self.epoch
+        for server in set(self.replicaRanges) - set(ranges):
+            self.replicaRanges.pop(server, None)
+        futures = [self.routing_executor.submit(push, host, port, entries)
+                   for (host, port), entries in ranges.items() if self.replicaRanges.get((host, port)) != entries]
+        concurrent.futures.wait(futures)
+        logging.debug(f"Replica ranges for epoch {epoch} sent to {len(futures)} servers.")
+
     # Create the consistent hashing ring with virtual nodes
     # Each server is assigned multiple virtual nodes to distribute the load more evenly
-    # The ring is sorted based on the hash values of the virtual nodes
     def _createRing(self) -> None:
         logging.debug("Creating the ring.")
         for server_info in self.server_list:
@@ -98,43 +254,27 @@ class consistentHashing(rpyc.Service):
                 serverId: str = f"{host}_{port}_{vNodeNumber}"
                 ringIndex: int = self._createHash(serverId, self.hashRandom)
                 self.ring[ringIndex] = (host, port, vNodeNumber)
+        self._sortRing()
         logging.debug("Ring creation done.")
-        
-        self.sortedServers = sorted(self.ring.items(), key=lambda x: x[0])
-        logging.debug(f"Sorted servers: {self.sortedServers}")
         logging.debug("------"*4)
 
-    # Performs optimum search to find the closest server for the given hash.
-    def _binarySearch(self, start, end, targetHash) -> int:
-        logging.debug(f"{start} {end}")
-        while (start <= end):
-            mid = int((end - start) / 2) + start
-            if self.sortedServers[mid][0] == targetHash:
-                return mid
-            elif self.sortedServers[mid][0] < targetHash:
-                start = mid + 1
-            else:
-                end = mid - 1
+    # The ring is kept as two parallel arrays sorted by hash, so a lookup is one bisect over
+    # plain ints instead of a search over (hash, server) tuples
+    def _sortRing(self) -> None:
+        sortedRing = sorted(self.ring.items())
+        self.ringHashes = [ringIndex for ringIndex, _ in sortedRing]
+        self.ringVNodes = [vNode for _, vNode in sortedRing]
 
-        logging.debug(f"{start}")
-        logging.debug(f"{self.sortedServers}")
-        
-        if start == len(self.sortedServers):
-            return 0
-        return start   # just the greater one
+    # Finds the position on the ring of the virtual node that coordinates the given key:
+    # the first one at or after the key's hash, wrapping around to the start of the ring.
+    def _findCoordinatorIndex(self, key: str) -> int:
+        index = bisect.bisect_left(self.ringHashes, self._createHash(key))
+        return index if index < len(self.ringHashes) else 0
 
-    # Finds the next server for the given key in the ring.
-    def _findCoordinatorServer(self, key: str):
-        logging.debug("Looking for the coordinator node.")
-        
-        keyHash: int = self._createHash(key)
-        logging.debug(f"keyHash: {keyHash}")
-        length = len(self.sortedServers)
-        index = self._binarySearch(0, length - 1, keyHash)
-        logging.debug(f"index: {index}")
-
-        logging.debug("Coordinator node found.")
-        return self.ring[self.sortedServers[index][0]]
+    # The (preference list, translated preference list) of the virtual node coordinating the key
+    def _findPreferenceList(self, key: str):
+        with self.ringLock:
+            return self.preferenceLists[self._findCoordinatorIndex(key)]
 
     def _listServers(self) -> None:
         logging.debug("Listing down the servers.")
@@ -143,45 +283,189 @@ class consistentHashing(rpyc.Service):
         logging.debug("Listing completed.")
         logging.debug("------"*4)
 
-    def _remove_server(self, host, port) -> None:
+    # Takes the server's virtual nodes out of the ring. Returns the hashes of the remaining
+    # virtual nodes whose preference lists included the server.
+    def _remove_server(self, host, port) -> set:
         logging.debug("Removing the server.")
+        affected = set()
+        removed = list()
         for vNodeNumber in range(self.vNode):
             serverId: str = f"{host}_{port}_{vNodeNumber}"
             ringIndex: int = self._createHash(serverId)
+            if self.ring.get(ringIndex) == (host, port, vNodeNumber):
+                affected.update(self._precedingHashes(ringIndex, self.listSize))
+                removed.append(ringIndex)
+
+        for ringIndex in removed:
             del self.ring[ringIndex]
-        self.sortedServers = [server for server in self.sortedServers if server[1] != (host, port)]
+            position = bisect.bisect_left(self.ringHashes, ringIndex)
+            del self.ringHashes[position]
+            del self.ringVNodes[position]
+            del self.preferenceLists[position]
+        self.routingTables.pop((host, port), None)
         logging.debug("Server removed.")
         logging.debug("------"*4)
+        return affected - set(removed)
 
-    def _add_server(self, host, port) -> None:
+    # Puts the server's virtual nodes on the ring. Returns the hashes of the virtual nodes whose
+    # preference lists may now include the server, the new ones among them.
+    def _add_server(self, host, port) -> set:
         logging.debug("Adding the server.")
+        added = list()
         for vNodeNumber in range(self.vNode):
             serverId: str = f"{host}_{port}_{vNodeNumber}"
             ringIndex: int = self._createHash(serverId)
             self.ring[ringIndex] = (host, port, vNodeNumber)
-        self.sortedServers.append((ringIndex, (host, port, vNodeNumber)))
-        self.sortedServers = sorted(self.sortedServers, key=lambda x: x[0])
+            position = bisect.bisect_left(self.ringHashes, ringIndex)
+            self.ringHashes.insert(position, ringIndex)
+            self.ringVNodes.insert(position, (host, port, vNodeNumber))
+            self.preferenceLists.insert(position, None)
+            added.append(ringIndex)
+
+        affected = set(added)
+        for ringIndex in added:
+            affected.update(self._precedingHashes(ringIndex, self.listSize))
         logging.debug("Server added.")
         logging.debug("------"*4)
-
-    # Pings a server to check if it is active.
-    def _ping(self, host, port) -> bool:
-        try:
-            conn = rpyc.connect(host, port)
-            response = conn.root.ping()
-            conn.close()
-            if response != True:
-                logging.debug(f"Server {host}:{port} is not active.")
-                logging.debug("------"*4)
-                return False
-            logging.debug(f"Ping successful for {host}:{port}")
-            logging.debug("------"*4)
-            return True
-        except Exception as e:
-            logging.error(f"Ping error: {e}")
-            logging.debug("------"*4)
-            return False
-
+        return affected
+
+    # Applies a membership change to the ring and pushes the resulting routing changes.
+    # Only the affected preference lists are recomputed, unless the change alters how many
+    # servers a preference list holds, which changes every list.
+    def _changeMembership(self, change, host, port) -> None:
+        with self.ringLock:
+            oldHashes = list(self.ringHashes)
+            oldOwners = [order[:self.N] for order, _ in self.preferenceLists]
+            affected = change(host, port)
+            if self._listSize() != self.listSize:
+                self._createRoutingTable()
+                updates = { server: None for server in self.routingTables }
+            else:
+                updates = self._updatePreferenceLists(affected)
+                if change == self._add_server:
+                    updates[(host, port)] = None
+            segments = self._changedSegments(oldHashes, oldOwners)
+            ranges = self._replicaRanges()
+        self._pushRoutingUpdates(updates)
+        self._pushReplicaRanges(ranges)
+        self.detector.set_peers(server.split(':') for server in self.server_list)
+        self._startRebalance(segments)
+
+    # Ring segments (start, end] whose N replicas differ between the old ring and the current
+    # one. Segments are cut at every virtual node of either ring, so each has a single owner
+    # set before and after the change.
+    def _changedSegments(self, oldHashes, oldOwners) -> List:
+        if not oldHashes or not self.ringHashes:
+            return list()
+        boundaries = sorted(set(oldHashes) | set(self.ringHashes))
+        segments = list()
+        for i, end in enumerate(boundaries):
+            start = boundaries[i - 1]
+            old = oldOwners[bisect.bisect_left(oldHashes, end) % len(oldHashes)]
+            new = self.preferenceLists[bisect.bisect_left(self.ringHashes, end) % len(self.ringHashes)][0][:self.N]
+            if set(old) != set(new):
+                segments.append((start, end, old, new))
+        return segments
+
+    # Tells every server involved in a changed segment what changed, and which old replica
+    # streams the segment to its new owners: one that is up and, preferably, one that stops
+    # owning it, so the server being replaced hands over its data.
+    def _startRebalance(self, segments) -> None:
+        translate = lambda servers: tuple(self._translate_address(h, p) for h, p in servers)
+        servers = set(self.routingTables)
+        plans = dict()
+        for start, end, old, new in segments:
+            sources = [server for server in old if server in servers and self.detector.is_up(*server)]
+            sources.sort(key=lambda server: server in new)
+            if not sources:
+                logging.error(f"No live replica to stream range ({start}, {end}] from")
+            source = self._translate_address(*sources[0]) if sources else None
+            entry = (start, end, translate(old), translate(new), source)
+            for server in set(old) | set(new):
+                if server in servers:
+                    plans.setdefault(server, []).append(entry)
+
+        def send(host, port, plan):
+            try:
+                self.pool.call(host, port, "rebalance", tuple(plan), epoch)
+            except Exception as e:
+                logging.error(f"Failed to send rebalance plan to {host}:{port}: {e}")
+
+        epoch = self.epoch
+        futures = [self.routing_executor.submit(send, host, port, plan) for (host, port), plan in plans.items()]
+        concurrent.futures.wait(futures)
+        logging.debug(f"Rebalance plans for {len(segments)} ranges sent to {len(plans)} servers.")
+
+    # Sends the request to the coordinator of the key's preference list
+    def _callCoordinator(self, key: str, method: str, *args, spread: bool = False):
+        return self._callPreferenceList(self._findPreferenceList(key), method, key, *args, spread=spread)
+
+    # Sends the request to a live node among the first N entries of the given preference list.
+    # Nodes the failure detector does not consider up are tried last, and a call that fails or
+    # that the node answers with NOT_ACTIVE fails over to the next entry.
+    # Which live node comes first: when latency aware, the less loaded of two picked at random;
+    # otherwise the first in ring order, or a random one with spread, so every replica
+    # coordinates a share of the requests.
+    def _callPreferenceList(self, preferenceList, method: str, *args, spread: bool = False):
+        intended_server_order, translated_intended_server_order = preferenceList
+
+        candidates = intended_server_order[:self.N]
+        if len(candidates) < self.N:
+            logging.error(f"Not enough entries in the preference list {intended_server_order}")
+        live = [server for server in candidates if self.detector.is_up(*server)]
+        if self.latencyAware:
+            live = self.peerLoad.choose(live)
+        elif spread:
+            live = rnd.sample(live, len(live))
+        candidates = live + [server for server in candidates if server not in live]
+
+        for nextHost, nextPort in candidates:
+            try:
+                with self.peerLoad.track(nextHost, nextPort):
+                    response = self.pool.call(nextHost, nextPort, method, *args, translated_intended_server_order)
+            except Exception as e:
+                logging.error(f"Error calling {method} on server {nextHost}:{nextPort}: {e}")
+                self.detector.report_failure(nextHost, nextPort)
+                continue
+
+            # Single-key reads answer (value, status), batches a tuple of results or a bare status
+            status = response[1] if isinstance(response, tuple) and method == "get" else response
+            if status == NOT_ACTIVE:
+                logging.debug(f"Server {nextHost}:{nextPort} is not active.")
+                self.detector.report_failure(nextHost, nextPort)
+                continue
+
+            logging.debug(f"Coordinator Host: {nextHost}, Port: {nextPort}")
+            return response
+        return None
+
+    # Splits the keys into batches that share a coordinator, calls all batches in parallel and
+    # puts the results back in the order of keys. batchArgs(indices) builds the arguments of
+    # one batch call; keys of a batch that no node could serve get the failed result.
+    def _callBatches(self, keys, method: str, batchArgs, failed):
+        batches = dict()
+        with self.ringLock:
+            for index, key in enumerate(keys):
+                batches.setdefault(self._findCoordinatorIndex(key), []).append(index)
+            preferenceLists = { coordinatorIndex: self.preferenceLists[coordinatorIndex] for coordinatorIndex in batches }
+
+        futures = dict()
+        for coordinatorIndex, indices in batches.items():
+            for start in range(0, len(indices), self.batch_max_keys):
+                chunk = indices[start:start + self.batch_max_keys]
+                future = self.batch_executor.submit(self._callPreferenceList, preferenceLists[coordinatorIndex], method, batchArgs(chunk))
+                futures[future] = chunk
+        logging.debug(f"Sent {len(keys)} keys to coordinators in {len(futures)} batches")
+
+        results = [failed] * len(keys)
+        for future, chunk in futures.items():
+            response = future.result()
+            if not isinstance(response, tuple):
+                logging.error(f"Batch {method} failed for {len(chunk)} keys")
+                continue
+            for index, result in zip(chunk, response):
+                results[index] = result
+        return tuple(results)
 
     '''
         exposed endpoints.
@@ -197,15 +481,69 @@ class consistentHashing(rpyc.Service):
             int: Status code indicating success or failure. 0 for success, -1 for failure.
         """
         try:
-            self.server_list = server_list
-            self._createRing()
-            self._createRoutingTable()
+            self.server_list = list(server_list)
+            self.cache.clear()
+            with self.ringLock:
+                self._createRing()
+                self._createRoutingTable()
+                ranges = self._replicaRanges()
+            self._sendRoutingTables()
+            self.replicaRanges = dict()
+            self._pushReplicaRanges(ranges)
             self._listServers()
+            self.detector.set_peers(server.split(':') for server in self.server_list)
+            self.detector.start()
         except Exception as e:
             logging.error(f"Error: {e}")
             return -1
         return 0
     
+    def exposed_add_node(self, host: str, port: int) -> int:
+        """
+        Adds a server to the ring. Only the preference lists that now include it are
+        recomputed, and servers are sent just the entries that changed.
+
+        Args:
+            host (str): Host of the server.
+            port (int): Port of the server.
+
+        Returns:
+            int: Status code. 0 for success, 1 if the server is already on the ring, -1 for failure.
+        """
+        server = f"{host}:{port}"
+        if server in self.server_list:
+            return 1
+        try:
+            self.server_list.append(server)
+            self._changeMembership(self._add_server, host, str(port))
+        except Exception as e:
+            logging.error(f"Error adding {server}: {e}")
+            return -1
+        return 0
+
+    def exposed_remove_node(self, host: str, port: int) -> int:
+        """
+        Removes a server from the ring. Only the preference lists that included it are
+        recomputed, and servers are sent just the entries that changed.
+
+        Args:
+            host (str): Host of the server.
+            port (int): Port of the server.
+
+        Returns:
+            int: Status code. 0 for success, 1 if the server is not on the ring, -1 for failure.
+        """
+        server = f"{host}:{port}"
+        if server not in self.server_list:
+            return 1
+        try:
+            self.server_list.remove(server)
+            self._changeMembership(self._remove_server, host, str(port))
+        except Exception as e:
+            logging.error(f"Error removing {server}: {e}")
+            return -1
+        return 0
+
     def exposed_destroy(self) -> int:
         """
         Shuts down the connection to a server and frees state.
@@ -214,17 +552,40 @@ class consistentHashing(rpyc.Service):
             int: Status code indicating success or failure. 0 for success, -1 for failure.
         """
         try:
-            self.ring = dict()
-            self.sortedServers = list()
+            with self.ringLock:
+                self.ring = dict()
+                self._sortRing()
+                self.preferenceLists = list()
             self.server_list: List = list()
+            self.cache.clear()
         except Exception as e:
             logging.error(f"Error in destroy: {e}")
             return -1
         return 0
 
+    def exposed_ring(self) -> tuple:
+        """
+        Versioned snapshot of the ring, for clients that route requests to coordinators themselves.
+
+        Returns:
+            tuple: (epoch, N, ring, routing_tables) where ring is the sorted
+                (hash, host, port, vNodeNum) entries and routing_tables holds
+                ((host, port), preference lists, translated preference lists) per server.
+        """
+        with self.ringLock:
+            ring = tuple((ringIndex, host, port, vNodeNum) for ringIndex, (host, port, vNodeNum) in zip(self.ringHashes, self.ringVNodes))
+            routing_tables = tuple(
+                ((host, port),
+                 tuple(tuple(entry) for entry in table),
+                 tuple(tuple(self._translate_address(h, p) for h, p in entry) for entry in table))
+                for (host, port), table in self.routingTables.items()
+            )
+            return (self.epoch, self.N, ring, routing_tables)
+
     def exposed_get(self, key: str) -> int:
         '''
-        Retrives the value for the given key.
+        Retrives the value for the given key. Served from the read cache when it holds the key,
+        and coordinated by any of the key's replicas when the key is hot.
 
         Args:
             key (str): Key for which the value needs to be fetched.
@@ -233,33 +594,19 @@ class consistentHashing(rpyc.Service):
             int: Status code. 0 for success, 1 if the key is not present, and -1 for failure.
         '''
         logging.debug("Get request received.")
-        coordinatorServer = self._findCoordinatorServer(key)
-        host, port, vNodeNum = coordinatorServer
-
-        # Loop through the first N entries in the routing table for the coordinator server
-        intended_server_order = self.routingTables[(host, port)][vNodeNum]
-        translated_intended_server_order = [self._translate_address(h, p) for h, p in intended_server_order]
-        logging.debug(f"Intended server order: {translated_intended_server_order}")
-        logging.debug(f"Actual server order: {intended_server_order}")
-        for i in range(self.N):
-            try:
-                nextHost, nextPort = intended_server_order[i]
-                if self._ping(nextHost, nextPort):
-                    logging.debug(f"Coordinator Host: {host}, Port: {port}, vNodeNum: {vNodeNum}")
-                    conn = rpyc.connect(nextHost, nextPort)
-                    response = conn.root.get(key, translated_intended_server_order)
-                    conn.close()
-                    logging.debug("Get request completed.")
-                    logging.debug("------"*4)
-                    return response
-                else:
-                    logging.debug(f"Server {nextHost}:{nextPort} is not active.")
-                    logging.debug("------"*4)
-            except IndexError:
-                logging.error(f"Not enough entries in the routing table for {host}:{port}")
-                break
-            except Exception as e:
-                logging.error(f"Error connecting to server {nextHost}:{nextPort}: {e}")
+        hot = self.hotKeys.record(key)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logging.debug("Get request served from the read cache.")
+            return cached
+
+        token = self.cache.begin_read(key)
+        response = self._callCoordinator(key, "get", spread=hot and self.spreadHotReads)
+        self.cache.finish_read(key, token, response)
+        if response is not None:
+            logging.debug("Get request completed.")
+            logging.debug("------"*4)
+            return response
 
         logging.error("Failed to fetch the data. No active servers available.")
         logging.debug("------"*4)
@@ -277,35 +624,105 @@ class consistentHashing(rpyc.Service):
             int: Status code. 0 for success, -1 for failure.
         '''
         logging.debug("Put request received.")
-        coordinatorServer = self._findCoordinatorServer(key)
-        host, port, vNodeNum = coordinatorServer
-
-        # Loop through the first N entries in the routing table for the coordinator server
-        intended_server_order = self.routingTables[(host, port)][vNodeNum]
-        translated_intended_server_order = [self._translate_address(h, p) for h, p in intended_server_order]
-        logging.debug(f"Intended server order: {translated_intended_server_order}")
-        logging.debug(f"Actual server order: {intended_server_order}")
-        for i in range(self.N):
-            try:
-                nextHost, nextPort = intended_server_order[i]
-                if self._ping(nextHost, nextPort):
-                    logging.debug(f"Coordinator Host: {host}, Port: {port}, vNodeNum: {vNodeNum}")
-                    conn = rpyc.connect(nextHost, nextPort)
-                    response = conn.root.coordinator_put(key, value, translated_intended_server_order)
-                    conn.close()
-                    logging.debug("Put request completed.")
-                    return response
-                else:
-                    logging.debug(f"Server {nextHost}:{nextPort} is not active.")
-            except IndexError:
-                logging.error(f"Not enough entries in the routing table for {host}:{port}")
-                break
-            except Exception as e:
-                logging.error(f"Error connecting to server {nextHost}:{nextPort}: {e}")
+        self.cache.begin_write(key)
+        response = None
+        try:
+            response = self._callCoordinator(key, "coordinator_put", value)
+        finally:
+            self.cache.finish_write(key, value, response in (0, 1))
+        if response is not None:
+            logging.debug("Put request completed.")
+            return response
 
         logging.error("Failed to store the data. No active servers available.")
         return -1
     
+    def exposed_multi_get(self, keys: List) -> tuple:
+        '''
+        Retrives the values for several keys at once.
+
+        Args:
+            keys (List): Keys for which the values need to be fetched.
+
+        Returns:
+            tuple: (value, status_code) per key in the order of keys, as for get.
+        '''
+        logging.debug("Multi get request received.")
+        keys = tuple(keys)
+        response = self._callBatches(keys, "multi_get", lambda chunk: tuple(keys[i] for i in chunk), (None, -1))
+        logging.debug("Multi get request completed.")
+        logging.debug("------"*4)
+        return response
+
+    def exposed_multi_put(self, items: List) -> tuple:
+        '''
+        Stores several key-value pairs at once.
+
+        Args:
+            items (List): (key, value) pairs to be stored.
+
+        Returns:
+            tuple: Status code per pair in the order of items, as for put.
+        '''
+        logging.debug("Multi put request received.")
+        items = tuple((key, value) for key, value in items)
+        keys = tuple(key for key, _ in items)
+        for key in keys:
+            self.cache.begin_write(key)
+        response = tuple([-1] * len(items))
+        try:
+            response = self._callBatches(keys, "coordinator_multi_put", lambda chunk: tuple(items[i] for i in chunk), -1)
+        finally:
+            for (key, value), status in zip(items, response):
+                self.cache.finish_write(key, value, status in (0, 1))
+        logging.debug("Multi put request completed.")
+        logging.debug("------"*4)
+        return response
+
+    def exposed_rebalance_status(self) -> dict:
+        """
+        Progress of the servers streaming ranges to their new owners.
+
+        Returns:
+            dict: Rebalance status per server.
+        """
+        status = dict()
+        for host, port in list(self.routingTables):
+            try:
+                status[f"{host}:{port}"] = self._to_dict(self.pool.call(host, port, "rebalance_status"))
+            except Exception as e:
+                status[f"{host}:{port}"] = {"state": "unreachable", "error": str(e)}
+        return status
+
+    # Copies a dict returned by a server so it does not hold a reference to the remote object
+    @staticmethod
+    def _to_dict(remote) -> dict:
+        return { key: remote[key] for key in remote }
+
+    def exposed_metrics(self) -> dict:
+        """
+        Counters for monitoring the load balancer.
+
+        Returns:
+            dict: Metrics grouped by subsystem.
+        """
+        return {
+            "connection_pool": self.pool.stats(),
+            "failure_detector": self.detector.view(),
+            "read_cache": self.cache.stats(),
+            "hot_keys": self.hotKeys.stats(),
+            "peer_load": self.peerLoad.stats(),
+        }
+
+    def exposed_hot_keys(self) -> tuple:
+        """
+        The keys clients read the most through this load balancer recently.
+
+        Returns:
+            tuple: (key, estimated recent reads, whether it is hot) per key, hottest first.
+        """
+        return self.hotKeys.hot_keys()
+
     def exposed_toggle_server(self, host: str, port: int) -> None:
         """
         Toggles the server status.
@@ -315,9 +732,7 @@ class consistentHashing(rpyc.Service):
             port (int): Port of the server.
         """
         
-        conn = rpyc.connect(host, int(port))
-        conn.root.toggle_server()
-        conn.close()
+        self.pool.call(host, int(port), "toggle_server")
 
         logging.debug("Server toggled.")
         logging.debug("------"*4)
@@ -332,6 +747,8 @@ if __name__ == '__main__':
     # lb._createRoutingTable()
 
     port = 5000
-    server = ThreadedServer(consistentHashing, port=port)
+    # One shared instance, so the ring and the connection pool outlive each client connection
+    server = ThreadedServer(consistentHashing(), port=port)
+    server.listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     print(f"Load Balancer running on port {port}")
     server.start()
@@ -0,0 +1,289 @@
+import time
+import hashlib
+import logging
+import threading
+from rebalancing import key_hash, SegmentIndex
+from versioning import ZERO_VERSION, version_of
+
+RING_SIZE = 2 ** 128
+
+
+def entry_hash(key, record) -> int:
+    """
+    Hash of one key's stored version, the unit the Merkle trees are built from.
+    Versions are unique per write, so two replicas agree on it exactly when they hold the same write.
+    """
+    data = f"{key}\x00{tuple(record[0])}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+# Merkle tree over the keys of one ring segment (start, end].
+# The segment is split into 2 ** depth leaves by hash position, so every replica of the
+# segment puts a key into the same leaf. A node's hash is the XOR of the entry hashes below
+# it, which lets a write update the path to the root in O(depth) without rehashing children.
+# Nodes are stored heap-style in one array: the root at 1, the children of i at 2i and 2i+1.
+class MerkleTree:
+    def __init__(self, start, end, depth):
+        self.start = start
+        self.width = (end - start) % RING_SIZE or RING_SIZE
+        self.leaf_count = 2 ** depth
+        self.nodes = [0] * (2 * self.leaf_count)
+        self.leaves = [dict() for _ in range(self.leaf_count)]     # key -> entry hash, per leaf
+
+    def leaf_of(self, ring_index) -> int:
+        return ((ring_index - self.start - 1) % RING_SIZE) * self.leaf_count // self.width
+
+    # Sets (or, with entry None, removes) a key's entry hash. Setting the hash a key already
+    # has changes nothing, so replaying an update is harmless.
+    def set(self, key, ring_index, entry) -> None:
+        leaf = self.leaf_of(ring_index)
+        bucket = self.leaves[leaf]
+        old = bucket.pop(key, 0)
+        if entry is not None:
+            bucket[key] = entry
+        delta = old ^ (entry or 0)
+        index = self.leaf_count + leaf
+        while index and delta:
+            self.nodes[index] ^= delta
+            index //= 2
+
+    @property
+    def root(self) -> int:
+        return self.nodes[1]
+
+    def keys(self) -> int:
+        return sum(len(bucket) for bucket in self.leaves)
+
+
+# Background anti-entropy between the replicas of this node's ring segments.
+# A Merkle tree per segment is kept up to date on every write. Each round compares the roots
+# of all segments shared with a peer in one call, walks down the trees of the ones that
+# differ level by level, and exchanges the (key, version) lists of just the differing leaves.
+# Keys the peer has newer are fetched from it and keys this node has newer are pushed to it,
+# in batches of batch_keys, through the same last-writer-wins path as any other write.
+class AntiEntropy:
+    def __init__(self, store, pool, detector, apply_write, depth=10, interval=30, batch_keys=500):
+        self.store = store
+        self.pool = pool
+        self.detector = detector
+        self.apply_write = apply_write
+        self.depth = depth
+        self.interval = interval
+        self.batch_keys = batch_keys
+
+        self.lock = threading.Lock()
+        self.me = None
+        self.ranges = dict()            # (start, end) -> [(host, port)] replicas of the segment
+        self.trees = dict()             # (start, end) -> MerkleTree
+        self.index = _KeyedIndex(SegmentIndex([]), [])
+        self.pending = None             # writes made while the trees are being rebuilt
+        self.rebuild = threading.Event()
+        self.counters = {"rounds": 0, "ranges_compared": 0, "ranges_differing": 0, "leaves_differing": 0,
+                         "keys_compared": 0, "keys_pulled": 0, "keys_pushed": 0, "failed_syncs": 0,
+                         "last_round": None}
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def set_ranges(self, me, ranges) -> None:
+        """
+        Sets the ring segments this node replicates; the trees are rebuilt in the background.
+
+        Args:
+            me (tuple): (host, port) of this node
+            ranges (tuple): (start, end, replicas) per segment (start, end]
+        """
+        with self.lock:
+            self.me = tuple(me)
+            self.ranges = { (start, end): [tuple(replica) for replica in replicas] for start, end, replicas in ranges }
+        self.rebuild.set()
+
+    # Called with the lock of the key's shard held after its record changed, None on delete
+    def update(self, key, record) -> None:
+        ring_index = key_hash(key)
+        entry = None if record is None else entry_hash(key, record)
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((key, ring_index, entry))
+            segment = self.index.find(ring_index)
+            if segment is not None:
+                self.trees[segment].set(key, ring_index, entry)
+
+    # Builds the trees of the current ranges from a scan of the store without blocking writes.
+    # Writes made meanwhile are logged and replayed on the new trees before they replace the old ones.
+    def _rebuild(self):
+        with self.lock:
+            ranges = list(self.ranges)
+            self.pending = list()
+        segments = SegmentIndex(ranges)
+        trees = [MerkleTree(start, end, self.depth) for start, end in ranges]
+        for key in list(self.store.keys()):
+            ring_index = key_hash(key)
+            segment = segments.find(ring_index)
+            if segment is None:
+                continue
+            record = self.store.get(key, None)
+            if record is not None:
+                trees[segment].set(key, ring_index, entry_hash(key, record))
+        with self.lock:
+            for key, ring_index, entry in self.pending:
+                segment = segments.find(ring_index)
+                if segment is not None:
+                    trees[segment].set(key, ring_index, entry)
+            self.pending = None
+            self.trees = dict(zip(ranges, trees))
+            self.index = _KeyedIndex(segments, ranges)
+        logging.info(f"Merkle trees rebuilt for {len(ranges)} ranges")
+
+    def _run(self):
+        while True:
+            if self.rebuild.wait(self.interval):
+                self.rebuild.clear()
+                try:
+                    self._rebuild()
+                except Exception as e:
+                    logging.error(f"Error rebuilding Merkle trees: {e}")
+                continue
+            try:
+                self._round()
+            except Exception as e:
+                logging.error(f"Error in anti-entropy round: {e}")
+
+    # Syncs with every live peer the segments this node shares with it
+    def _round(self):
+        with self.lock:
+            shared = dict()             # (host, port) -> [(start, end)]
+            for segment, replicas in self.ranges.items():
+                if segment not in self.trees:
+                    return              # a rebuild is on its way
+                for replica in replicas:
+                    if replica != self.me:
+                        shared.setdefault(replica, []).append(segment)
+        for peer, segments in shared.items():
+            if not self.detector.is_up(*peer):
+                continue
+            try:
+                self._sync(peer, segments)
+            except Exception as e:
+                logging.error(f"Anti-entropy with {peer[0]}:{peer[1]} failed: {e}")
+                self._count("failed_syncs")
+        with self.lock:
+            self.counters["rounds"] += 1
+            self.counters["last_round"] = time.time()
+
+    def _sync(self, peer, segments):
+        host, port = peer
+        roots = self.pool.call(host, port, "merkle_roots", tuple(segments))
+        if roots is None:
+            return
+        self._count("ranges_compared", len(segments))
+        for segment, root in zip(segments, roots):
+            tree = self.trees.get(segment)
+            if root is None or tree is None or root == tree.root:
+                continue
+            self._count("ranges_differing")
+            leaves = self._differing_leaves(peer, segment, tree)
+            if leaves:
+                self._count("leaves_differing", len(leaves))
+                self._exchange(peer, segment, tree, leaves)
+
+    # Walks down both trees from the root, one call per level, following the differing nodes
+    def _differing_leaves(self, peer, segment, tree) -> list:
+        host, port = peer
+        leaves = list()
+        indices = [2, 3] if tree.leaf_count > 1 else [1]
+        while indices:
+            remote = self.pool.call(host, port, "merkle_nodes", segment, tuple(indices))
+            if remote is None:
+                return list()
+            next_indices = list()
+            for index, value in zip(indices, remote):
+                if tree.nodes[index] == value:
+                    continue
+                if index >= tree.leaf_count:
+                    leaves.append(index - tree.leaf_count)
+                else:
+                    next_indices += [2 * index, 2 * index + 1]
+            indices = next_indices
+        return leaves
+
+    # Compares the versions of the keys in the differing leaves and moves the newer records
+    def _exchange(self, peer, segment, tree, leaves):
+        host, port = peer
+        remote = self.pool.call(host, port, "merkle_leaf_versions", segment, tuple(leaves))
+        if remote is None:
+            return
+        remote = { key: tuple(version) for key, version in remote }
+        with self.lock:
+            keys = [key for leaf in leaves for key in tree.leaves[leaf]]
+        local = { key: version_of(self.store.get(key, None)) for key in keys }
+        self._count("keys_compared", len(set(remote) | set(local)))
+
+        pull = [key for key, version in remote.items() if version > local.get(key, ZERO_VERSION)]
+        push = [key for key, version in local.items() if version > remote.get(key, ZERO_VERSION)]
+        for start in range(0, len(pull), self.batch_keys):
+            chunk = tuple(pull[start:start + self.batch_keys])
+            records = self.pool.call(host, port, "multi_fetch", chunk, True)
+            for key, record in zip(chunk, records):
+                if record is not None:
+                    self.apply_write(key, tuple(record))
+            self._count("keys_pulled", len(chunk))
+        for start in range(0, len(push), self.batch_keys):
+            chunk = [(key, self.store.get(key, None)) for key in push[start:start + self.batch_keys]]
+            chunk = tuple((key, record) for key, record in chunk if record is not None)
+            self.pool.call(host, port, "multi_put", chunk)
+            self._count("keys_pushed", len(chunk))
+        logging.debug(f"Anti-entropy with {host}:{port}: {len(leaves)} leaves differed, "
+                      f"pulled {len(pull)} keys, pushed {len(push)}")
+
+    '''
+        Peer side of the protocol
+    '''
+
+    def roots(self, segments) -> tuple:
+        """
+        Root hash per segment, None for a segment this node has no tree for.
+        """
+        with self.lock:
+            return tuple(self.trees[tuple(segment)].root if tuple(segment) in self.trees else None
+                         for segment in segments)
+
+    def nodes(self, segment, indices):
+        with self.lock:
+            tree = self.trees.get(tuple(segment))
+            if tree is None:
+                return None
+            return tuple(tree.nodes[index] for index in indices)
+
+    def leaf_versions(self, segment, leaves):
+        """
+        (key, version) of every key in the given leaves of a segment, None if it has no tree.
+        """
+        with self.lock:
+            tree = self.trees.get(tuple(segment))
+            if tree is None:
+                return None
+            keys = [key for leaf in leaves for key in tree.leaves[leaf]]
+        return tuple((key, version_of(self.store.get(key, None))) for key in keys)
+
+    def _count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, ranges=len(self.trees),
+                        keys=sum(tree.keys() for tree in self.trees.values()),
+                        rebuilding=self.pending is not None)
+
+
+# SegmentIndex that answers with the segment's (start, end) instead of its position
+class _KeyedIndex:
+    def __init__(self, index, segments):
+        self.index = index
+        self.segments = segments
+
+    def find(self, ring_index):
+        position = self.index.find(ring_index)
+        return None if position is None else self.segments[position]
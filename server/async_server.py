@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from binary_protocol import (OP_GET, OP_PUT, OP_FETCH, OP_COORDINATOR_PUT, OP_BATCH,
+                             STATUS_OK, STATUS_ERROR, encode_frame, read_frame)
+
+
+# asyncio front end for KeyValueStoreService speaking the framed binary protocol of
+# binary_protocol.py next to the rpyc server. One event loop serves every connection, and a
+# connection can have any number of requests in flight. Requests that wait for other replicas
+# (get, coordinator_put) run on a thread pool so the loop keeps serving in the meantime. The
+# ones that only touch this node (put, fetch) run right on the loop, but only with the
+# in-memory dict store and neither the write-ahead log nor the hint logs set to fsync always.
+# Then a put only waits for locks that are never held across an fsync or a log rewrite (see
+# PersistenceEngine.sync and HintedHandoff._rewrite). A disk backend or fsync always could
+# stall every connection, so they go to the pool as well then.
+class AsyncNodeServer:
+    def __init__(self, service, host="0.0.0.0", port=9100, workers=32):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="async-node")
+        self.tasks = set()
+        self.counters = {"connections": 0, "requests": 0, "errors": 0}
+
+        config = service.config
+        local_blocks = (config["storage"]["backend"] != "dict"
+                        or config["persistence"]["fsync"] == "always"
+                        or config["hinted_handoff"]["fsync"] == "always")
+
+        # op code -> (service method, whether it can block the loop)
+        self.operations = {
+            OP_GET: (service.exposed_get, True),
+            OP_PUT: (service.exposed_put, local_blocks),
+            OP_FETCH: (service.exposed_fetch, local_blocks),
+            OP_COORDINATOR_PUT: (service.exposed_coordinator_put, True),
+        }
+
+    def start(self) -> None:
+        """
+        Runs the server on its own event loop in a background thread.
+        """
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),))
+        thread.daemon = True
+        thread.start()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f"Binary protocol server listening on port {self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        self.counters["connections"] += 1
+        try:
+            while True:
+                request_id, op, args = await read_frame(reader)
+                self.counters["requests"] += 1
+                if self._blocks(op, args):
+                    task = asyncio.get_running_loop().create_task(self._offload(writer, request_id, op, args))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                else:
+                    self._reply(writer, request_id, *self._run(op, args))
+                    await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logging.error(f"Closing binary protocol connection: {e}")
+        finally:
+            self.counters["connections"] -= 1
+            writer.close()
+
+    def _blocks(self, op, args) -> bool:
+        if op == OP_BATCH:
+            return any(self._blocks(sub_op, sub_args) for sub_op, sub_args in args)
+        return op not in self.operations or self.operations[op][1]
+
+    async def _offload(self, writer, request_id, op, args):
+        status, result = await asyncio.get_running_loop().run_in_executor(self.executor, self._run, op, args)
+        self._reply(writer, request_id, status, result)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    # Runs one request against the service, returns (status, result)
+    def _run(self, op, args):
+        try:
+            if op == OP_BATCH:
+                results = list()
+                for sub_op, sub_args in args:
+                    status, result = self._run(sub_op, sub_args)
+                    if status != STATUS_OK:
+                        return status, result
+                    results.append(result)
+                return STATUS_OK, tuple(results)
+            if op not in self.operations:
+                return STATUS_ERROR, f"Unknown op code {op}"
+            method, _ = self.operations[op]
+            return STATUS_OK, method(*args)
+        except Exception as e:
+            self.counters["errors"] += 1
+            logging.error(f"Error in binary protocol request {op}: {e}")
+            return STATUS_ERROR, str(e)
+
+    def _reply(self, writer, request_id, status, result):
+        try:
+            frame = encode_frame(request_id, status, result)
+        except Exception as e:
+            frame = encode_frame(request_id, STATUS_ERROR, f"Result cannot be encoded: {e}")
+        writer.write(frame)
+
+    def stats(self) -> dict:
+        return dict(self.counters, in_flight=len(self.tasks))
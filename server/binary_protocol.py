@@ -0,0 +1,128 @@
+import struct
+import asyncio
+import itertools
+from rpyc.core import brine
+
+# Frame header: body length, request id, and the op code of a request or the status of a reply.
+# The body is the brine-encoded argument tuple of a request or result of a reply; brine only
+# encodes plain values (None, bools, numbers, str, bytes, tuples), never references.
+_HEADER = struct.Struct("!IIB")
+
+OP_GET = 1                      # (key, intended_server_order, epoch)
+OP_PUT = 2                      # (key, record, target_host, target_port)
+OP_FETCH = 3                    # (key, is_primary)
+OP_COORDINATOR_PUT = 4          # (key, value, replica_servers, epoch)
+OP_BATCH = 5                    # ((op, args), ...) run in order, answered with a tuple of results
+
+STATUS_OK = 0
+STATUS_ERROR = 1                # the body is the error message
+
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+
+def encode_frame(request_id, code, body) -> bytes:
+    payload = brine.dump(body)
+    return _HEADER.pack(len(payload), request_id, code) + payload
+
+
+def plain(value):
+    """
+    Turns the lists in an argument, however deeply nested, into tuples, which brine can encode.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(plain(item) for item in value)
+    return value
+
+
+async def read_frame(reader):
+    """
+    Reads one frame from the stream.
+
+    Returns:
+        tuple: (request_id, code, body)
+
+    Raises:
+        asyncio.IncompleteReadError: If the connection closed
+        ValueError: If the frame is larger than MAX_BODY_SIZE
+    """
+    length, request_id, code = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    if length > MAX_BODY_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the limit of {MAX_BODY_SIZE}")
+    return request_id, code, brine.load(await reader.readexactly(length))
+
+
+# Client side of the binary protocol: one connection on which any number of requests can be
+# in flight. Replies come back in whatever order the node finishes the requests and are
+# matched to their request by id.
+class NodeConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.request_ids = itertools.count(1)
+        self.pending = dict()           # request id -> future of the reply
+        self.reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read_replies(self):
+        try:
+            while True:
+                request_id, status, body = await read_frame(self.reader)
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if status == STATUS_OK:
+                    future.set_result(body)
+                else:
+                    future.set_exception(RuntimeError(body))
+        except Exception as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to node lost: {e}"))
+            self.pending.clear()
+
+    async def call(self, op, *args):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        # Encoded before the future is registered, so a request that cannot be encoded leaves nothing behind
+        frame = encode_frame(request_id, op, args)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(frame)
+        await self.writer.drain()
+        return await future
+
+    async def get(self, key, intended_server_order, epoch=None):
+        return await self.call(OP_GET, key, plain(intended_server_order), epoch)
+
+    async def put(self, key, record, target_host=None, target_port=None):
+        return await self.call(OP_PUT, key, record, target_host, target_port)
+
+    async def fetch(self, key, is_primary=True):
+        return await self.call(OP_FETCH, key, is_primary)
+
+    async def coordinator_put(self, key, value, replica_servers, epoch=None):
+        return await self.call(OP_COORDINATOR_PUT, key, value, plain(replica_servers), epoch)
+
+    async def batch(self, requests):
+        """
+        Sends several requests in one frame.
+
+        Args:
+            requests (list): (op, args) per request, where args may hold lists, such as the
+                server order of a get
+
+        Returns:
+            tuple: The result of each request, in order
+        """
+        return await self.call(OP_BATCH, *((op, plain(args)) for op, args in requests))
+
+    async def close(self):
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
@@ -0,0 +1,359 @@
+import os
+import glob
+import mmap
+import time
+import zlib
+import pickle
+import struct
+import logging
+import threading
+from collections import namedtuple
+from storage import StorageBackend
+from persistence import FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER
+
+# Data file record: crc32 | timestamp | key size | value size | key | value
+# The crc covers everything after itself. A value size of TOMBSTONE marks a delete.
+_RECORD_HEADER = struct.Struct("<IQII")
+# Hint file record: timestamp | key size | value size | value position | key
+_HINT_HEADER = struct.Struct("<QIIQ")
+TOMBSTONE = 0xFFFFFFFF
+
+# Where the latest value of a key lives on disk
+KeydirEntry = namedtuple("KeydirEntry", ["file_id", "value_pos", "value_size", "timestamp"])
+
+
+# Bitcask-style log-structured hash table.
+# Values live in append-only data files that are read through mmap; only the keydir
+# (key -> file, offset, size) is kept in memory. Old files are periodically merged into
+# compacted files with hint files next to them, so a restart rebuilds the keydir by reading
+# the small hints instead of scanning every value.
+class BitcaskStore(StorageBackend):
+    def __init__(self, directory, max_file_size=64 * 1024 * 1024, fsync=FSYNC_INTERVAL,
+                 fsync_interval_ms=100, merge_interval=300, merge_dead_ratio=0.4):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.merge_interval = merge_interval
+        self.merge_dead_ratio = merge_dead_ratio
+
+        self.lock = threading.RLock()
+        self.merge_lock = threading.Lock()
+        self.keydir = dict()
+        self.maps = dict()              # file_id -> mmap of the file
+        self.file_sizes = dict()        # file_id -> bytes written
+        self.dead_bytes = dict()        # file_id -> bytes taken by overwritten or deleted records
+        self.last_timestamp = 0
+        self.dirty = False
+        self.closed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_keydir()
+
+        self.active_id = max(self.file_sizes, default=0) + 1
+        self._open_active_file()
+        self._start_background_worker()
+
+    def _data_path(self, file_id):
+        return os.path.join(self.directory, f"{file_id:08d}.data")
+
+    def _hint_path(self, file_id):
+        return os.path.join(self.directory, f"{file_id:08d}.hint")
+
+    def _next_timestamp(self) -> int:
+        # Timestamps order the records of a key across files, so they must never repeat
+        self.last_timestamp = max(time.time_ns(), self.last_timestamp + 1)
+        return self.last_timestamp
+
+    '''
+    /////////////////// Recovery /////////////////
+    '''
+
+    # Rebuilds the keydir from hint files where present and by scanning data files otherwise.
+    # The record with the highest timestamp wins, so the order files are read in does not matter.
+    def _load_keydir(self):
+        latest = dict()     # key -> (timestamp, KeydirEntry or None for a tombstone)
+        for file_path in glob.glob(os.path.join(self.directory, "*.data")):
+            file_id = int(os.path.basename(file_path)[:-len(".data")])
+            self.file_sizes[file_id] = os.path.getsize(file_path)
+            self.dead_bytes[file_id] = 0
+            if os.path.exists(self._hint_path(file_id)):
+                records = self._read_hint_file(file_id)
+            else:
+                records = self._scan_data_file(file_id)
+            for key, entry in records:
+                current = latest.get(key)
+                if current is not None:
+                    # Whichever record loses is garbage that a merge can reclaim
+                    loser = entry if entry.timestamp < current[0] else current[1]
+                    if loser is not None:
+                        self.dead_bytes[loser.file_id] += self._record_size(key, loser.value_size)
+                    if entry.timestamp < current[0]:
+                        continue
+                latest[key] = (entry.timestamp, None if entry.value_size == TOMBSTONE else entry)
+                self.last_timestamp = max(self.last_timestamp, entry.timestamp)
+
+        self.keydir = {key: entry for key, (_, entry) in latest.items() if entry is not None}
+        logging.info(f"Bitcask keydir rebuilt with {len(self.keydir)} keys from {len(self.file_sizes)} files")
+
+    def _read_hint_file(self, file_id):
+        with open(self._hint_path(file_id), "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + _HINT_HEADER.size <= len(data):
+            timestamp, key_size, value_size, value_pos = _HINT_HEADER.unpack_from(data, pos)
+            pos += _HINT_HEADER.size
+            key = data[pos:pos + key_size].decode("utf-8")
+            pos += key_size
+            yield key, KeydirEntry(file_id, value_pos, value_size, timestamp)
+
+    def _scan_data_file(self, file_id):
+        with open(self._data_path(file_id), "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + _RECORD_HEADER.size <= len(data):
+            crc, timestamp, key_size, value_size = _RECORD_HEADER.unpack_from(data, pos)
+            body_size = key_size + (0 if value_size == TOMBSTONE else value_size)
+            end = pos + _RECORD_HEADER.size + body_size
+            if end > len(data) or zlib.crc32(data[pos + 4:end]) != crc:
+                logging.warning(f"Stopping scan of bitcask file {file_id} at a torn record")
+                self.file_sizes[file_id] = pos
+                return
+            key_pos = pos + _RECORD_HEADER.size
+            key = data[key_pos:key_pos + key_size].decode("utf-8")
+            yield key, KeydirEntry(file_id, key_pos + key_size, value_size, timestamp)
+            pos = end
+
+    @staticmethod
+    def _record_size(key, value_size):
+        key_size = len(key.encode("utf-8"))
+        return _RECORD_HEADER.size + key_size + (0 if value_size == TOMBSTONE else value_size)
+
+    '''
+    /////////////////// Data files /////////////////
+    '''
+
+    def _open_active_file(self):
+        self.active_file = open(self._data_path(self.active_id), "ab")
+        self.file_sizes.setdefault(self.active_id, 0)
+        self.dead_bytes.setdefault(self.active_id, 0)
+
+    def _rotate_active_file(self):
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.active_file.close()
+        self.active_id = max(self.file_sizes) + 1
+        self._open_active_file()
+
+    # Appends one record to the active file and returns where its value starts
+    def _append(self, key, value_bytes, timestamp):
+        key_bytes = key.encode("utf-8")
+        value_size = TOMBSTONE if value_bytes is None else len(value_bytes)
+        body = struct.pack("<QII", timestamp, len(key_bytes), value_size) + key_bytes + (value_bytes or b"")
+        record = struct.pack("<I", zlib.crc32(body)) + body
+
+        if self.file_sizes[self.active_id] + len(record) > self.max_file_size and self.file_sizes[self.active_id] > 0:
+            self._rotate_active_file()
+
+        # Flushing on every append keeps the record visible to mmap readers
+        self.active_file.write(record)
+        self.active_file.flush()
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(self.active_file.fileno())
+        else:
+            self.dirty = True
+
+        value_pos = self.file_sizes[self.active_id] + _RECORD_HEADER.size + len(key_bytes)
+        self.file_sizes[self.active_id] += len(record)
+        return KeydirEntry(self.active_id, value_pos, value_size, timestamp)
+
+    # Returns a mmap covering at least `end` bytes of the given file
+    def _map(self, file_id, end):
+        mapped = self.maps.get(file_id)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            with open(self._data_path(file_id), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[file_id] = mapped
+        return mapped
+
+    def _mark_dead(self, key, entry):
+        if entry is not None:
+            self.dead_bytes[entry.file_id] += self._record_size(key, entry.value_size)
+
+    '''
+    /////////////////// Mapping interface /////////////////
+    '''
+
+    def __getitem__(self, key):
+        with self.lock:
+            entry = self.keydir[key]
+            mapped = self._map(entry.file_id, entry.value_pos + entry.value_size)
+            value_bytes = mapped[entry.value_pos:entry.value_pos + entry.value_size]
+        return pickle.loads(value_bytes)
+
+    def __setitem__(self, key, value):
+        value_bytes = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            entry = self._append(key, value_bytes, self._next_timestamp())
+            self._mark_dead(key, self.keydir.get(key))
+            self.keydir[key] = entry
+
+    def __delitem__(self, key):
+        with self.lock:
+            old_entry = self.keydir.pop(key)
+            tombstone = self._append(key, None, self._next_timestamp())
+            self._mark_dead(key, old_entry)
+            self.dead_bytes[tombstone.file_id] += self._record_size(key, TOMBSTONE)
+
+    def __contains__(self, key):
+        return key in self.keydir
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.keydir))
+
+    def __len__(self):
+        return len(self.keydir)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    '''
+    /////////////////// Merge /////////////////
+    '''
+
+    def _should_merge(self) -> bool:
+        immutable = [file_id for file_id in self.file_sizes if file_id != self.active_id]
+        total = sum(self.file_sizes[file_id] for file_id in immutable)
+        dead = sum(self.dead_bytes[file_id] for file_id in immutable)
+        return total > 0 and dead / total >= self.merge_dead_ratio
+
+    def merge(self) -> None:
+        """
+        Compacts every immutable data file into new files holding only live values.
+
+        Each merged file gets a hint file so the keydir can be rebuilt without scanning values.
+        A key whose keydir entry moved while the merge ran keeps the newer location.
+        """
+        with self.merge_lock:
+            with self.lock:
+                if self.file_sizes[self.active_id] > 0:
+                    self._rotate_active_file()
+                inputs = sorted(file_id for file_id in self.file_sizes if file_id != self.active_id)
+                live = [(key, entry) for key, entry in self.keydir.items() if entry.file_id in inputs]
+            if not inputs:
+                return
+
+            output_id, output_file, hint_file, output_size = None, None, None, 0
+            moved = []
+            for key, entry in live:
+                with self.lock:
+                    mapped = self._map(entry.file_id, entry.value_pos + entry.value_size)
+                    value_bytes = mapped[entry.value_pos:entry.value_pos + entry.value_size]
+
+                key_bytes = key.encode("utf-8")
+                body = struct.pack("<QII", entry.timestamp, len(key_bytes), len(value_bytes)) + key_bytes + value_bytes
+                record = struct.pack("<I", zlib.crc32(body)) + body
+                if output_file is None or output_size + len(record) > self.max_file_size:
+                    if output_file is not None:
+                        self._finish_merge_file(output_id, output_file, hint_file, output_size)
+                    with self.lock:
+                        output_id = max(self.file_sizes) + 1
+                        self.file_sizes[output_id] = 0
+                        self.dead_bytes[output_id] = 0
+                    output_file = open(self._data_path(output_id), "wb")
+                    hint_file = open(self._hint_path(output_id) + ".tmp", "wb")
+                    output_size = 0
+
+                value_pos = output_size + _RECORD_HEADER.size + len(key_bytes)
+                output_file.write(record)
+                hint_file.write(_HINT_HEADER.pack(entry.timestamp, len(key_bytes), len(value_bytes), value_pos) + key_bytes)
+                output_size += len(record)
+                moved.append((key, entry, KeydirEntry(output_id, value_pos, len(value_bytes), entry.timestamp)))
+
+            if output_file is not None:
+                self._finish_merge_file(output_id, output_file, hint_file, output_size)
+
+            with self.lock:
+                for key, old_entry, new_entry in moved:
+                    if self.keydir.get(key) == old_entry:
+                        self.keydir[key] = new_entry
+                    else:
+                        self._mark_dead(key, new_entry)
+                for file_id in inputs:
+                    mapped = self.maps.pop(file_id, None)
+                    if mapped is not None:
+                        mapped.close()
+                    self.file_sizes.pop(file_id)
+                    self.dead_bytes.pop(file_id)
+                    os.remove(self._data_path(file_id))
+                    if os.path.exists(self._hint_path(file_id)):
+                        os.remove(self._hint_path(file_id))
+            logging.info(f"Bitcask merge compacted {len(inputs)} files into {len(moved)} live records")
+
+    def _finish_merge_file(self, file_id, output_file, hint_file, size):
+        output_file.flush()
+        os.fsync(output_file.fileno())
+        output_file.close()
+        hint_file.flush()
+        os.fsync(hint_file.fileno())
+        hint_file.close()
+        # The hint file only becomes visible once its data file is durable
+        os.replace(self._hint_path(file_id) + ".tmp", self._hint_path(file_id))
+        with self.lock:
+            self.file_sizes[file_id] = size
+
+    '''
+    /////////////////// Background work /////////////////
+    '''
+
+    def _start_background_worker(self):
+        thread = threading.Thread(target=self._background_worker)
+        thread.daemon = True
+        thread.start()
+
+    def _background_worker(self):
+        last_merge = time.time()
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            try:
+                if self.dirty and self.fsync == FSYNC_INTERVAL:
+                    with self.lock:
+                        if self.closed:
+                            return
+                        self.dirty = False
+                        os.fsync(self.active_file.fileno())
+                if time.time() - last_merge >= self.merge_interval:
+                    last_merge = time.time()
+                    if self._should_merge():
+                        self.merge()
+            except Exception as e:
+                logging.error(f"Error in bitcask background worker: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "backend": type(self).__name__,
+                "keys": len(self.keydir),
+                "files": len(self.file_sizes),
+                "bytes": sum(self.file_sizes.values()),
+                "dead_bytes": sum(self.dead_bytes.values()),
+            }
+
+    def close(self) -> None:
+        self.closed = True
+        with self.lock:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.active_file.close()
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
@@ -0,0 +1,155 @@
+import sys
+import time
+import zlib
+import threading
+from collections import Counter
+
+# A compressed value is stored as (COMPRESSED, codec, kind, data): a plain tuple, so it is
+# stored, replicated, hinted and digested like any other value. kind tells whether the
+# original was a str or bytes; other values are never compressed.
+COMPRESSED = "\x00kv-compressed"
+KIND_STR = "str"
+KIND_BYTES = "bytes"
+
+
+def is_compressed(value) -> bool:
+    return isinstance(value, tuple) and len(value) == 4 and value[0] == COMPRESSED
+
+
+def train_dictionary(samples, size=32 * 1024, piece=32) -> bytes:
+    """
+    Builds a zlib preset dictionary from sample values: the pieces that recur most across
+    the samples, the most common last since zlib encodes nearer matches more cheaply.
+
+    Args:
+        samples (iterable): Sample str or bytes values
+        size (int): Dictionary size in bytes; zlib uses at most 32 KB of it
+        piece (int): Length of the substrings counted
+
+    Returns:
+        bytes: The dictionary
+    """
+    counts = Counter()
+    for sample in samples:
+        data = sample.encode("utf-8") if isinstance(sample, str) else bytes(sample)
+        for start in range(0, max(len(data) - piece, 0) + 1, piece // 2):
+            counts[data[start:start + piece]] += 1
+    dictionary = b""
+    for chunk, count in counts.most_common():
+        if count < 2 or len(dictionary) + len(chunk) > size:
+            break
+        dictionary = chunk + dictionary
+    return dictionary
+
+
+# Compresses values of at least threshold bytes with zlib, optionally primed with a trained
+# preset dictionary, which pays off for many small values that share their structure.
+# A value stays as it is if compressing does not make it smaller. The codec name carries
+# the dictionary's checksum, so a node with a different dictionary refuses to decompress.
+class ValueCodec:
+    def __init__(self, enabled=True, threshold=256, level=6, dictionary=None):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary
+        self.codec = f"zlib-{zlib.crc32(dictionary):08x}" if dictionary else "zlib"
+        # Priming zlib with a dictionary is costly, so it is done once and copied per value
+        self.compressor = zlib.compressobj(level, zdict=dictionary) if dictionary else zlib.compressobj(level)
+        self.decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else None
+
+        self.lock = threading.Lock()
+        self.counters = {"values": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0,
+                         "compress_seconds": 0.0, "decompressed": 0, "decompress_seconds": 0.0}
+
+    def compress(self, value):
+        """
+        Returns:
+            The compressed form of the value, or the value itself if it is not worth compressing
+        """
+        if not self.enabled:
+            return value
+        if isinstance(value, str):
+            kind, data = KIND_STR, value.encode("utf-8")
+        elif isinstance(value, bytes):
+            kind, data = KIND_BYTES, value
+        else:
+            return value
+        if len(data) < self.threshold:
+            self._count(values=1, bytes_in=len(data), bytes_out=len(data))
+            return value
+
+        started = time.perf_counter()
+        compressor = self.compressor.copy()
+        compressed = compressor.compress(data) + compressor.flush()
+        elapsed = time.perf_counter() - started
+        if len(compressed) >= len(data):
+            self._count(values=1, bytes_in=len(data), bytes_out=len(data), compress_seconds=elapsed)
+            return value
+        self._count(values=1, compressed=1, bytes_in=len(data), bytes_out=len(compressed), compress_seconds=elapsed)
+        return (COMPRESSED, self.codec, kind, compressed)
+
+    def decompress(self, value):
+        """
+        Returns:
+            The original of a compressed value, any other value as it is
+
+        Raises:
+            ValueError: If the value was compressed with a dictionary this codec does not have
+        """
+        if not is_compressed(value):
+            return value
+        _, codec, kind, compressed = value
+        started = time.perf_counter()
+        if codec == "zlib":
+            decompressor = zlib.decompressobj()
+        elif codec == self.codec:
+            decompressor = self.decompressor.copy()
+        else:
+            raise ValueError(f"Value was compressed with {codec}, this node has {self.codec}")
+        data = decompressor.decompress(compressed) + decompressor.flush()
+        self._count(decompressed=1, decompress_seconds=time.perf_counter() - started)
+        return data.decode("utf-8") if kind == KIND_STR else data
+
+    def _count(self, **amounts):
+        with self.lock:
+            for counter, amount in amounts.items():
+                self.counters[counter] += amount
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+        counters["codec"] = self.codec if self.enabled else None
+        counters["ratio"] = counters["bytes_in"] / counters["bytes_out"] if counters["bytes_out"] else 1.0
+        return counters
+
+
+def load_codec(config: dict, base_path: str) -> ValueCodec:
+    """
+    Builds the codec from the compression section of the server config.
+
+    Raises:
+        ValueError: If a dictionary is configured but cannot be read. A node compressing
+            without the dictionary the other nodes use could not read their values.
+    """
+    dictionary = None
+    if config["dictionary"]:
+        try:
+            with open(f"{base_path}/{config['dictionary']}", "rb") as f:
+                dictionary = f.read()
+        except OSError as e:
+            raise ValueError(f"Cannot read compression dictionary {config['dictionary']}: {e}") from e
+    return ValueCodec(enabled=config["enabled"], threshold=config["threshold"], level=config["level"],
+                      dictionary=dictionary)
+
+
+if __name__ == "__main__":
+    # Trains a dictionary from sample values, one per line, to ship with every node
+    if len(sys.argv) != 3:
+        print("Usage: python compression.py <samples file> <dictionary file>")
+        sys.exit(1)
+    with open(sys.argv[1], "rb") as f:
+        samples = f.read().splitlines()
+    dictionary = train_dictionary(samples)
+    with open(sys.argv[2], "wb") as f:
+        f.write(dictionary)
+    print(f"Wrote a {len(dictionary)} byte dictionary trained on {len(samples)} samples")
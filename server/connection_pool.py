@@ -0,0 +1,163 @@
+import time
+import rpyc
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Errors that mean the connection itself is broken rather than the remote call failing
+CONNECTION_ERRORS = (EOFError, OSError, TimeoutError)
+# Errors a pooled connection shows when the peer closed it while it sat idle
+STALE_ERRORS = (EOFError, ConnectionError)
+
+
+# Pool of reusable rpyc connections, kept per peer.
+# Borrowing a connection that is already open saves the TCP handshake and rpyc setup of a
+# fresh rpyc.connect. Connections idle for too long are closed, connections idle for a while
+# are pinged before reuse, and a connection that breaks during a call is dropped and
+# replaced once by a fresh one.
+class ConnectionPool:
+    def __init__(self, max_size=8, idle_timeout=60, health_check_interval=5,
+                 connect_timeout=3, request_timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+
+        self.lock = threading.Lock()
+        self.idle = dict()          # (host, port) -> deque of (conn, last_used)
+        self.in_use = dict()        # (host, port) -> borrowed connection count
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.discarded = 0
+
+    def _connect(self, host, port):
+        config = {"sync_request_timeout": self.request_timeout}
+        stream = rpyc.SocketStream.connect(host, port, timeout=self.connect_timeout, nodelay=True)
+        return rpyc.connect_stream(stream, config=config)
+
+    def _close(self, conn):
+        self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, idle_for) -> bool:
+        if conn.closed or idle_for > self.idle_timeout:
+            return False
+        if idle_for > self.health_check_interval:
+            try:
+                conn.ping(timeout=self.connect_timeout)
+            except Exception:
+                return False
+        return True
+
+    def acquire(self, host, port):
+        """
+        Borrows a connection to the given peer, opening a new one if none is idle.
+
+        Returns:
+            tuple: (connection, reused) where reused tells whether it came from the pool
+        """
+        peer = (host, int(port))
+        while True:
+            with self.lock:
+                idle = self.idle.get(peer)
+                if not idle:
+                    self.misses += 1
+                    self.in_use[peer] = self.in_use.get(peer, 0) + 1
+                    break
+                conn, last_used = idle.pop()
+            if self._healthy(conn, time.time() - last_used):
+                with self.lock:
+                    self.hits += 1
+                    self.in_use[peer] = self.in_use.get(peer, 0) + 1
+                return conn, True
+            self._close(conn)
+
+        try:
+            return self._connect(host, int(port)), False
+        except Exception:
+            with self.lock:
+                self.in_use[peer] -= 1
+            raise
+
+    def release(self, host, port, conn, broken=False) -> None:
+        peer = (host, int(port))
+        with self.lock:
+            self.in_use[peer] -= 1
+            idle = self.idle.setdefault(peer, deque())
+            if not broken and not conn.closed and len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        self._close(conn)
+
+    @contextmanager
+    def connection(self, host, port):
+        conn, _ = self.acquire(host, port)
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self.release(host, port, conn, broken=True)
+            raise
+        except Exception:
+            self.release(host, port, conn, broken=conn.closed)
+            raise
+        self.release(host, port, conn)
+
+    def call(self, host, port, method, *args):
+        """
+        Calls an exposed method of the peer's service over a pooled connection.
+
+        If a reused connection turns out to be broken, the call is retried once on a fresh one.
+        """
+        for attempt in range(2):
+            conn, reused = self.acquire(host, port)
+            try:
+                result = getattr(conn.root, method)(*args)
+            except CONNECTION_ERRORS as e:
+                self.release(host, port, conn, broken=True)
+                if not reused or attempt == 1 or not isinstance(e, STALE_ERRORS):
+                    raise
+                with self.lock:
+                    self.reconnects += 1
+                logging.debug(f"Reconnecting to {host}:{port} after a stale pooled connection: {e}")
+                continue
+            except Exception:
+                self.release(host, port, conn, broken=conn.closed)
+                raise
+            self.release(host, port, conn)
+            return result
+
+    def probe(self, host, port) -> bool:
+        """
+        Checks that the peer is reachable, reusing a pooled connection when there is one.
+        """
+        try:
+            with self.connection(host, port) as conn:
+                conn.ping(timeout=self.connect_timeout)
+            return True
+        except Exception:
+            return False
+
+    def clear(self, host, port) -> None:
+        with self.lock:
+            idle = self.idle.pop((host, int(port)), deque())
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "reconnects": self.reconnects,
+                "discarded": self.discarded,
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "in_use": sum(self.in_use.values()),
+            }
@@ -0,0 +1,124 @@
+import time
+import rpyc
+import logging
+import threading
+import concurrent.futures
+
+UP = "up"
+SUSPECT = "suspect"
+DOWN = "down"
+
+
+# Heartbeat-based failure detector.
+# A background thread pings every peer once per interval and keeps an up/suspect/down view
+# of the cluster, so request paths can look a peer up in O(1) instead of probing it.
+# A peer is suspected after suspect_after consecutive missed heartbeats and marked down after
+# down_after; one answered heartbeat brings it back up. A peer that answers but reports
+# itself inactive counts as a missed heartbeat.
+class FailureDetector:
+    def __init__(self, pool, interval=1.0, timeout=0.5, suspect_after=1, down_after=3):
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self.suspect_after = suspect_after
+        self.down_after = down_after
+
+        self.lock = threading.Lock()
+        self.peers = set()
+        self.states = dict()            # (host, port) -> UP | SUSPECT | DOWN
+        self.missed = dict()            # (host, port) -> consecutive missed heartbeats
+        self.last_seen = dict()         # (host, port) -> time of the last answered heartbeat
+        self.listeners = list()
+        self.executor = None
+        self.running = False
+
+    def set_peers(self, peers) -> None:
+        with self.lock:
+            self.peers = set((host, int(port)) for host, port in peers)
+            for peer in self.peers:
+                self.states.setdefault(peer, UP)
+                self.missed.setdefault(peer, 0)
+
+    def add_listener(self, listener) -> None:
+        """
+        Registers listener(host, port, old_state, new_state), called on every state change.
+        """
+        self.listeners.append(listener)
+
+    def state(self, host, port) -> str:
+        # Peers that were never probed are assumed to be up
+        return self.states.get((host, int(port)), UP)
+
+    def is_available(self, host, port) -> bool:
+        return self.state(host, port) != DOWN
+
+    def is_up(self, host, port) -> bool:
+        return self.state(host, port) == UP
+
+    def report_success(self, host, port) -> None:
+        self._record((host, int(port)), True)
+
+    def report_failure(self, host, port) -> None:
+        self._record((host, int(port)), False)
+
+    def _record(self, peer, answered):
+        with self.lock:
+            old_state = self.states.get(peer, UP)
+            if answered:
+                self.missed[peer] = 0
+                self.last_seen[peer] = time.time()
+                new_state = UP
+            else:
+                self.missed[peer] = self.missed.get(peer, 0) + 1
+                if self.missed[peer] >= self.down_after:
+                    new_state = DOWN
+                elif self.missed[peer] >= self.suspect_after:
+                    new_state = SUSPECT
+                else:
+                    new_state = old_state
+            self.states[peer] = new_state
+
+        if new_state != old_state:
+            logging.info(f"Peer {peer[0]}:{peer[1]} changed from {old_state} to {new_state}")
+            for listener in self.listeners:
+                try:
+                    listener(peer[0], peer[1], old_state, new_state)
+                except Exception as e:
+                    logging.error(f"Error in failure detector listener: {e}")
+
+    def _heartbeat(self, peer):
+        host, port = peer
+        try:
+            with self.pool.connection(host, port) as conn:
+                result = rpyc.async_(conn.root.ping)()
+                result.set_expiry(self.timeout)
+                answered = result.value is True
+        except Exception:
+            answered = False
+        self._record(peer, answered)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.running = True
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="heartbeat")
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        logging.info("Failure detector started in the background")
+
+    def _run(self):
+        while self.running:
+            started = time.time()
+            with self.lock:
+                peers = list(self.peers)
+            try:
+                # Peers are probed in parallel so one slow peer does not delay the others
+                list(self.executor.map(self._heartbeat, peers))
+            except Exception as e:
+                logging.error(f"Error in failure detector: {e}")
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def view(self) -> dict:
+        with self.lock:
+            return {f"{host}:{port}": state for (host, port), state in self.states.items()}
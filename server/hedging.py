@@ -0,0 +1,120 @@
+import time
+import threading
+
+
+# Hedged requests: a coordinator waiting on replicas sends the same request on to another
+# node when a replica has not answered within its hedge delay, and counts whichever answer
+# arrives first. A peer's delay is a percentile of its latest latencies for the same kind of
+# request, single key or batch, clamped between min_delay and max_delay, so only requests
+# slower than that peer usually is with such a request get hedged. Hedges are capped at
+# budget_percent of the keys sent to replicas, a hedged batch costing as many keys as it
+# holds, counted over a window that halves every decay_interval seconds, so a slow cluster
+# is not flooded with extra load.
+class Hedger:
+    def __init__(self, peer_load, enabled=True, percentile=95, min_delay=0.005, max_delay=0.2,
+                 budget_percent=10, decay_interval=10):
+        self.peer_load = peer_load
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget_percent / 100
+
+        self.lock = threading.Lock()
+        self.decay_interval = decay_interval
+        self.next_decay = time.monotonic() + decay_interval
+        self.window = {"keys": 0, "hedged_keys": 0}
+        self.counters = {"keys": 0, "hedges": 0, "hedged_keys": 0, "over_budget": 0, "no_target": 0}
+
+    def delay(self, host, port, kind=None) -> float:
+        """
+        Returns:
+            float: Seconds to wait for the peer before hedging a request of the kind, max_delay
+                while its latencies for the kind are unknown
+        """
+        latency = self.peer_load.percentile(host, port, self.percentile, kind)
+        if latency is None:
+            return self.max_delay
+        return min(max(latency, self.min_delay), self.max_delay)
+
+    def sent(self, count=1) -> None:
+        """
+        Counts keys sent to replicas, which the hedge budget is a share of.
+        """
+        with self.lock:
+            self._decay()
+            self.window["keys"] += count
+            self.counters["keys"] += count
+
+    def _decay(self):
+        now = time.monotonic()
+        if now >= self.next_decay:
+            self.next_decay = now + self.decay_interval
+            self.window = { name: count // 2 for name, count in self.window.items() }
+
+    def _take_budget(self, cost) -> bool:
+        with self.lock:
+            self._decay()
+            if self.window["hedged_keys"] + cost > self.budget * self.window["keys"]:
+                self.counters["over_budget"] += 1
+                return False
+            self.window["hedged_keys"] += cost
+            self.counters["hedges"] += 1
+            self.counters["hedged_keys"] += cost
+            return True
+
+    def wait(self, collector, enough, peers, hedge, timeout, kind=None, cost=1) -> bool:
+        """
+        Waits like collector.wait_for(enough, timeout), hedging every peer that has not answered
+        within its delay, or that failed, once.
+
+        Args:
+            collector (QuorumCollector): Collects the responses, keyed by (host, port)
+            enough (callable): Predicate on the responses that ends the wait
+            peers (list): The peers the request went to, tuples that start with host and port
+            hedge (callable): hedge(peer) sends the request on to another node and adds it to
+                the collector; returns False if there was no node left to send it to
+            timeout (float): Seconds to wait in total
+            kind (str): Kind of the request, see request_kind, whose latencies set the delays
+            cost (int): Keys in the request, charged to the budget per hedge
+
+        Returns:
+            bool: The final value of the predicate
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        pending = dict()
+        if self.enabled:
+            pending = { peer: started + self.delay(peer[0], peer[1], kind) for peer in peers }
+
+        while True:
+            now = time.monotonic()
+            if collector.done:
+                # Every request is answered and the quorum still is not reached: hedge the rest now
+                pending = { peer: now for peer in pending }
+            wake = min([deadline] + list(pending.values()))
+            if collector.wait_for(enough, timeout=max(wake - now, 0)):
+                return True
+            now = time.monotonic()
+            if now >= deadline or (collector.done and not pending):
+                return False
+
+            answered = set(replica for replica, _ in collector.snapshot())
+            for peer, hedge_at in list(pending.items()):
+                if hedge_at > now and not collector.done:
+                    continue
+                del pending[peer]
+                if (peer[0], peer[1]) in answered or not self._take_budget(cost):
+                    continue
+                if not hedge(peer):
+                    with self.lock:
+                        self.window["hedged_keys"] = max(self.window["hedged_keys"] - cost, 0)
+                        self.counters["hedges"] -= 1
+                        self.counters["hedged_keys"] -= cost
+                        self.counters["no_target"] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters, enabled=self.enabled)
+        counters["hedge_rate"] = counters["hedged_keys"] / counters["keys"] if counters["keys"] else 0.0
+        return counters
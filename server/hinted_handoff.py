@@ -0,0 +1,324 @@
+import os
+import glob
+import time
+import logging
+import threading
+import itertools
+from persistence import OP_PUT, OP_DELETE, encode_record, iter_records, FSYNC_ALWAYS, FSYNC_INTERVAL
+from versioning import is_newer, version_of
+
+# Status of a delivered hint for a key its target does not replicate at its current ring epoch
+NOT_OWNED = -4
+
+# Durable hinted handoff: writes held for replicas that were down, and their delivery.
+# Hints are kept in memory per target node, for reads and delivery, and appended to an
+# on-disk log per target, so they survive a restart. Delivered hints are logged as deletes,
+# and a target's log is rewritten from memory once it is drained or mostly deletes, without
+# holding the lock while the new log is written.
+# A target is drained by one thread at a time in batches of batch_keys sent as one batched
+# put over a pooled connection, rate limited to max_keys_per_sec. The lock is only held to
+# take a batch and to remove what was delivered, never during network I/O. When a batch
+# fails, delivery stops and resumes later with the hints still queued. A target only takes
+# hints for keys it still replicates, so a ring change since a hint was stored never puts a
+# key back on a node that handed its range over; such hints are rejected and dropped.
+class HintedHandoff:
+    def __init__(self, directory, pool, batch_keys=500, max_keys_per_sec=5000, fsync=FSYNC_INTERVAL,
+                 retry_interval=10):
+        self.directory = directory
+        self.pool = pool
+        self.batch_keys = batch_keys
+        self.max_keys_per_sec = max_keys_per_sec
+        self.fsync = fsync
+        self.retry_interval = retry_interval
+
+        self.lock = threading.Lock()
+        self.queues = dict()            # (host, port) -> {key: (version, value)} in arrival order
+        self.files = dict()             # (host, port) -> open hint log
+        self.log_records = dict()       # (host, port) -> records in the hint log
+        self.draining = set()           # targets a delivery thread is working on
+        self.rewrite_tails = dict()     # (host, port) -> records logged while its log is rewritten
+        self.counters = dict()          # (host, port) -> delivery counters
+        self.is_up = lambda host, port: True
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def _path(self, target):
+        host, port = target
+        return os.path.join(self.directory, f"hints-{host}_{port}.log")
+
+    # Replays the hint logs left by a previous run
+    def _load(self):
+        recovered = 0
+        for file_path in glob.glob(os.path.join(self.directory, "hints-*.log")):
+            host, port = os.path.basename(file_path)[len("hints-"):-len(".log")].rsplit("_", 1)
+            target = (host, int(port))
+            queue = self.queues.setdefault(target, dict())
+            with open(file_path, "rb") as f:
+                for op, key, value in iter_records(f):
+                    if op == OP_PUT:
+                        if is_newer(value, queue.get(key)):
+                            queue[key] = value
+                    elif version_of(queue.get(key)) == tuple(value):
+                        del queue[key]
+            recovered += len(queue)
+            self._rewrite(target)
+        logging.info(f"Recovered {recovered} hints for {len(self.queues)} targets")
+
+    # Replaces a target's log with one holding just the hints still queued. The queue is copied
+    # under the lock, but the new log is written and fsynced without it, so adding hints does not
+    # wait for the rewrite. Records logged for the target meanwhile are kept aside and appended
+    # to the new log, under the lock, right before it replaces the old one.
+    def _rewrite(self, target):
+        with self.lock:
+            if target in self.rewrite_tails:
+                return          # another thread is at it
+            queue = list(self.queues.get(target, dict()).items())
+            self.rewrite_tails[target] = list()
+
+        temp_path = self._path(target) + ".tmp"
+        try:
+            if queue:
+                with open(temp_path, "wb") as f:
+                    for key, record in queue:
+                        f.write(encode_record(OP_PUT, key, record))
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            with self.lock:
+                del self.rewrite_tails[target]
+            raise
+
+        with self.lock:
+            tail = self.rewrite_tails.pop(target)
+            if target in self.files:
+                self.files.pop(target).close()
+            if not queue and not tail:
+                if not self.queues.get(target):
+                    self.queues.pop(target, None)
+                self.log_records.pop(target, None)
+                if os.path.exists(self._path(target)):
+                    os.remove(self._path(target))
+                return
+            with open(temp_path, "ab") as f:
+                for record in tail:
+                    f.write(record)
+                f.flush()
+                if tail and self.fsync == FSYNC_ALWAYS:
+                    os.fsync(f.fileno())
+            os.replace(temp_path, self._path(target))
+            self.files[target] = open(self._path(target), "ab")
+            self.log_records[target] = len(queue) + len(tail)
+
+    def _append(self, target, record):
+        file = self.files.get(target)
+        if file is None:
+            file = self.files[target] = open(self._path(target), "ab")
+        file.write(record)
+        file.flush()
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(file.fileno())
+        self.log_records[target] = self.log_records.get(target, 0) + 1
+        if target in self.rewrite_tails:
+            self.rewrite_tails[target].append(record)
+
+    def add(self, key, record, host, port) -> bool:
+        """
+        Queues a hinted write for the target, unless a newer one for the key is queued already.
+
+        Returns:
+            bool: Whether a hint for the key was queued for the target before
+        """
+        target = (host, int(port))
+        with self.lock:
+            queue = self.queues.setdefault(target, dict())
+            current = queue.get(key)
+            if is_newer(record, current):
+                queue[key] = record
+                self._append(target, encode_record(OP_PUT, key, record))
+        return current is not None
+
+    def get(self, key):
+        """
+        Newest hinted record of the key over all targets, None if there is none.
+        """
+        with self.lock:
+            records = [queue[key] for queue in self.queues.values() if key in queue]
+        newest = None
+        for record in records:
+            if is_newer(record, newest):
+                newest = record
+        return newest
+
+    def records(self) -> dict:
+        """
+        Newest hinted record of every key over all targets.
+        """
+        records = dict()
+        with self.lock:
+            for queue in self.queues.values():
+                for key, record in queue.items():
+                    if is_newer(record, records.get(key)):
+                        records[key] = record
+        return records
+
+    def targets(self) -> list:
+        with self.lock:
+            return [target for target, queue in self.queues.items() if queue]
+
+    def start(self, is_up) -> None:
+        """
+        Starts the background thread that retries delivery to targets with queued hints.
+
+        Args:
+            is_up (callable): is_up(host, port), whether a target is worth trying
+        """
+        self.is_up = is_up
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        logging.info("Hinted handoff started in the background")
+
+    # Safety net for targets that came back without a state change being seen, e.g. hints
+    # stored while the failure detector still considered the target up. Also fsyncs the hint
+    # logs once a second unless every append is fsynced or none is.
+    def _run(self):
+        last_retry = time.time()
+        while True:
+            time.sleep(1)
+            try:
+                self._sync()
+                if time.time() - last_retry < self.retry_interval:
+                    continue
+                last_retry = time.time()
+                for host, port in self.targets():
+                    if self.is_up(host, port):
+                        self.deliver_async(host, port)
+            except Exception as e:
+                logging.error(f"Error in hinted handoff: {e}")
+
+    # The fsyncs run outside the lock, so adding hints does not wait for the disk. A log that
+    # _rewrite closes meanwhile is skipped; the rewritten log was fsynced already.
+    def _sync(self):
+        if self.fsync != FSYNC_INTERVAL:
+            return
+        with self.lock:
+            files = list(self.files.values())
+        for file in files:
+            try:
+                os.fsync(file.fileno())
+            except ValueError:
+                pass            # closed by _rewrite
+
+    def deliver_async(self, host, port) -> None:
+        thread = threading.Thread(target=self.deliver, args=(host, int(port)))
+        thread.daemon = True
+        thread.start()
+
+    def deliver(self, host, port) -> None:
+        """
+        Drains the hints queued for the target, unless another thread is at it already.
+        """
+        target = (host, int(port))
+        with self.lock:
+            if target in self.draining or not self.queues.get(target):
+                return
+            self.draining.add(target)
+            counters = self.counters.setdefault(target, {"delivered": 0, "not_owned": 0, "failed_batches": 0,
+                                                         "drain_rate": 0.0, "last_drain": None, "last_error": None})
+        logging.info(f"Delivering {self.backlog(target)} hints to {host}:{port}")
+        started = time.time()
+        delivered = 0
+        try:
+            while True:
+                with self.lock:
+                    batch = tuple(itertools.islice(self.queues.get(target, dict()).items(), self.batch_keys))
+                if not batch:
+                    break
+                sent = time.time()
+                try:
+                    statuses = self.pool.call(host, port, "multi_put", batch, None, None, True)
+                except Exception as e:
+                    statuses = e
+                if not isinstance(statuses, tuple):
+                    logging.error(f"Hinted handoff to {host}:{port} failed, {self.backlog(target)} hints left: {statuses}")
+                    with self.lock:
+                        counters["failed_batches"] += 1
+                        counters["last_error"] = str(statuses)
+                    break
+                done = [(key, record) for (key, record), status in zip(batch, statuses) if status in (0, 1, NOT_OWNED)]
+                self._remove(target, done, lambda current, record: current is record)
+                not_owned = sum(1 for status in statuses if status == NOT_OWNED)
+                if not_owned:
+                    logging.warning(f"{host}:{port} no longer replicates {not_owned} hinted keys, dropped them")
+                    with self.lock:
+                        counters["not_owned"] += not_owned
+                delivered += len(done) - not_owned
+                if len(done) < len(batch):
+                    logging.error(f"{len(batch) - len(done)} hints were rejected by {host}:{port}, retrying later")
+                    break
+                # Rate limit: a batch may not take less time than max_keys_per_sec allows
+                delay = len(batch) / self.max_keys_per_sec - (time.time() - sent)
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                self.draining.discard(target)
+                counters["delivered"] += delivered
+                counters["last_drain"] = time.time()
+                if delivered:
+                    counters["drain_rate"] = delivered / elapsed if elapsed > 0 else 0.0
+            logging.info(f"Delivered {delivered} hints to {host}:{port} in {elapsed:.2f} seconds")
+
+    def discard(self, entries, host, port) -> int:
+        """
+        Takes hints for the target off its queue that are no longer needed, such as those of a
+        hedged write the target acked itself, unless a newer hint for the key arrived meanwhile.
+
+        Args:
+            entries (tuple): (key, version) of the hints to drop
+
+        Returns:
+            int: Number of hints dropped
+        """
+        return self._remove((host, int(port)), entries,
+                            lambda current, version: version_of(current) == tuple(version))
+
+    # Takes hints off the queue where matches(queued record, entry) holds, so a newer hint for
+    # the key that arrived meanwhile stays. Returns how many were taken off.
+    def _remove(self, target, entries, matches):
+        removed = 0
+        with self.lock:
+            queue = self.queues.get(target)
+            if queue is None:
+                return 0
+            for key, entry in entries:
+                current = queue.get(key)
+                if current is not None and matches(current, entry):
+                    del queue[key]
+                    self._append(target, encode_record(OP_DELETE, key, tuple(current[0])))
+                    removed += 1
+            rewrite = not queue or self.log_records.get(target, 0) > 2 * len(queue) + 1000
+        if rewrite:
+            self._rewrite(target)
+        return removed
+
+    def backlog(self, target=None) -> int:
+        with self.lock:
+            if target is not None:
+                return len(self.queues.get(target, ()))
+            return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            targets = set(self.queues) | set(self.counters)
+            return {
+                "backlog": sum(len(queue) for queue in self.queues.values()),
+                "targets": {
+                    f"{host}:{port}": dict(self.counters.get((host, port), {}),
+                                           backlog=len(self.queues.get((host, port), ())),
+                                           draining=(host, port) in self.draining)
+                    for host, port in targets
+                },
+            }
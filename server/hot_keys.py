@@ -0,0 +1,116 @@
+import time
+import hashlib
+import threading
+
+
+# Count-min sketch: depth rows of width counters, a key counting in one counter per row. A
+# key's estimate is the smallest of its counters, which never undercounts and overcounts by
+# about total / width at most. Counters are only raised as far as the key's new estimate
+# (conservative update), which keeps the overcount of rarely seen keys low.
+class CountMinSketch:
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _indices(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1) -> int:
+        """
+        Returns:
+            int: The key's estimate after adding count
+        """
+        indices = self._indices(key)
+        estimate = min(row[index] for row, index in zip(self.rows, indices)) + count
+        for row, index in zip(self.rows, indices):
+            if row[index] < estimate:
+                row[index] = estimate
+        return estimate
+
+    def estimate(self, key) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indices(key)))
+
+    def halve(self) -> None:
+        self.rows = [[counter >> 1 for counter in row] for row in self.rows]
+
+
+# Finds the keys that take a large share of the recent accesses. Every access is counted in a
+# count-min sketch whose counters are halved every decay_interval seconds, so a key that
+# cools down stops counting as hot within a few intervals. A key is hot while its estimate is
+# at least hot_fraction of all recent accesses and at least min_count. The top_k keys with
+# the highest estimates are kept for monitoring.
+class HotKeyTracker:
+    def __init__(self, width=2048, depth=4, decay_interval=10, hot_fraction=0.01, min_count=50, top_k=20):
+        self.sketch = CountMinSketch(width, depth)
+        self.decay_interval = decay_interval
+        self.hot_fraction = hot_fraction
+        self.min_count = min_count
+        self.top_k = top_k
+
+        self.lock = threading.Lock()
+        self.total = 0                  # recent accesses, decayed like the counters
+        self.top = dict()               # key -> estimate, at most top_k keys
+        self.top_floor = 0              # lowest estimate in top when it was last full
+        self.next_decay = time.monotonic() + decay_interval
+
+    def record(self, key) -> bool:
+        """
+        Counts one access to the key.
+
+        Returns:
+            bool: Whether the key is hot
+        """
+        with self.lock:
+            self._decay()
+            self.total += 1
+            estimate = self.sketch.add(key)
+            self._track(key, estimate)
+            return estimate >= self.min_count and estimate >= self.hot_fraction * self.total
+
+    def _decay(self):
+        now = time.monotonic()
+        if now < self.next_decay:
+            return
+        self.next_decay = now + self.decay_interval
+        self.sketch.halve()
+        self.total >>= 1
+        self.top = { key: estimate >> 1 for key, estimate in self.top.items() if estimate > 1 }
+        self.top_floor >>= 1
+
+    def _track(self, key, estimate):
+        if key in self.top or len(self.top) < self.top_k:
+            self.top[key] = estimate
+            return
+        if estimate <= self.top_floor:
+            return
+        coldest = min(self.top, key=self.top.get)
+        if estimate > self.top[coldest]:
+            del self.top[coldest]
+            self.top[key] = estimate
+            coldest = min(self.top, key=self.top.get)
+        self.top_floor = self.top[coldest]
+
+    def hot_keys(self) -> tuple:
+        """
+        Returns:
+            tuple: (key, estimated recent accesses, whether it is hot) of the top keys,
+                the most accessed first
+        """
+        with self.lock:
+            self._decay()
+            threshold = max(self.min_count, self.hot_fraction * self.total)
+            top = sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+            return tuple((key, estimate, estimate >= threshold) for key, estimate in top)
+
+    def stats(self) -> dict:
+        hot_keys = self.hot_keys()
+        with self.lock:
+            return {
+                "recent_accesses": self.total,
+                "hot": sum(1 for _, _, hot in hot_keys if hot),
+                "hottest": hot_keys[0][0] if hot_keys else None,
+            }
@@ -0,0 +1,447 @@
+import os
+import glob
+import math
+import pickle
+import struct
+import bisect
+import hashlib
+import logging
+import threading
+from storage import StorageBackend
+from persistence import encode_record, iter_records, OP_PUT, OP_DELETE
+
+# SSTable entry: key size | tombstone flag | value size | key | value
+_ENTRY_HEADER = struct.Struct("<IBI")
+# SSTable footer: index offset | index size | bloom offset | bloom size | magic
+_FOOTER = struct.Struct("<QQQQ8s")
+_MAGIC = b"KVSSTBL1"
+
+# Marks a deleted key in memtables and SSTables until compaction drops it
+TOMBSTONE = object()
+
+
+class BloomFilter:
+    def __init__(self, bit_count, hash_count, bits=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((bit_count + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, key_count, bits_per_key):
+        bit_count = max(64, key_count * bits_per_key)
+        hash_count = max(1, round(bits_per_key * math.log(2)))
+        return cls(bit_count, hash_count)
+
+    # Double hashing: positions are h1 + i*h2 for two halves of one digest
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def to_bytes(self) -> bytes:
+        return struct.pack("<QI", self.bit_count, self.hash_count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        bit_count, hash_count = struct.unpack_from("<QI", data)
+        return cls(bit_count, hash_count, bytearray(data[12:]))
+
+
+# Immutable sorted table on disk.
+# Only the block index (first key and location of every data block) and the Bloom filter
+# are held in memory; a lookup reads at most one data block.
+class SSTable:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        footer = os.pread(self.fd, _FOOTER.size, self.size - _FOOTER.size)
+        index_offset, index_size, bloom_offset, bloom_size, magic = _FOOTER.unpack(footer)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not an SSTable")
+        self.block_keys, self.block_locations = pickle.loads(os.pread(self.fd, index_size, index_offset))
+        self.bloom = BloomFilter.from_bytes(os.pread(self.fd, bloom_size, bloom_offset))
+
+    @staticmethod
+    def write(path, items, block_size, bits_per_key):
+        """
+        Writes sorted (key, value) pairs as an SSTable. Values may be TOMBSTONE.
+
+        Returns:
+            SSTable: The opened table
+        """
+        items = list(items)
+        bloom = BloomFilter.for_keys(len(items), bits_per_key)
+        block_keys, block_locations = [], []
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            block = bytearray()
+            first_key = None
+            offset = 0
+            for key, value in items:
+                bloom.add(key)
+                if first_key is None:
+                    first_key = key
+                key_bytes = key.encode("utf-8")
+                if value is TOMBSTONE:
+                    block += _ENTRY_HEADER.pack(len(key_bytes), 1, 0) + key_bytes
+                else:
+                    value_bytes = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                    block += _ENTRY_HEADER.pack(len(key_bytes), 0, len(value_bytes)) + key_bytes + value_bytes
+                if len(block) >= block_size:
+                    f.write(block)
+                    block_keys.append(first_key)
+                    block_locations.append((offset, len(block)))
+                    offset += len(block)
+                    block, first_key = bytearray(), None
+            if block:
+                f.write(block)
+                block_keys.append(first_key)
+                block_locations.append((offset, len(block)))
+                offset += len(block)
+
+            index = pickle.dumps((block_keys, block_locations), protocol=pickle.HIGHEST_PROTOCOL)
+            bloom_bytes = bloom.to_bytes()
+            f.write(index)
+            f.write(bloom_bytes)
+            f.write(_FOOTER.pack(offset, len(index), offset + len(index), len(bloom_bytes), _MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return SSTable(path)
+
+    def _read_block(self, block_number):
+        offset, length = self.block_locations[block_number]
+        data = os.pread(self.fd, length, offset)
+        pos = 0
+        while pos < len(data):
+            key_size, tombstone, value_size = _ENTRY_HEADER.unpack_from(data, pos)
+            pos += _ENTRY_HEADER.size
+            key = data[pos:pos + key_size].decode("utf-8")
+            pos += key_size
+            yield key, tombstone, data, pos, value_size
+            pos += value_size
+
+    def get(self, key):
+        """
+        Returns the value stored for key, TOMBSTONE if it was deleted, or None if this
+        table does not know the key.
+        """
+        if not self.bloom.might_contain(key):
+            return None
+        block_number = bisect.bisect_right(self.block_keys, key) - 1
+        if block_number < 0:
+            return None
+        for entry_key, tombstone, data, pos, value_size in self._read_block(block_number):
+            if entry_key == key:
+                return TOMBSTONE if tombstone else pickle.loads(data[pos:pos + value_size])
+            if entry_key > key:
+                break
+        return None
+
+    def items(self):
+        for block_number in range(len(self.block_locations)):
+            for key, tombstone, data, pos, value_size in self._read_block(block_number):
+                yield key, TOMBSTONE if tombstone else pickle.loads(data[pos:pos + value_size])
+
+    def __del__(self):
+        # Tables replaced by a compaction are closed once the last reader lets go of them
+        try:
+            os.close(self.fd)
+        except Exception:
+            pass
+
+
+# Log-structured merge tree for write-heavy nodes.
+# Writes go to a memtable backed by a small write-ahead log. Full memtables are flushed in the
+# background to immutable SSTables, and runs of similarly sized adjacent tables are merged by
+# size-tiered compaction. The MANIFEST lists the live tables from newest to oldest.
+class LSMStore(StorageBackend):
+    def __init__(self, directory, memtable_size=4 * 1024 * 1024, block_size=4096,
+                 bloom_bits_per_key=10, compaction_threshold=4, tier_ratio=4):
+        self.directory = directory
+        self.memtable_size = memtable_size
+        self.block_size = block_size
+        self.bloom_bits_per_key = bloom_bits_per_key
+        self.compaction_threshold = compaction_threshold
+        self.tier_ratio = tier_ratio
+
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        self.work_event = threading.Event()
+        self.tables = list()                # newest first
+        self.immutables = list()            # [(log_id, memtable)] waiting to be flushed, newest first
+        self.memtable = dict()
+        self.memtable_bytes = 0
+        self.misses = 0
+        self.closed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self._start_background_worker()
+
+    def _manifest_path(self):
+        return os.path.join(self.directory, "MANIFEST")
+
+    def _log_path(self, log_id):
+        return os.path.join(self.directory, f"memtable-{log_id:08d}.log")
+
+    def _table_path(self, table_id):
+        return os.path.join(self.directory, f"{table_id:08d}.sst")
+
+    def _next_file_id(self):
+        with self.lock:
+            self.file_id += 1
+            return self.file_id
+
+    '''
+    /////////////////// Recovery /////////////////
+    '''
+
+    def _recover(self):
+        table_names = []
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                table_names = f.read().split()
+        self.tables = [SSTable(os.path.join(self.directory, name)) for name in table_names]
+
+        # Tables that never made it into the manifest are leftovers of an interrupted flush or compaction
+        for file_path in glob.glob(os.path.join(self.directory, "*.sst*")):
+            if os.path.basename(file_path) not in table_names:
+                os.remove(file_path)
+
+        ids = [int(name[:-len(".sst")]) for name in table_names]
+        logs = sorted(int(os.path.basename(p)[len("memtable-"):-len(".log")])
+                      for p in glob.glob(os.path.join(self.directory, "memtable-*.log")))
+        self.file_id = max(ids + logs, default=0)
+
+        # Memtables that were not flushed before the restart are replayed, oldest first
+        replayed = 0
+        for log_id in logs:
+            with open(self._log_path(log_id), "rb") as f:
+                for op, key, value in iter_records(f):
+                    self.memtable[key] = value if op == OP_PUT else TOMBSTONE
+                    replayed += 1
+        self.log_id = self._next_file_id()
+        self.log_file = open(self._log_path(self.log_id), "ab")
+        for log_id in logs:
+            self.log_file.write(open(self._log_path(log_id), "rb").read())
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        for log_id in logs:
+            os.remove(self._log_path(log_id))
+        self.memtable_bytes = self.log_file.tell()
+        logging.info(f"LSM store opened with {len(self.tables)} SSTables and {replayed} replayed memtable records")
+
+    def _write_manifest(self):
+        temp_path = self._manifest_path() + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(os.path.basename(table.path) for table in self.tables))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._manifest_path())
+
+    '''
+    /////////////////// Mapping interface /////////////////
+    '''
+
+    def _write(self, key, value):
+        record = encode_record(OP_DELETE, key) if value is TOMBSTONE else encode_record(OP_PUT, key, value)
+        with self.lock:
+            self.log_file.write(record)
+            self.log_file.flush()
+            self.memtable[key] = value
+            self.memtable_bytes += len(record)
+            if self.memtable_bytes >= self.memtable_size:
+                self._freeze_memtable()
+
+    # Swaps in an empty memtable and hands the full one to the background flusher
+    def _freeze_memtable(self):
+        os.fsync(self.log_file.fileno())
+        self.log_file.close()
+        self.immutables.insert(0, (self.log_id, self.memtable))
+        self.memtable = dict()
+        self.memtable_bytes = 0
+        self.log_id = self._next_file_id()
+        self.log_file = open(self._log_path(self.log_id), "ab")
+        self.work_event.set()
+
+    def _lookup(self, key):
+        with self.lock:
+            value = self.memtable.get(key)
+            if value is not None:
+                return value
+            for _, memtable in self.immutables:
+                value = memtable.get(key)
+                if value is not None:
+                    return value
+            tables = list(self.tables)
+
+        for table in tables:
+            value = table.get(key)
+            if value is not None:
+                return value
+        self.misses += 1
+        return None
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is None or value is TOMBSTONE:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._write(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._write(key, TOMBSTONE)
+
+    def __contains__(self, key):
+        value = self._lookup(key)
+        return value is not None and value is not TOMBSTONE
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is None or value is TOMBSTONE:
+            return default
+        return value
+
+    # Newest version of every key across tables and memtables
+    def _live_items(self):
+        with self.lock:
+            tables = list(self.tables)
+            memtables = [memtable for _, memtable in reversed(self.immutables)] + [dict(self.memtable)]
+        merged = dict()
+        for table in reversed(tables):
+            merged.update(table.items())
+        for memtable in memtables:
+            merged.update(memtable)
+        return {key: value for key, value in merged.items() if value is not TOMBSTONE}
+
+    def __iter__(self):
+        return iter(list(self._live_items()))
+
+    def __len__(self):
+        return len(self._live_items())
+
+    '''
+    /////////////////// Flush and compaction /////////////////
+    '''
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.memtable:
+                self._freeze_memtable()
+        self._flush_immutables()
+
+    def _flush_immutables(self):
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    if not self.immutables:
+                        return
+                    log_id, memtable = self.immutables[-1]
+
+                table = SSTable.write(self._table_path(self._next_file_id()), sorted(memtable.items()),
+                                      self.block_size, self.bloom_bits_per_key)
+                with self.lock:
+                    self.tables.insert(0, table)
+                    self._write_manifest()
+                    self.immutables.pop()
+                os.remove(self._log_path(log_id))
+                logging.debug(f"Flushed memtable {log_id} with {len(memtable)} keys to {table.path}")
+
+    def _tier(self, table):
+        return int(math.log(max(table.size, self.block_size) / self.block_size, self.tier_ratio))
+
+    # Finds the longest run of adjacent tables in the same size tier
+    def _pick_compaction_run(self, tables):
+        best_start, best_length = 0, 0
+        start = 0
+        for i in range(1, len(tables) + 1):
+            if i == len(tables) or self._tier(tables[i]) != self._tier(tables[start]):
+                if i - start > best_length:
+                    best_start, best_length = start, i - start
+                start = i
+        return best_start, best_length
+
+    def compact(self) -> bool:
+        """
+        Merges one run of similarly sized adjacent tables into a single table.
+        Tombstones are dropped when the run reaches the oldest table.
+
+        Returns:
+            bool: True if a compaction was performed
+        """
+        with self.compaction_lock:
+            with self.lock:
+                tables = list(self.tables)
+            start, length = self._pick_compaction_run(tables)
+            if length < self.compaction_threshold:
+                return False
+
+            run = tables[start:start + length]
+            includes_oldest = start + length == len(tables)
+            merged = dict()
+            for table in reversed(run):
+                merged.update(table.items())
+            items = sorted((key, value) for key, value in merged.items()
+                           if not (includes_oldest and value is TOMBSTONE))
+
+            table = SSTable.write(self._table_path(self._next_file_id()), items,
+                                  self.block_size, self.bloom_bits_per_key)
+            with self.lock:
+                # Flushes only ever add tables in front, so the run is still contiguous
+                position = self.tables.index(run[0])
+                self.tables[position:position + length] = [table]
+                self._write_manifest()
+            for old_table in run:
+                os.remove(old_table.path)
+            logging.info(f"Compacted {length} SSTables into {table.path} with {len(items)} keys")
+            return True
+
+    def _start_background_worker(self):
+        thread = threading.Thread(target=self._background_worker)
+        thread.daemon = True
+        thread.start()
+
+    def _background_worker(self):
+        while not self.closed:
+            self.work_event.wait(timeout=1)
+            self.work_event.clear()
+            try:
+                self._flush_immutables()
+                while self.compact():
+                    pass
+            except Exception as e:
+                logging.error(f"Error in LSM background worker: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "backend": type(self).__name__,
+                "sstables": len(self.tables),
+                "sstable_bytes": sum(table.size for table in self.tables),
+                "memtable_keys": len(self.memtable),
+                "pending_flushes": len(self.immutables),
+                "misses": self.misses,
+            }
+
+    def close(self) -> None:
+        self.closed = True
+        self.work_event.set()
+        with self.lock:
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.log_file.close()
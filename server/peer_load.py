@@ -0,0 +1,111 @@
+import time
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+def request_kind(keys) -> str:
+    """
+    Kind of a request for latency percentiles: "single" for one key, "batch" for more.
+    """
+    return "single" if keys == 1 else "batch"
+
+
+# Per-peer view of how loaded each peer looks from here: an EWMA of the latency of the
+# requests sent to it and how many of them are still outstanding. A peer's score is its
+# latency times its outstanding requests plus one, so a slow peer and a peer with a queue of
+# requests both look expensive. Without new samples a peer's latency halves every half_life
+# seconds, so a peer that was slow for a while is tried again eventually. The latest window
+# latencies of each peer are kept as well, for percentiles, separately per kind of request
+# (see request_kind), since a batch takes far longer than a single key.
+class PeerLoad:
+    def __init__(self, alpha=0.3, half_life=5.0, window=200):
+        self.alpha = alpha
+        self.half_life = half_life
+        self.window = window
+        self.lock = threading.Lock()
+        self.peers = dict()             # (host, port) -> [latency EWMA in seconds, updated at, outstanding]
+        self.samples = dict()           # (host, port, kind) -> latest latencies in seconds
+
+    def _state(self, peer):
+        state = self.peers.get(peer)
+        if state is None:
+            state = self.peers[peer] = [None, time.monotonic(), 0]
+        return state
+
+    def _latency(self, state, now):
+        if state[0] is None:
+            return 0.0
+        return state[0] * 0.5 ** ((now - state[1]) / self.half_life)
+
+    @contextmanager
+    def track(self, host, port, kind=None):
+        """
+        Counts the request made inside the block as outstanding to the peer, and adds its
+        latency to the peer's average once it completes or fails, and to the peer's latest
+        latencies of the given kind.
+        """
+        peer = (host, int(port))
+        with self.lock:
+            self._state(peer)[2] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            sample = time.perf_counter() - started
+            with self.lock:
+                state = self._state(peer)
+                now = time.monotonic()
+                latency = self._latency(state, now)
+                state[0] = sample if state[0] is None else self.alpha * sample + (1 - self.alpha) * latency
+                state[1] = now
+                state[2] -= 1
+                samples = self.samples.get(peer + (kind,))
+                if samples is None:
+                    samples = self.samples[peer + (kind,)] = deque(maxlen=self.window)
+                samples.append(sample)
+
+    def percentile(self, host, port, percentile, kind=None, min_samples=10):
+        """
+        Returns:
+            float: The given percentile of the peer's latest latencies of the kind in seconds,
+                or None if fewer than min_samples are known
+        """
+        with self.lock:
+            samples = sorted(self.samples.get((host, int(port), kind), ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def choose(self, candidates) -> list:
+        """
+        Orders the candidates by power of two choices: of two candidates picked at random, the
+        one with the lower score comes first, then the rest from the lowest score up.
+
+        Args:
+            candidates (list): Tuples that start with the host and port of a peer
+
+        Returns:
+            list: The candidates in the order to try them
+        """
+        if len(candidates) < 2:
+            return list(candidates)
+        with self.lock:
+            now = time.monotonic()
+            scores = dict()
+            for candidate in candidates:
+                state = self._state((candidate[0], int(candidate[1])))
+                scores[candidate] = self._latency(state, now) * (state[2] + 1)
+        first, second = random.sample(list(candidates), 2)
+        chosen = first if scores[first] <= scores[second] else second
+        rest = sorted((candidate for candidate in candidates if candidate != chosen), key=scores.get)
+        return [chosen] + rest
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            return {
+                f"{host}:{port}": {"latency_ms": self._latency(state, now) * 1000, "outstanding": state[2]}
+                for (host, port), state in self.peers.items()
+            }
@@ -0,0 +1,245 @@
+import os
+import ast
+import glob
+import time
+import zlib
+import pickle
+import struct
+import logging
+import threading
+
+OP_PUT = 1
+OP_DELETE = 2
+
+# Record framing: crc32 of the payload, payload length, op code
+_HEADER = struct.Struct("<IIB")
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+
+
+def encode_record(op, key, value=None) -> bytes:
+    payload = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(zlib.crc32(payload), len(payload), op) + payload
+
+
+def iter_records(file):
+    """
+    Yields (op, key, value) tuples from an open log file.
+
+    Stops silently at the first truncated or corrupted record, which is what
+    a crash in the middle of an append leaves behind.
+    """
+    while True:
+        header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        crc, length, op = _HEADER.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logging.warning(f"Stopping log replay at a torn record in {file.name}")
+            return
+        key, value = pickle.loads(payload)
+        yield op, key, value
+
+
+# Append-only write-ahead log with periodic snapshots.
+# Every put/delete appends one small record to the active log segment, so the cost of a
+# write does not depend on the size of the store. A background thread takes care of the
+# fsync policy and periodically writes a snapshot, after which older segments are dropped.
+# A whole-store backup written by older versions (legacy_backup) is imported once, into the
+# first snapshot, when no snapshot or log exists yet.
+class PersistenceEngine:
+    def __init__(self, directory, fsync=FSYNC_INTERVAL, fsync_interval_ms=100,
+                 snapshot_interval=60, snapshot_min_records=10000, legacy_backup=None):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_min_records = snapshot_min_records
+        self.legacy_backup = legacy_backup
+
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.segment_id = 0
+        self.log_file = None
+        self.dirty = False
+        self.records_since_snapshot = 0
+        self.last_snapshot = time.time()
+        self.snapshot_source = None
+        self.closed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _snapshot_path(self):
+        return os.path.join(self.directory, "snapshot.dat")
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"wal-{segment_id:08d}.log")
+
+    def _segments(self):
+        segments = []
+        for file_path in glob.glob(os.path.join(self.directory, "wal-*.log")):
+            name = os.path.basename(file_path)
+            segments.append(int(name[len("wal-"):-len(".log")]))
+        return sorted(segments)
+
+    def load(self) -> dict:
+        """
+        Rebuilds the store from the latest snapshot plus the log tail written after it,
+        then opens a fresh segment for new records.
+
+        Returns:
+            dict: The recovered key-value pairs.
+        """
+        store = dict()
+        first_segment = 0
+        segments = self._segments()
+        try:
+            with open(self._snapshot_path(), "rb") as f:
+                first_segment, store = pickle.load(f)
+        except FileNotFoundError:
+            if not segments and self.legacy_backup and os.path.exists(self.legacy_backup):
+                first_segment, store = 1, self._import_legacy_backup()
+
+        replayed = 0
+        for segment_id in segments:
+            if segment_id < first_segment:
+                continue
+            with open(self._segment_path(segment_id), "rb") as f:
+                for op, key, value in iter_records(f):
+                    if op == OP_PUT:
+                        store[key] = value
+                    else:
+                        store.pop(key, None)
+                    replayed += 1
+        logging.info(f"Recovered {len(store)} keys from snapshot and {replayed} log records")
+
+        self.segment_id = max(segments + [first_segment]) + 1
+        self.log_file = open(self._segment_path(self.segment_id), "ab")
+        self.records_since_snapshot = replayed
+        return store
+
+    # Reads the backup with literal_eval, never eval, stamps every value with the backup's
+    # modification time as its version, so any later write wins, and writes it as the first
+    # snapshot. The backup is renamed afterwards, so it is not imported again.
+    def _import_legacy_backup(self) -> dict:
+        with open(self.legacy_backup, "r") as f:
+            backup = ast.literal_eval(f.read() or "{}")
+        version = (int(os.path.getmtime(self.legacy_backup) * 1000), 0, "")
+        store = { key: (version, value) for key, value in backup.items() }
+        self._write_snapshot(1, store)
+        os.replace(self.legacy_backup, self.legacy_backup + ".imported")
+        logging.info(f"Imported {len(store)} keys from legacy backup {self.legacy_backup}")
+        return store
+
+    def _write_snapshot(self, first_segment, data) -> None:
+        temp_path = self._snapshot_path() + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump((first_segment, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._snapshot_path())
+
+    def start(self, snapshot_source) -> None:
+        """
+        Starts the background fsync/snapshot thread.
+
+        Args:
+            snapshot_source (callable): Returns a point-in-time copy of the store to snapshot.
+        """
+        self.snapshot_source = snapshot_source
+        thread = threading.Thread(target=self._background_worker)
+        thread.daemon = True
+        thread.start()
+        logging.info(f"Persistence engine started in {self.directory} with fsync={self.fsync}")
+
+    def _append(self, record: bytes) -> None:
+        with self.lock:
+            self.log_file.write(record)
+            if self.fsync == FSYNC_ALWAYS:
+                self.log_file.flush()
+                os.fsync(self.log_file.fileno())
+            else:
+                self.dirty = True
+            self.records_since_snapshot += 1
+
+    def log_put(self, key, value) -> None:
+        self._append(encode_record(OP_PUT, key, value))
+
+    def log_delete(self, key) -> None:
+        self._append(encode_record(OP_DELETE, key))
+
+    # Only the flush runs under the lock; the fsync runs outside it, so writers never wait for
+    # the disk. A segment that snapshot() rotates out meanwhile is skipped, it fsyncs it itself.
+    def sync(self) -> None:
+        with self.lock:
+            if not self.dirty or self.log_file is None:
+                return
+            self.log_file.flush()
+            self.dirty = False
+            log_file = self.log_file
+        if self.fsync != FSYNC_NEVER:
+            try:
+                os.fsync(log_file.fileno())
+            except ValueError:
+                pass            # closed by snapshot()
+
+    def snapshot(self) -> None:
+        """
+        Writes a snapshot of the store and removes the log segments it covers.
+
+        The log is rotated before the store is copied, so every record in the older
+        segments is already reflected in the copy. Records that land in the new segment
+        may be in the copy as well, which is harmless since replay is idempotent. Only the
+        rotation holds the append lock; the old segment is fsynced and the store copied
+        after it is released.
+        """
+        if self.snapshot_source is None:
+            return
+
+        with self.snapshot_lock:
+            with self.lock:
+                if self.log_file is None:
+                    return      # closed
+                self.log_file.flush()
+                old_file = self.log_file
+                self.segment_id += 1
+                self.log_file = open(self._segment_path(self.segment_id), "ab")
+                self.dirty = False
+                self.records_since_snapshot = 0
+                first_segment = self.segment_id
+            os.fsync(old_file.fileno())
+            old_file.close()
+            data = self.snapshot_source()
+
+            self._write_snapshot(first_segment, data)
+
+            for segment_id in self._segments():
+                if segment_id < first_segment:
+                    os.remove(self._segment_path(segment_id))
+            self.last_snapshot = time.time()
+            logging.info(f"Snapshot written with {len(data)} keys, log truncated to segment {first_segment}")
+
+    def _background_worker(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+                if (self.records_since_snapshot >= self.snapshot_min_records
+                        and time.time() - self.last_snapshot >= self.snapshot_interval):
+                    self.snapshot()
+            except Exception as e:
+                logging.error(f"Error in persistence engine: {e}")
+
+    def close(self) -> None:
+        self.closed = True
+        self.sync()
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
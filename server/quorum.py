@@ -0,0 +1,90 @@
+import time
+import pickle
+import hashlib
+import threading
+
+
+def value_digest(value):
+    """
+    Compact hash of a stored value, used to compare replicas without shipping values.
+
+    Returns:
+        bytes: 8-byte digest, or None for a missing value
+    """
+    if value is None:
+        return None
+    return hashlib.blake2b(pickle.dumps(value, protocol=4), digest_size=8).digest()
+
+
+# Collects the responses of requests sent to several replicas in parallel.
+# The coordinator waits until a quorum condition holds on what has arrived so far, while
+# stragglers keep adding their responses afterwards. Done callbacks run once every replica
+# has answered or failed, which is where late responses can be looked at.
+class QuorumCollector:
+    def __init__(self, expected):
+        self.condition = threading.Condition()
+        self.expected = expected
+        self.responses = list()         # [(replica, response)]
+        self.failures = list()          # [replica]
+        self.callbacks = list()
+        self.fired = False
+
+    @property
+    def done(self) -> bool:
+        return len(self.responses) + len(self.failures) >= self.expected
+
+    def add(self, replica, response) -> None:
+        self._record(lambda: self.responses.append((replica, response)))
+
+    def add_failure(self, replica) -> None:
+        self._record(lambda: self.failures.append(replica))
+
+    def _record(self, update):
+        with self.condition:
+            update()
+            callbacks = []
+            if self.done and not self.fired:
+                self.fired = True
+                callbacks = self.callbacks
+            self.condition.notify_all()
+        for callback in callbacks:
+            callback(self)
+
+    def expect(self, more) -> None:
+        """
+        Counts more replicas the responses are awaited from. Only call it before any done
+        callback is added.
+        """
+        with self.condition:
+            self.expected += more
+            self.fired = self.done
+
+    def wait_for(self, predicate, timeout=None) -> bool:
+        """
+        Blocks until predicate(responses) is true or every replica has answered.
+
+        Returns:
+            bool: The final value of the predicate
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while not predicate(self.responses) and not self.done:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return predicate(self.responses)
+
+    def snapshot(self) -> list:
+        with self.condition:
+            return list(self.responses)
+
+    def add_done_callback(self, callback) -> None:
+        """
+        Runs callback(collector) once all replicas have answered or failed.
+        """
+        with self.condition:
+            if not self.fired:
+                self.callbacks.append(callback)
+                return
+        callback(self)
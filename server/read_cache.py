@@ -0,0 +1,137 @@
+import time
+import threading
+from collections import OrderedDict
+from rpyc.core import brine
+
+
+# Bounded LRU cache of get responses, for workloads where a few hot keys take most of the
+# reads. The load balancer keeps one in front of the coordinators, and every storage node one
+# for the hot key reads it coordinates. Entries expire after ttl seconds, which bounds how
+# stale a value can be when it was written without the cache seeing the write.
+#
+# Writes the cache sees keep it coherent: a write drops the key's entry and voids the reads
+# in flight for it, so a read that started before the write cannot cache the old value
+# afterwards. A write through the load balancer that succeeds stores its value, unless
+# another write to the key overlapped it, as then it is unknown which of them the replicas
+# kept. A storage node only invalidates, once it applied a write to its own copy.
+class ReadCache:
+    def __init__(self, enabled=True, max_entries=10000, ttl=1.0):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> (response, expires at), least recently used first
+        self.reads = dict()             # key -> token shared by the reads in flight that may fill it
+        self.writes = dict()            # key -> [writes in flight, whether writes overlapped]
+        self.counters = {"hits": 0, "misses": 0, "fills": 0, "stale_fills": 0,
+                         "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: The cached (value, status) response of the key, or None on a miss
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self.entries[key]
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[0]
+
+    def begin_read(self, key):
+        """
+        Registers a read that missed the cache and goes to a coordinator.
+
+        Returns:
+            The token to pass to finish_read, or None if a write to the key is in flight
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            if key in self.writes:
+                return None
+            return self.reads.setdefault(key, object())
+
+    def finish_read(self, key, token, response) -> None:
+        """
+        Caches the response of a read, unless a write to the key started since begin_read.
+        Only found values are cached.
+        """
+        if token is None:
+            return
+        with self.lock:
+            if self.reads.get(key) is not token:
+                self.counters["stale_fills"] += 1
+                return
+            del self.reads[key]
+            if isinstance(response, tuple) and len(response) == 2 and response[1] == 0:
+                self._store(key, response)
+
+    def begin_write(self, key) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            if key in self.writes:
+                self.writes[key][0] += 1
+                self.writes[key][1] = True
+            else:
+                self.writes[key] = [1, False]
+            self.reads.pop(key, None)
+            if self.entries.pop(key, None) is not None:
+                self.counters["invalidations"] += 1
+
+    def finish_write(self, key, value, succeeded) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            write = self.writes[key]
+            write[0] -= 1
+            if write[0]:
+                return
+            del self.writes[key]
+            if succeeded and not write[1]:
+                self._store(key, (value, 0))
+
+    def invalidate(self, key) -> None:
+        """
+        Drops the key's entry and voids the reads in flight for it, for a write whose value
+        the cache is not told, such as one a storage node applied to its copy.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.reads.pop(key, None)
+            if self.entries.pop(key, None) is not None:
+                self.counters["invalidations"] += 1
+
+    def _store(self, key, response) -> None:
+        # Only plain values are cached, never references to objects of a client connection
+        if not brine.dumpable(response):
+            return
+        self.entries[key] = (response, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        self.counters["fills"] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.reads.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters, entries=len(self.entries), enabled=self.enabled)
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / lookups if lookups else 0.0
+        return counters
@@ -0,0 +1,218 @@
+import time
+import bisect
+import logging
+import threading
+from hashlib import md5
+from collections import deque
+from versioning import newest
+
+
+def key_hash(key) -> int:
+    """
+    Position of a key on the ring, the same hash the load balancer places keys with.
+    """
+    return int.from_bytes(md5(key.encode("utf-8")).digest(), "big")
+
+
+# Looks up which of a set of disjoint ring segments (start, end] a hash falls in.
+# At most one segment wraps around the top of the ring (start >= end).
+class SegmentIndex:
+    def __init__(self, segments):
+        self.wrapping = None
+        bounded = list()
+        for index, (start, end) in enumerate(segments):
+            if start >= end:
+                self.wrapping = (start, end, index)
+            else:
+                bounded.append((end, start, index))
+        bounded.sort()
+        self.ends = [end for end, _, _ in bounded]
+        self.bounded = bounded
+
+    def find(self, ringIndex):
+        if self.wrapping is not None:
+            start, end, index = self.wrapping
+            if ringIndex > start or ringIndex <= end:
+                return index
+        position = bisect.bisect_left(self.ends, ringIndex)
+        if position < len(self.bounded):
+            end, start, index = self.bounded[position]
+            if start < ringIndex <= end:
+                return index
+        return None
+
+
+# Streams the keys of ring segments this node hands over to their new owners.
+# A rebalance job scans the store once and sends the keys of every segment in chunks of
+# chunk_keys to each new owner with a batched put. Streaming is rate limited, and the rate
+# backs off (halves) whenever a chunk takes longer than latency_budget_ms, a sign the target
+# is busy serving foreground requests, and grows back while chunks are fast. Keys of a
+# segment this node no longer owns are dropped once every chunk of it was delivered, unless
+# a newer record arrived for them meanwhile. on_drop(key) runs for every dropped key, under
+# the lock of its shard. Hints this node holds for keys of a segment are streamed along,
+# where newer than the stored record, so the new owners get writes still waiting for a
+# replica that may have lost the segment.
+class Rebalancer:
+    def __init__(self, store, pool, chunk_keys=500, max_keys_per_sec=5000,
+                 min_keys_per_sec=100, latency_budget_ms=50, max_retries=3, on_drop=None,
+                 hinted=None):
+        self.store = store
+        self.pool = pool
+        self.on_drop = on_drop
+        self.hinted = hinted if hinted is not None else dict
+        self.chunk_keys = chunk_keys
+        self.max_keys_per_sec = max_keys_per_sec
+        self.min_keys_per_sec = min_keys_per_sec
+        self.latency_budget_ms = latency_budget_ms
+        self.max_retries = max_retries
+
+        self.lock = threading.Lock()
+        self.jobs = deque()
+        self.wakeup = threading.Event()
+        self.rate = max_keys_per_sec
+        self.progress = {"state": "idle", "epoch": None, "ranges_gained": 0, "ranges_lost": 0,
+                         "transfers": 0, "keys_scanned": 0, "keys_sent": 0, "chunks_sent": 0,
+                         "failed_chunks": 0, "keys_dropped": 0, "queued_jobs": 0,
+                         "started": None, "finished": None}
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, epoch, transfers, ranges_gained, ranges_lost) -> None:
+        """
+        Queues a rebalance job.
+
+        Args:
+            epoch (int): Ring epoch the transfers belong to
+            transfers (list): (start, end, targets, drop) per segment to stream, where targets
+                are the (host, port) of the new owners and drop tells whether this node stops
+                owning the segment
+            ranges_gained (int): Segments this node now owns, which other nodes stream to it
+            ranges_lost (int): Segments this node no longer owns
+        """
+        with self.lock:
+            self.jobs.append((epoch, transfers))
+            self.progress["ranges_gained"] += ranges_gained
+            self.progress["ranges_lost"] += ranges_lost
+            self.progress["queued_jobs"] = len(self.jobs)
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                if not self.jobs:
+                    self.wakeup.clear()
+                    continue
+                epoch, transfers = self.jobs.popleft()
+                self.progress.update(state="streaming", epoch=epoch, started=time.time(), finished=None,
+                                     queued_jobs=len(self.jobs))
+                self.progress["transfers"] += len(transfers)
+            try:
+                self._stream(transfers)
+                state = "done"
+            except Exception as e:
+                logging.error(f"Error in rebalance for epoch {epoch}: {e}")
+                state = "failed"
+            with self.lock:
+                self.progress.update(state=state, finished=time.time())
+
+    def _stream(self, transfers):
+        if not transfers:
+            return
+        index = SegmentIndex([(start, end) for start, end, _, _ in transfers])
+        buffers = dict()                # (host, port) -> [(key, record)] waiting to be sent
+        segment_keys = [list() for _ in transfers]
+        failed = set()                  # segments with a chunk that could not be delivered
+
+        def flush(target):
+            chunk = buffers.pop(target, [])
+            if chunk and not self._send(target, [(key, record) for key, record, _ in chunk]):
+                failed.update(segment for _, _, segment in chunk)
+
+        hinted = self.hinted()
+        for key in list(self.store.keys()) + [key for key in hinted if key not in self.store]:
+            with self.lock:
+                self.progress["keys_scanned"] += 1
+            segment = index.find(key_hash(key))
+            if segment is None:
+                continue
+            stored = self.store.get(key, None)
+            record = newest((stored, hinted.get(key)))
+            if record is None:
+                continue
+            _, _, targets, drop = transfers[segment]
+            if drop and stored is not None:
+                segment_keys[segment].append((key, stored))
+            for target in targets:
+                target = tuple(target)
+                buffers.setdefault(target, []).append((key, record, segment))
+                if len(buffers[target]) >= self.chunk_keys:
+                    flush(target)
+        for target in list(buffers):
+            flush(target)
+
+        for segment, (start, end, _, drop) in enumerate(transfers):
+            if not drop:
+                continue
+            if segment in failed:
+                logging.error(f"Keeping range ({start}, {end}], not all of it reached its new owners")
+                continue
+            self._drop(segment_keys[segment])
+
+    # Sends one chunk as a batched put, retrying with backoff, then waits as the rate limit requires.
+    # A chunk only counts as delivered if the target stored every record of it.
+    def _send(self, target, records) -> bool:
+        host, port = target
+        for attempt in range(self.max_retries):
+            started = time.time()
+            try:
+                response = self.pool.call(host, port, "multi_put", tuple(records))
+            except Exception as e:
+                logging.error(f"Failed to stream {len(records)} keys to {host}:{port}: {e}")
+                time.sleep(0.5 * (2 ** attempt))
+                continue
+            if not isinstance(response, tuple) or any(status < 0 for status in response):
+                logging.error(f"{host}:{port} did not store all {len(records)} streamed keys: {response}")
+                time.sleep(0.5 * (2 ** attempt))
+                continue
+            elapsed = time.time() - started
+            self._throttle(len(records), elapsed)
+            with self.lock:
+                self.progress["keys_sent"] += len(records)
+                self.progress["chunks_sent"] += 1
+            return True
+        with self.lock:
+            self.progress["failed_chunks"] += 1
+        return False
+
+    def _throttle(self, sent, elapsed):
+        if elapsed * 1000 > self.latency_budget_ms:
+            self.rate = max(self.min_keys_per_sec, self.rate / 2)
+        else:
+            self.rate = min(self.max_keys_per_sec, self.rate + self.max_keys_per_sec / 10)
+        delay = sent / self.rate - elapsed
+        if delay > 0:
+            time.sleep(delay)
+
+    # Deletes the streamed keys, but only where the stored record is still the one streamed. A
+    # newer one, from a coordinator still on the old ring or a hint delivery, never reached the
+    # new owners and is kept.
+    def _drop(self, streamed):
+        dropped = 0
+        for key, record in streamed:
+            with self.store.lock_for(key):
+                current = self.store.get(key, None)
+                if current is None or current[0] != record[0]:
+                    continue
+                self.store.delete(key)
+                if self.on_drop is not None:
+                    self.on_drop(key)
+            dropped += 1
+        with self.lock:
+            self.progress["keys_dropped"] += dropped
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.progress, keys_per_sec=self.rate)
@@ -0,0 +1,77 @@
+import queue
+import logging
+import threading
+
+
+# Long-lived pool of replication workers with one bounded queue per peer.
+# Each peer gets up to workers_per_peer threads, started the first time work is queued for
+# it, so a slow peer backs up its own queue without holding up replication to the others.
+# When a peer's queue is full, new work for it is rejected instead of piling up.
+class ReplicationExecutor:
+    def __init__(self, workers_per_peer=4, max_queue_depth=1000):
+        self.workers_per_peer = workers_per_peer
+        self.max_queue_depth = max_queue_depth
+
+        self.lock = threading.Lock()
+        self.queues = dict()            # (host, port) -> queue.Queue of (fn, args)
+        self.completed = dict()         # (host, port) -> tasks run
+        self.rejected = dict()          # (host, port) -> tasks refused because the queue was full
+        self.max_depth = dict()         # (host, port) -> deepest the queue has been
+
+    def _queue_for(self, peer):
+        with self.lock:
+            work_queue = self.queues.get(peer)
+            if work_queue is None:
+                work_queue = queue.Queue(maxsize=self.max_queue_depth)
+                self.queues[peer] = work_queue
+                self.completed[peer] = 0
+                self.rejected[peer] = 0
+                self.max_depth[peer] = 0
+                for i in range(self.workers_per_peer):
+                    thread = threading.Thread(target=self._worker, args=(peer, work_queue),
+                                              name=f"replicate-{peer[0]}:{peer[1]}-{i}")
+                    thread.daemon = True
+                    thread.start()
+            return work_queue
+
+    def submit(self, host, port, fn, *args) -> bool:
+        """
+        Queues fn(*args) on one of the given peer's workers.
+
+        Returns:
+            bool: False if the peer's queue is full and the task was dropped
+        """
+        peer = (host, int(port))
+        work_queue = self._queue_for(peer)
+        try:
+            work_queue.put_nowait((fn, args))
+        except queue.Full:
+            with self.lock:
+                self.rejected[peer] += 1
+            logging.error(f"Replication queue for {host}:{port} is full, dropping task")
+            return False
+        with self.lock:
+            self.max_depth[peer] = max(self.max_depth[peer], work_queue.qsize())
+        return True
+
+    def _worker(self, peer, work_queue):
+        while True:
+            fn, args = work_queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"Error in replication task for {peer[0]}:{peer[1]}: {e}")
+            with self.lock:
+                self.completed[peer] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                f"{host}:{port}": {
+                    "depth": work_queue.qsize(),
+                    "max_depth": self.max_depth[(host, port)],
+                    "completed": self.completed[(host, port)],
+                    "rejected": self.rejected[(host, port)],
+                }
+                for (host, port), work_queue in self.queues.items()
+            }
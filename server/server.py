@@ -3,104 +3,410 @@ import logging
 import yaml
 import os
 import time
+import socket
+import random
 import threading
 import concurrent.futures
+from collections import deque
 from rpyc.utils.server import ThreadedServer
+from storage import create_storage
+from connection_pool import ConnectionPool
+from failure_detector import FailureDetector, UP
+from quorum import QuorumCollector, value_digest
+from versioning import HybridLogicalClock, is_newer, newest
+from rebalancing import Rebalancer, SegmentIndex, key_hash
+from anti_entropy import AntiEntropy
+from hinted_handoff import HintedHandoff, NOT_OWNED
+from replication import ReplicationExecutor
+from async_server import AsyncNodeServer
+from compression import load_codec
+from hot_keys import HotKeyTracker
+from read_cache import ReadCache
+from peer_load import PeerLoad, request_kind
+from hedging import Hedger
 
 path = os.path.dirname(os.path.abspath(__file__))
+
+# Status a request gets when it was routed with an older ring than the one this node has
+STALE_EPOCH = -3
 logging.basicConfig(level=logging.DEBUG, filename=path+"/server.log", filemode='w')
 
 class KeyValueStoreService(rpyc.Service):
     def __init__(self):
         self.routing_table = None
+        self.ring_epoch = 0
         self.host = None
         self.port = None
-        self.store = dict()
-        self.hinted_replica = dict()  # {key: (value, host, port)} 
+        self.store = None
         self.active : bool = True
         self.N = 3
         self.W = 2
         self.R = 2
-        self.lock = threading.RLock()
-        self._start_hinted_handoff_manager()
+        self.clock = HybridLogicalClock()
+        self.binary_server = None               # asyncio front end, if enabled
+        self.slowdown = 0.0                     # seconds added to every read and write, for testing
+        self.owned_ranges = None                # SegmentIndex of the segments this node replicates
+        self.handed_over = deque(maxlen=16)     # (SegmentIndex, new owners per segment) of recent ring changes
+
+        with open(file=path + "/server_config.yml", mode='r', encoding="utf-8") as file:
+            self.config = yaml.safe_load(file)
+
+        pool_config = self.config["connection_pool"]
+        self.pool = ConnectionPool(
+            max_size=pool_config["max_size"],
+            idle_timeout=pool_config["idle_timeout"],
+            health_check_interval=pool_config["health_check_interval"],
+            connect_timeout=pool_config["connect_timeout"],
+            request_timeout=pool_config["request_timeout"],
+        )
+
+        detector_config = self.config["failure_detector"]
+        self.detector = FailureDetector(
+            self.pool,
+            interval=detector_config["interval"],
+            timeout=detector_config["timeout"],
+            suspect_after=detector_config["suspect_after"],
+            down_after=detector_config["down_after"],
+        )
+        self.detector.add_listener(self._on_peer_state_change)
+
+        quorum_config = self.config["quorum"]
+        self.read_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=quorum_config["read_workers"], thread_name_prefix="read")
+        self.read_timeout = quorum_config["read_timeout"]
+        self.read_mode = quorum_config["read_mode"]
+        self.read_repair_lock = threading.Lock()
+        self.read_repairs = {"divergent_reads": 0, "repairs": 0, "failed": 0}
+        self.write_timeout = quorum_config["write_timeout"]
+
+        hot_keys_config = self.config["hot_keys"]
+        self.hot_keys = HotKeyTracker(
+            width=hot_keys_config["width"],
+            depth=hot_keys_config["depth"],
+            decay_interval=hot_keys_config["decay_interval"],
+            hot_fraction=hot_keys_config["hot_fraction"],
+            min_count=hot_keys_config["min_count"],
+            top_k=hot_keys_config["top_k"],
+        )
+        self.spread_hot_reads = hot_keys_config["spread_reads"]
+
+        cache_config = self.config["read_cache"]
+        self.read_cache = ReadCache(
+            enabled=cache_config["enabled"],
+            max_entries=cache_config["max_entries"],
+            ttl=cache_config["ttl"],
+        )
 
-    def _persist_to_disk(self):
-        with open("kv_store_backup.txt", "w") as f:
-            f.write(str(self.store))
+        selection_config = self.config["peer_selection"]
+        self.peer_load = PeerLoad(alpha=selection_config["alpha"], half_life=selection_config["half_life"],
+                                  window=selection_config["window"])
+        self.latency_aware = selection_config["latency_aware"]
 
-    def _async_persist_to_disk(self):
-        thread = threading.Thread(target=self._persist_to_disk)
-        thread.daemon = True
-        thread.start()
+        hedging_config = self.config["hedging"]
+        self.hedger = Hedger(
+            self.peer_load,
+            enabled=hedging_config["enabled"],
+            percentile=hedging_config["percentile"],
+            min_delay=hedging_config["min_delay_ms"] / 1000,
+            max_delay=hedging_config["max_delay_ms"] / 1000,
+            budget_percent=hedging_config["budget_percent"],
+        )
 
+        replication_config = self.config["replication"]
+        self.replicator = ReplicationExecutor(
+            workers_per_peer=replication_config["workers_per_peer"],
+            max_queue_depth=replication_config["max_queue_depth"],
+        )
+
+        self._load_from_disk()
+        self.codec = load_codec(self.config["compression"], path)
+
+        hints_config = self.config["hinted_handoff"]
+        self.hints = HintedHandoff(
+            os.path.join(path, hints_config["dir"]),
+            self.pool,
+            batch_keys=hints_config["batch_keys"],
+            max_keys_per_sec=hints_config["max_keys_per_sec"],
+            fsync=hints_config["fsync"],
+            retry_interval=hints_config["retry_interval"],
+        )
+        self.hints.start(self.detector.is_up)
+
+        rebalance_config = self.config["rebalance"]
+        self.rebalancer = Rebalancer(
+            self.store,
+            self.pool,
+            chunk_keys=rebalance_config["chunk_keys"],
+            max_keys_per_sec=rebalance_config["max_keys_per_sec"],
+            min_keys_per_sec=rebalance_config["min_keys_per_sec"],
+            latency_budget_ms=rebalance_config["latency_budget_ms"],
+            on_drop=self._on_drop,
+            hinted=self.hints.records,
+        )
+
+        anti_entropy_config = self.config["anti_entropy"]
+        self.anti_entropy = AntiEntropy(
+            self.store,
+            self.pool,
+            self.detector,
+            self._apply_write,
+            depth=anti_entropy_config["depth"],
+            interval=anti_entropy_config["interval"],
+            batch_keys=anti_entropy_config["batch_keys"],
+        )
+
+    # Opens the configured storage backend, which recovers its own on-disk state
     def _load_from_disk(self):
-        try:
-            with open("kv_store_backup.txt", "r") as f:
-                self.store = eval(f.read())
-        except FileNotFoundError:
-            self.store = {}
+        self.store = create_storage(self.config, path)
 
-    def ping_actual_server(self, host, port, timeout=0.5):
-        try:
-            conn = rpyc.connect(host, port, config={"sync_request_timeout": timeout})
-            conn.close()
-            return True
-        except Exception as e:
-            return False
+    # Every stored value is a (version, value) record. Writes are last-writer-wins: a record
+    # only replaces the stored one if its version is newer, so replayed, repaired or handed off
+    # writes never overwrite a newer value. Returns whether the key already had a record.
+    # Only the lock of the key's shard is held, so writes to other shards go on meanwhile.
+    # The read cache is invalidated after the store changed, so no read that starts later
+    # can cache the old value.
+    def _apply_write(self, key, record):
+        self.clock.observe(record[0])
+        with self.store.lock_for(key):
+            current = self.store.get(key, None)
+            if is_newer(record, current):
+                self.store[key] = record
+                self.anti_entropy.update(key, record)
+                self.read_cache.invalidate(key)
+        return current is not None
+
+    # Runs under the lock of the key's shard once the rebalancer dropped a key handed over
+    def _on_drop(self, key):
+        self.anti_entropy.update(key, None)
+        self.read_cache.invalidate(key)
+
+    # Same as _apply_write for a hinted copy held on behalf of target_host:target_port
+    def _apply_hint(self, key, record, target_host, target_port):
+        self.clock.observe(record[0])
+        return self.hints.add(key, record, target_host, target_port)
 
     '''
     /////////////////// Hinted Handoff /////////////////
     '''
-    
-    # Start the hinted handoff manager in the background
-    def _start_hinted_handoff_manager(self):
-        thread = threading.Thread(target=self._hinted_handoff_manager)
-        thread.daemon = True
-        thread.start()
-        logging.info("Hinted Handoff Manager started in the background")
-
-    # Check if the server is back online and process the hinted handoff
-    def _hinted_handoff_manager(self):
-        while True:
-            try:
-                with self.lock:
-                    pending_servers = set((host, port) for _, host, port in self.hinted_replica.values())
-
-                for host, port in pending_servers:
-                    logging.debug(f"Checking if {host}:{port} is back online")
-                    if self.ping_actual_server(host, port):
-                        logging.info(f"Server {host}:{port} is back online. Going to process hinted handoff...")
-                        self._process_hinted_handoff(host, port)
-            except Exception as e:
-                logging.error(f"Error in hinted handoff manager: {e}")
-
-            # sleep for 10 seconds before checking again
-            time.sleep(10)
-
-    # Process the hinted handoff for the given server
-    def _process_hinted_handoff(self, host, port):
-        keys_to_remove = []
-        with self.lock:
-            for key, (value, target_host, target_port) in self.hinted_replica.items():
-                if host == target_host and port == target_port:
-                    try:
-                        logging.debug(f"Trying to send data to recovered server. Hinted handoff in process for key {key}")
-                        conn = rpyc.connect(target_host, target_port)
-                        response = conn.root.put(key, value)
-
-                        if response != -1:
-                            logging.debug(f"Hinted handoff for key {key} processed successfully to {target_host}:{target_port}")
-                            keys_to_remove.append(key)
-                        else:
-                            logging.error(f"Failed to send hinted handoff for key {key} to {target_host}:{target_port}")
-                    except Exception as e:
-                        logging.error(f"Error sending hinted handoff for key {key} to {target_host}:{target_port}: {e}")
-                        logging.debug("------"*4)
-            # There can be multiple keys designated for the same server so continue
-
-            for key in keys_to_remove:
-                self.hinted_replica.pop(key, None)
-        logging.debug("------"*4)
+
+    # Hands hinted writes back as soon as the failure detector sees their target come back up
+    def _on_peer_state_change(self, host, port, old_state, new_state):
+        if new_state != UP:
+            return
+        if (host, int(port)) in self.hints.targets():
+            logging.info(f"Server {host}:{port} is back online. Going to process hinted handoff...")
+            self.hints.deliver_async(host, port)
+
+    '''
+    //////////////////////////////////////////////////////
+    '''
+
+    '''
+    /////////////////// Quorum Reads /////////////////
+    '''
+
+    # Other replicas to read from: the key's primaries, and for every primary the failure
+    # detector considers down, the next handoff node which may hold its hinted copy
+    def _read_replicas(self, intended_server_order):
+        replicas = []
+        handoff_nodes = iter(intended_server_order[self.N:])
+        for host, port in intended_server_order[:self.N]:
+            if (host, port) == (self.host, self.port):
+                continue
+            if self.detector.is_available(host, port):
+                replicas.append((host, port, True))
+            else:
+                handoff = next(handoff_nodes, None)
+                if handoff is not None:
+                    replicas.append((handoff[0], handoff[1], False))
+        return replicas
+
+    # A spread read asks only as many of the other replicas as the quorum needs, so reads of a
+    # hot key spread over the replicas instead of reaching every one of them, and with hedging
+    # the rest are left to hedge a slow one to. They are picked by power of two choices on
+    # their load when latency aware, otherwise at random.
+    # Returns the replicas to ask and the spare ones to ask if those fall short.
+    def _spread_replicas(self, replicas):
+        if len(replicas) <= self.R - 1:
+            return replicas, []
+        if self.latency_aware:
+            ordered = self.peer_load.choose(replicas)
+        else:
+            ordered = random.sample(replicas, len(replicas))
+        return ordered[:self.R - 1], ordered[self.R - 1:]
+
+    # Sends method(keys, is_primary) to all replicas at once and returns once `needed` responses
+    # are in, counting the responses already known to the coordinator. Stragglers keep adding
+    # theirs in the background. Spare replicas are only asked if the others fall short: a
+    # replica slower than its hedge delay is hedged to the next spare one, and whatever spares
+    # are left are all asked once the wait times out.
+    def _quorum_read(self, keys, replicas, method, initial_responses, needed, spare=()):
+        collector = QuorumCollector(expected=len(replicas) + len(initial_responses))
+        for replica, response in initial_responses:
+            collector.add(replica, response)
+        for nextHost, nextPort, is_primary in replicas:
+            self.read_executor.submit(self._fetch_from_replica, collector, method, nextHost, nextPort, keys, is_primary)
+        self.hedger.sent(len(replicas) * len(keys))
+
+        spare = list(spare)
+        def hedge(replica):
+            if not spare:
+                return False
+            nextHost, nextPort, is_primary = spare.pop(0)
+            logging.debug(f"Hedging {method} to {replica[0]}:{replica[1]} with {nextHost}:{nextPort}")
+            collector.expect(1)
+            self.read_executor.submit(self._fetch_from_replica, collector, method, nextHost, nextPort, keys, is_primary)
+            return True
+
+        enough = lambda responses: len(responses) >= needed
+        hedged = replicas if spare else []
+        if not self.hedger.wait(collector, enough, hedged, hedge, self.read_timeout,
+                                kind=request_kind(len(keys)), cost=len(keys)) and spare:
+            collector.expect(len(spare))
+            for nextHost, nextPort, is_primary in spare:
+                self.read_executor.submit(self._fetch_from_replica, collector, method, nextHost, nextPort, keys, is_primary)
+            collector.wait_for(enough, timeout=self.read_timeout)
+        return collector
+
+    def _fetch_from_replica(self, collector, method, host, port, keys, is_primary):
+        try:
+            with self.peer_load.track(host, port, request_kind(len(keys))):
+                value = self.pool.call(host, port, method, keys, is_primary)
+            logging.debug(f"Server {host}:{port} returned {method} response: {value}")
+            collector.add((host, port), value)
+        except Exception as e:
+            logging.error(f"Error fetching {keys} from {host}:{port}: {e}")
+            self.detector.report_failure(host, port)
+            collector.add_failure((host, port))
+
+    # Turns the newest record among the responses into the (value, status_code) answer of get
+    def _read_result(self, record, response_count):
+        if response_count < self.R:
+            logging.error("Failed to fetch the data. Read quorum not reached.")
+            return (None, -1)
+        if record is None:
+            return (None, 1)
+        logging.debug(f"Get request completed with record: {record}")
+        # Values stay compressed everywhere else; only the reply to the client is decompressed
+        try:
+            return (self.codec.decompress(record[1]), 0)
+        except Exception as e:
+            logging.error(f"Failed to decompress the value: {e}")
+            return (None, -1)
+
+    # Reads a batch of keys that share one preference list. Every replica gets a single
+    # message for the whole batch, and each key resolves to its newest record among the
+    # responses of the replicas that answered in time. hot tells whether all keys are hot.
+    def _read_batch(self, keys, intended_server_order, hot):
+        self._slow_down()
+        replicas = self._read_replicas(list(intended_server_order))
+        # Asking every replica leaves nothing to hedge to: a read waits on R - 1 of the N - 1
+        # others, so with hedging it asks just those and hedges a slow one to the rest. Only when
+        # latency aware, since picked at random a slow replica gets asked often enough to use up
+        # the hedge budget, and reads over budget then wait for it. A replica left out of a read
+        # misses its read repair; anti-entropy still brings it up to date.
+        asked, spare = replicas, []
+        if (hot and self.spread_hot_reads) or (self.hedger.enabled and self.latency_aware):
+            asked, spare = self._spread_replicas(replicas)
+        records = tuple(self.store.get(key, None) for key in keys)
+        logging.debug(f"Coordinator {self.host}:{self.port} found records: {records}")
+        coordinator = (self.host, self.port)
+
+        if self.read_mode == "digest":
+            # The coordinator's copy is the one full record; other replicas only send its hash
+            local_digests = tuple(value_digest(record) for record in records)
+            collector = self._quorum_read(keys, asked, "multi_fetch_digest", [(coordinator, local_digests)], self.R, spare)
+            responses = collector.snapshot()
+            full_records = {replica: records for replica, _ in responses}
+
+            mismatched = set(replica for replica, digests in responses if digests != local_digests)
+            if mismatched:
+                # Digests disagree: fetch full records, but only from the replicas and for the
+                # keys that did not match
+                logging.debug(f"Digest mismatch for keys {keys}, falling back to full reads")
+                indices = sorted(set(i for replica, digests in responses if replica in mismatched
+                                     for i, digest in enumerate(digests) if digest != local_digests[i]))
+                targets = [replica for replica in replicas if (replica[0], replica[1]) in mismatched]
+                subset = tuple(keys[i] for i in indices)
+                fetched = dict(self._quorum_read(subset, targets, "multi_fetch", [], len(targets)).snapshot())
+                for replica in mismatched:
+                    if replica not in fetched:
+                        del full_records[replica]
+                        continue
+                    merged = list(records)
+                    for i, record in zip(indices, fetched[replica]):
+                        merged[i] = record
+                    full_records[replica] = merged
+            results = [newest(replica_records[i] for replica_records in full_records.values())
+                       for i in range(len(keys))]
+            expected = [value_digest(result) for result in results]
+        else:
+            collector = self._quorum_read(keys, asked, "multi_fetch", [(coordinator, records)], self.R, spare)
+            full_records = dict(collector.snapshot())
+            results = expected = [newest(replica_records[i] for replica_records in full_records.values())
+                                  for i in range(len(keys))]
+
+        collector.add_done_callback(
+            lambda completed: self._schedule_read_repair(keys, results, expected, completed, replicas))
+        return tuple(self._read_result(result, len(full_records)) for result in results)
+
+    # Runs once every replica of a read has answered, including those that arrived after the
+    # client got its reply. Repairs are handed to a worker so they never run on the thread
+    # that answers the client.
+    def _schedule_read_repair(self, keys, results, expected, collector, replicas):
+        responses = collector.snapshot()
+        for i, key in enumerate(keys):
+            key_responses = [(replica, response[i]) for replica, response in responses]
+            if any(response != expected[i] for _, response in key_responses):
+                self.read_executor.submit(self._read_repair, key, results[i], expected[i], key_responses, replicas)
+
+    # Brings every replica of the read up to the newest record any of them holds. Replicas that
+    # answered with a digest are asked for their full record first, since a late one may be
+    # newer than what the client got. Handoff nodes are left alone, their hints reach the
+    # primary through hinted handoff.
+    def _read_repair(self, key, record, expected, responses, replicas):
+        logging.debug(f"Replicas diverge for key {key}: {responses}")
+        with self.read_repair_lock:
+            self.read_repairs["divergent_reads"] += 1
+        coordinator = (self.host, self.port)
+        primaries = set((host, port) for host, port, is_primary in replicas if is_primary)
+        primaries.add(coordinator)
+
+        records = dict()
+        for replica, response in responses:
+            if replica not in primaries:
+                continue
+            if response == expected:
+                records[replica] = record
+            elif replica == coordinator:
+                records[replica] = self.store.get(key, None)
+            else:
+                try:
+                    records[replica] = self.pool.call(replica[0], replica[1], "fetch", key, True)
+                except Exception as e:
+                    logging.error(f"Failed to fetch {key} from {replica[0]}:{replica[1]} for read repair: {e}")
+
+        latest = newest(records.values())
+        for (host, port), current in records.items():
+            if not is_newer(latest, current):
+                continue
+            if (host, port) == coordinator:
+                self._apply_write(key, latest)
+                self._count_repair(True)
+            elif not self.replicator.submit(host, port, self._repair_replica, host, port, key, latest):
+                self._count_repair(False)
+
+    def _repair_replica(self, host, port, key, record):
+        try:
+            repaired = self.pool.call(host, port, "put", key, record) >= 0
+        except Exception as e:
+            logging.error(f"Failed to repair {key} on {host}:{port}: {e}")
+            repaired = False
+        self._count_repair(repaired)
+
+    def _count_repair(self, repaired):
+        with self.read_repair_lock:
+            self.read_repairs["repairs" if repaired else "failed"] += 1
 
     '''
     //////////////////////////////////////////////////////
@@ -113,14 +419,14 @@ class KeyValueStoreService(rpyc.Service):
 
     def exposed_fetch(self, key, is_primary):
         """
-        Fetch the key's value from either the primary store or the hinted replica.
+        Fetch the key's versioned record from either the primary store or the hinted replica.
         
         Args:
             key (str): The key to look up
-            is_primary (bool): If True, check self.store, otherwise check self.hinted_replica
+            is_primary (bool): If True, check self.store, otherwise the hinted handoff queues
         
         Returns:
-            The value associated with the key, or None if not found
+            tuple: The (version, value) record of the key, or None if not found
         """
         logging.debug(f"Fetch request received for key: {key}, is_primary: {is_primary}")
         
@@ -128,89 +434,109 @@ class KeyValueStoreService(rpyc.Service):
             value = self.store.get(key, None)
             logging.debug(f"Value found in primary store: {value}")
         else:
-            value = self.hinted_replica.get(key, None)[0]
+            value = self.hints.get(key)
             logging.debug(f"Value found in hinted replica: {value}")
         
         logging.debug("------"*4)
         return value
 
-    def exposed_get(self, key, intended_server_order):
+    def exposed_fetch_digest(self, key, is_primary):
+        """
+        Like fetch, but returns a compact hash of the record instead of the record itself.
+
+        Returns:
+            bytes: Digest of the record, or None if not found
+        """
+        return value_digest(self.exposed_fetch(key, is_primary))
+
+    def exposed_multi_fetch(self, keys, is_primary):
+        """
+        Batched fetch, used by the coordinator to read a whole batch in one message.
+
+        Returns:
+            tuple: The record of each key in the order of keys
+        """
+        self._slow_down()
+        return tuple(self.exposed_fetch(key, is_primary) for key in keys)
+
+    def exposed_multi_fetch_digest(self, keys, is_primary):
+        """
+        Batched fetch_digest.
+
+        Returns:
+            tuple: The digest of each key's record in the order of keys
+        """
+        self._slow_down()
+        return tuple(self.exposed_fetch_digest(key, is_primary) for key in keys)
+
+    def exposed_get(self, key, intended_server_order, epoch=None):
         """
         Fetch the key's value from the distributed store.
 
         Args:
             key (str): The key to fetch
             intended_server_order (list): The order of servers to fetch the key from
+            epoch (int, optional): Ring epoch a client routed the request with
 
         Returns:
-            tuple: (value, status_code)
+            tuple: (value, status_code), status_code -2 if this server is not active and
+                -3 if the request was routed with a stale ring
         """
 
+        if not self.active:
+            logging.debug(f"Server is not active. Get operation rejected.")
+            return (None, -2)
+        if self._is_stale(epoch):
+            return (None, STALE_EPOCH)
+
         logging.debug(f"Get request received for key: {key}")
         logging.debug("------"*4)
 
-        # Find the starting index of (self.host, self.port) in intended_server_order
-        intended_server_order = list(intended_server_order)
-        logging.debug(f"type of intended_server_order {type(intended_server_order)}")
         logging.debug(f"intended_server_order: {intended_server_order}")
-        index = intended_server_order.index((self.host, self.port))
-        
-        outputs = []
-        value = self.store.get(key, None)
-        logging.debug(f"Coordinator {self.host}:{self.port} found value: {value}")
-        outputs.append(value)
-        index += 1
+        # A hot key's read is answered from the read cache while it holds the key
+        hot = self.hot_keys.record(key)
+        if hot:
+            cached = self.read_cache.get(key)
+            if cached is not None:
+                logging.debug("Get request served from the read cache.")
+                return cached
+        token = self.read_cache.begin_read(key) if hot else None
+        response = self._read_batch((key,), intended_server_order, hot)[0]
+        self.read_cache.finish_read(key, token, response)
+        return response
 
-        while index < len(intended_server_order) and len(outputs) < self.N:
-            try:
-                nextHost, nextPort = intended_server_order[index]
-                logging.debug(f"nextHost, nextPort: {nextHost}, {nextPort}")
-                conn = rpyc.connect(nextHost, nextPort)
-                if conn.root.ping():
-                    value = conn.root.fetch(key, index<self.N)
-                    outputs.append(value)
-                    logging.debug(f"Server {nextHost}:{nextPort} returned value: {value}")
-                else:
-                    logging.debug(f"Node {nextHost}:{nextPort} is not active")
-                conn.close()
-            except Exception as e:
-                logging.error(f"Error in Get: {e}")
-            index += 1
-            
-        # Determine the majority value
-        value_counts = {}
-        for value in outputs:
-            if value in value_counts:
-                value_counts[value] += 1
-            else:
-                value_counts[value] = 1
+    def exposed_multi_get(self, keys, intended_server_order, epoch=None):
+        """
+        Fetch the values of several keys that share the given preference list.
 
-        logging.debug(f"Value counts: {value_counts}")
+        Args:
+            keys (tuple): The keys to fetch
+            intended_server_order (list): The order of servers to fetch the keys from
+            epoch (int, optional): Ring epoch a client routed the request with
 
-        most_common_value = None
-        max_count = 0
-        for value, count in value_counts.items():
-            if count > max_count:
-                most_common_value = value
-                max_count = count
+        Returns:
+            tuple: (value, status_code) per key in the order of keys, or -2 if this server is
+                not active and -3 if the request was routed with a stale ring
+        """
+        if not self.active:
+            logging.debug(f"Server is not active. Multi get operation rejected.")
+            return -2
+        if self._is_stale(epoch):
+            return STALE_EPOCH
+
+        logging.debug(f"Multi get request received for {len(keys)} keys")
+        logging.debug("------"*4)
+        hot = all([self.hot_keys.record(key) for key in keys])
+        return self._read_batch(tuple(keys), intended_server_order, hot)
 
-        if most_common_value is None:
-            return (None, 1)
-        if max_count >= self.R:
-            logging.debug(f"Get request completed with value: {most_common_value}")
-            return (most_common_value, 0)
-        else:
-            logging.error("Failed to fetch the data. No majority value found.")
-            return (None, -1)
-    
-    
     def exposed_put(self, key, value, target_host=None, target_port=None):
         """
-        Store a key-value pair in the appropriate store.
+        Store a versioned key-value pair in the appropriate store, unless it already holds
+        a newer version of the key.
         
         Args:
             key (str): The key to store
-            value: The value to store
+            value (tuple): The (version, value) record to store
             target_host (str, optional): Target host for hinted handoff
             target_port (int, optional): Target port for hinted handoff
             
@@ -227,14 +553,11 @@ class KeyValueStoreService(rpyc.Service):
             
             # If target_host and target_port are provided, this is a hinted handoff
             if target_host and target_port:
-                exists = key in self.hinted_replica
-                self.hinted_replica[key] = (value, target_host, target_port)
+                exists = self._apply_hint(key, tuple(value), target_host, target_port)
                 logging.debug(f"Stored hinted handoff for key {key} intended for {target_host}:{target_port}")
             else:
                 # Regular put operation
-                exists = key in self.store
-                self.store[key] = value
-                self._async_persist_to_disk()
+                exists = self._apply_write(key, tuple(value))
                 logging.debug(f"Stored key {key} with value {value}")
             
             logging.debug("------"*4)
@@ -333,14 +656,13 @@ class KeyValueStoreService(rpyc.Service):
         # 7. If success_count>0, then update the key's value in self.store and persist storage
         if success_count > 0:
             self.store[key] = value
-            self._async_persist_to_disk()
             return exists
         else:
             return -1
     """
         
     # """
-    def exposed_coordinator_put(self, key, value, replica_servers):
+    def exposed_coordinator_put(self, key, value, replica_servers, epoch=None):
         """
         Store a key-value pair in the appropriate store.
 
@@ -348,66 +670,104 @@ class KeyValueStoreService(rpyc.Service):
             key (str): The key to store
             value: The value to store
             replica_servers (list): List of replica servers
+            epoch (int, optional): Ring epoch a client routed the request with
 
         Returns:
-            int: 0 if key already existed, 1 if key is new, -1 on failure
+            int: 0 if key already existed, 1 if key is new, -1 on failure, -2 if this server is not active,
+                -3 if the request was routed with a stale ring
+        """
+        result = self.exposed_coordinator_multi_put(((key, value),), replica_servers, epoch)
+        return result if isinstance(result, int) else result[0]
+
+    def exposed_coordinator_multi_put(self, items, replica_servers, epoch=None):
+        """
+        Store several key-value pairs that share the given preference list. Each replica
+        receives the whole batch in one message.
+
+        Args:
+            items (tuple): (key, value) pairs to store
+            replica_servers (list): List of replica servers
+            epoch (int, optional): Ring epoch a client routed the request with
+
+        Returns:
+            tuple: Status code per item as for coordinator_put, or -2 if this server is not active
+                and -3 if the request was routed with a stale ring
         """
         
-        logging.debug(f"Choosen as coordinator for key: {key}. Now, performing replication.")
-        
-        success_count = 1
-        quorum_event = threading.Event()  # Event to signal when quorum is reached
-        exists = 0 if key in self.store else 1
+        if not self.active:
+            logging.debug(f"Server is not active. Coordinator put operation rejected.")
+            return -2
+        if self._is_stale(epoch):
+            return STALE_EPOCH
 
-        logging.debug("Quorum event initialized")
+        self._slow_down()
+        keys = [key for key, _ in items]
+        logging.debug(f"Choosen as coordinator for keys: {keys}. Now, performing replication.")
         
-        def replicate_to_server(host, port, target_info=None):
-            nonlocal success_count
-            nonlocal exists
+        exists = [0 if key in self.store else 1 for key in keys]
+        # Values are compressed once here and replicated, hinted and stored in that form
+        records = tuple((key, (self.clock.now(), self.codec.compress(value))) for key, value in items)
+        kind = request_kind(len(records))
+
+        hedges = dict()         # replica -> (handoff node, target of its hint) its write was hedged to
+        acked = dict()          # node -> statuses of the write it acked
+        hedge_lock = threading.Lock()
+        def release_hedges(node):
+            # The hint a hedge left on a handoff node is not needed once the replica acked its own
+            # write. Both must have acked, so the hint is not dropped before it is even stored.
+            with hedge_lock:
+                released = [(replica, hedge) for replica, hedge in hedges.items()
+                            if node in (replica, hedge[0]) and replica in acked and hedge[0] in acked]
+                for replica, _ in released:
+                    del hedges[replica]
+            for replica, (handoff, target) in released:
+                entries = tuple((key, record[0]) for (key, record), status in zip(records, acked[replica])
+                                if status >= 0)
+                if entries:
+                    self.replicator.submit(handoff[0], handoff[1], self._discard_hints, handoff, target, entries)
+
+        def replicate_to_server(host, port, target_info, collector):
             try:
-                logging.debug(f"Pinging to {host}:{port}")
-                conn = rpyc.connect(host, port)
+                logging.debug(f"Replicating to {host}:{port}")
                 
-                # If target_info is provided, this is a hinted handoff
-                if target_info:
-                    target_host, target_port = target_info
-                    result = conn.root.put(key, value, target_host, target_port)
-                # Regular put operation
-                else:
-                    result = conn.root.put(key, value)
+                with self.peer_load.track(host, port, kind):
+                    # If target_info is provided, this is a hinted handoff
+                    if target_info:
+                        target_host, target_port = target_info
+                        result = self.pool.call(host, port, "multi_put", records, target_host, target_port)
+                    # Regular put operation
+                    else:
+                        result = self.pool.call(host, port, "multi_put", records)
                 
-                if result != -1:
-                    with self.lock:
-                        exists *= result
-                        success_count += 1
-                        if success_count >= self.W:
-                            logging.debug(f"Write quorum reached for key: {key}")
-                            quorum_event.set()  # Signal that quorum is reached
-                if quorum_event.is_set():
-                    return True
-                return True
+                # -2 is an inactive server, which does not count towards the quorum
+                if result != -2:
+                    collector.add((host, port), result)
+                    with hedge_lock:
+                        acked[(host, port)] = result
+                    release_hedges((host, port))
+                else:
+                    collector.add_failure((host, port))
             
             except Exception as e:
                 logging.error(f"Failed to replicate to {host}:{port}: {e}")
-                return False
+                self.detector.report_failure(host, port)
+                collector.add_failure((host, port))
     
         up_servers, down_servers = list(), list()
         replica_servers = list(replica_servers)
         index = replica_servers.index((self.host, self.port))
 
+        # The coordinator need not be the first replica, the load balancer may pick any live
+        # one, so the replicas before it count as up or down just like the ones after it
         logging.debug("Filling up_servers and down_servers")
-        for servers in range(index):
-            down_servers.append(replica_servers[servers])
-
-        for i in range(index + 1, len(replica_servers)):
+        for i in range(len(replica_servers)):
             logging.debug(f"Checking server {i}")
             try:
                 if i == index:
                     logging.debug(f"Skipping current server {self.host}:{self.port}")
                     continue    # Skip the current server
                 host, port = replica_servers[i]
-                logging.debug(f"Pinging {host}:{port}")
-                if self.ping_actual_server(host, port):
+                if self.detector.is_available(host, port):
                     logging.debug(f"Server {host}:{port} is up")
                     up_servers.append((i, host, port))
                 else:
@@ -419,18 +779,18 @@ class KeyValueStoreService(rpyc.Service):
         logging.debug(f"up servers: {up_servers}")
 
         if len(up_servers) < self.W:
-            logging.error(f"Failed to reach write quorum for key: {key}")
-            return -1
+            logging.error(f"Failed to reach write quorum for keys: {keys}")
+            return tuple(-1 for _ in keys)
         
         # Checking if the current server is one of the intended servers
         logging.debug(f"Storing in either store or hinted_replicas")
-        if index <= self.N:
-            self.store[key] = value
-            self._async_persist_to_disk()
-        else:
-            host, port = replica_servers[0]
-            self.hinted_replica[key] = (value, host, port)
-            logging.debug(f"Stored hinted handoff for key {key} intended for {host}:{port}")
+        for key, record in records:
+            if index <= self.N:
+                self._apply_write(key, record)
+            else:
+                host, port = replica_servers[0]
+                self._apply_hint(key, record, host, port)
+                logging.debug(f"Stored hinted handoff for key {key} intended for {host}:{port}")
 
 
         active_count = 0
@@ -446,51 +806,329 @@ class KeyValueStoreService(rpyc.Service):
                 logging.debug(f"active_count, N: {active_count}, {self.N}")
                 logging.debug(f"len(down_servers): {len(down_servers)}")
                 front_server = down_servers.pop(0)
-                print(f"front_server: {front_server}")
+                logging.debug(f"front_server: {front_server}")
                 front_server = front_server[1:]
                 replication_tasks[(host, port)] = front_server
                 active_count += 1
         
         
         logging.debug("Sending replicas asynchronously")
-        # with concurrent.futures.ThreadPoolExecutor(max_workers=len(replication_tasks)) as executor:
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(replication_tasks))
-        futures = [
-            executor.submit(replicate_to_server, host, port, target_info) 
-            for (host, port), target_info in replication_tasks.items()
-        ]
-        
-        for future in concurrent.futures.as_completed(futures):
-            if success_count >= self.W:
-                break
+        collector = QuorumCollector(expected=len(replication_tasks))
+        for (host, port), target_info in replication_tasks.items():
+            if not self.replicator.submit(host, port, replicate_to_server, host, port, target_info, collector):
+                collector.add_failure((host, port))
+        self.hedger.sent(len(replication_tasks) * len(records))
 
-        executor.shutdown(wait=False, cancel_futures=True)
+        # A replica slower than its hedge delay is hedged to the next handoff node of the
+        # preference list, which holds the write as a hint for it, like for a down replica. The
+        # direct write to the slow replica still goes out, since reads keep asking it and not the
+        # handoff node while it is up; once it acks, the hint is dropped again
+        handoff_servers = [(host, port) for i, host, port in up_servers if (host, port) not in replication_tasks]
+        def hedge(replica):
+            if not handoff_servers:
+                return False
+            host, port = handoff_servers.pop(0)
+            target_info = replication_tasks[replica] or replica
+            with hedge_lock:
+                hedges[replica] = ((host, port), tuple(target_info))
+            logging.debug(f"Hedging replication to {replica[0]}:{replica[1]} with {host}:{port}")
+            collector.expect(1)
+            if not self.replicator.submit(host, port, replicate_to_server, host, port, target_info, collector):
+                collector.add_failure((host, port))
+            return True
 
-        if success_count >= self.W:
-            return exists
-        return -1
+        # The coordinator's own write is the first ack; return the moment W acks are in
+        reached = self.hedger.wait(collector, lambda acks: 1 + len(acks) >= self.W, list(replication_tasks),
+                                   hedge, self.write_timeout, kind=kind, cost=len(records))
+        if not reached:
+            logging.error(f"Failed to reach write quorum for keys: {keys}")
+            return tuple(-1 for _ in keys)
+
+        logging.debug(f"Write quorum reached for keys: {keys}")
+        acks = [result for _, result in collector.snapshot()]
+        statuses = list()
+        for i in range(len(keys)):
+            # A replica's put can still fail for a single key, -1, which is not an ack for it
+            key_acks = [result[i] for result in acks if result[i] >= 0]
+            if 1 + len(key_acks) < self.W:
+                statuses.append(-1)
+                continue
+            for result in key_acks:
+                exists[i] *= result
+            statuses.append(exists[i])
+        return tuple(statuses)
+
+
+    def _discard_hints(self, handoff, target, entries):
+        try:
+            self.pool.call(handoff[0], handoff[1], "discard_hints", entries, target[0], target[1])
+        except Exception as e:
+            logging.error(f"Failed to discard {len(entries)} hedged hints on {handoff[0]}:{handoff[1]}: {e}")
+
+    def exposed_discard_hints(self, entries, target_host, target_port):
+        """
+        Drop hints held for the target that it does not need, such as those of a hedged write
+        the target acked itself.
+
+        Args:
+            entries (tuple): (key, version) of the hints to drop
+            target_host (str): Host the hints are held for
+            target_port (int): Port the hints are held for
+
+        Returns:
+            int: Number of hints dropped
+        """
+        return self.hints.discard(entries, target_host, target_port)
+
+    def exposed_multi_put(self, records, target_host=None, target_port=None, delivered_hints=False):
+        """
+        Batched put, used by the coordinator to replicate a whole batch in one message.
+
+        Args:
+            records (tuple): (key, (version, value)) pairs to store
+            target_host (str, optional): Target host for hinted handoff
+            target_port (int, optional): Target port for hinted handoff
+            delivered_hints (bool, optional): Whether the records are hints held for this server,
+                which it only stores for keys it replicates
+
+        Returns:
+            tuple: Status code per record as for put, -4 for a delivered hint of a key this
+                server does not replicate, or -2 if this server is not active
+        """
+        if not self.active:
+            logging.debug(f"Server is not active. Multi put operation rejected.")
+            return -2
+        self._slow_down()
+        if delivered_hints:
+            return self._accept_hints(records)
+        return tuple(self.exposed_put(key, record, target_host, target_port) for key, record in records)
 
+    # Hints may have waited through ring changes. A hint for a key this server no longer
+    # replicates is forwarded to the new owners if this server handed the key's segment over
+    # to them recently, and rejected otherwise, so it never puts a dropped key back.
+    def _accept_hints(self, records):
+        statuses = [None] * len(records)
+        forward = dict()        # new owners -> positions of the records to forward to them
+        for i, (key, record) in enumerate(records):
+            ring_index = key_hash(key)
+            if self.owned_ranges is None or self.owned_ranges.find(ring_index) is not None:
+                statuses[i] = self.exposed_put(key, record)
+                continue
+            owners = self._new_owners(ring_index)
+            if owners is None:
+                statuses[i] = NOT_OWNED
+            else:
+                forward.setdefault(owners, []).append(i)
+
+        for owners, positions in forward.items():
+            batch = tuple(records[i] for i in positions)
+            results = list()
+            for host, port in owners:
+                try:
+                    result = self.pool.call(host, port, "multi_put", batch, None, None, True)
+                except Exception as e:
+                    logging.error(f"Failed to forward {len(batch)} hints to {host}:{port}: {e}")
+                    continue
+                if isinstance(result, tuple):
+                    results.append(result)
+            for j, i in enumerate(positions):
+                key_results = [result[j] for result in results]
+                stored = [status for status in key_results if status in (0, 1)]
+                if stored:
+                    statuses[i] = min(stored)
+                elif len(key_results) == len(owners) and all(status == NOT_OWNED for status in key_results):
+                    statuses[i] = NOT_OWNED
+                else:
+                    statuses[i] = -1
+        return tuple(statuses)
+
+    # The owners a recent ring change handed the segment of the ring position over to, None
+    # if this server handed over no segment holding it
+    def _new_owners(self, ring_index):
+        for index, owners in list(self.handed_over):
+            position = index.find(ring_index)
+            if position is not None:
+                return owners[position]
+        return None
 
     def exposed_delete(self, key):
-        if key in self.store:
-            del self.store[key]
-            self._async_persist_to_disk()
-            return f"Deleted {key}"
+        with self.store.lock_for(key):
+            if self.store.delete(key) is not None:
+                self.anti_entropy.update(key, None)
+                return f"Deleted {key}"
         return "Key not found"
 
     def exposed_list_keys(self):
         return list(self.store.keys())
     
+    # Requests a client routed on its own carry the epoch of the ring it used; the load
+    # balancer always routes with the current ring and sends none
+    def _is_stale(self, epoch):
+        if epoch is not None and epoch < self.ring_epoch:
+            logging.debug(f"Rejecting request routed with ring epoch {epoch}, current is {self.ring_epoch}")
+            return True
+        return False
+
     # Receive routing table and server details from the request-router
-    def exposed_set_routing_table(self, table):
-        self.routing_table = table
+    def exposed_set_routing_table(self, table, epoch=0):
+        self.routing_table = [list(entry) for entry in table]
+        self.ring_epoch = epoch
         self.host = table[0][0][0]
         self.port = table[0][0][1]
+        self.clock.node_id = f"{self.host}:{self.port}"
         logging.info(f"Received routing table: {self.routing_table}")
 
+        self._set_peers()
+        self.detector.start()
+
+    # Receive the preference lists of this server's virtual nodes that changed with a ring epoch.
+    # Updates are deltas on the previous epoch, so an out-of-date one is ignored.
+    def exposed_update_routing_table(self, entries, epoch):
+        if epoch <= self.ring_epoch:
+            logging.debug(f"Ignoring routing update for epoch {epoch}, current is {self.ring_epoch}")
+            return
+        for vNodeNum, entry in entries:
+            self.routing_table[vNodeNum] = list(entry)
+        self.ring_epoch = epoch
+        logging.info(f"Routing table updated to epoch {epoch}: {entries}")
+        self._set_peers()
+
+    # Every server in this server's preference lists is a peer the failure detector watches
+    def _set_peers(self):
+        peers = set((host, port) for entry in self.routing_table for host, port in entry)
+        peers.discard((self.host, self.port))
+        self.detector.set_peers(peers)
+
+    def exposed_rebalance(self, segments, epoch):
+        """
+        Receive the ring segments whose replicas changed with a ring epoch, and stream the
+        ones this server was picked to hand over to their new owners in the background.
+
+        Args:
+            segments (tuple): (start, end, old_owners, new_owners, source) per ring segment
+                (start, end] that this server owned before or owns now
+            epoch (int): Ring epoch the change belongs to
+        """
+        me = (self.host, self.port)
+        transfers = list()
+        lost = list()
+        ranges_gained = ranges_lost = 0
+        for start, end, old_owners, new_owners, source in segments:
+            old_owners = set(tuple(owner) for owner in old_owners)
+            new_owners = set(tuple(owner) for owner in new_owners)
+            if me in new_owners and me not in old_owners:
+                ranges_gained += 1
+            if me in old_owners and me not in new_owners:
+                ranges_lost += 1
+                lost.append((start, end, tuple(new_owners)))
+            if source is not None and tuple(source) == me:
+                targets = [owner for owner in new_owners if owner not in old_owners]
+                transfers.append((start, end, targets, me not in new_owners))
+
+        if lost:
+            self.handed_over.appendleft((SegmentIndex([(start, end) for start, end, _ in lost]),
+                                         [owners for _, _, owners in lost]))
+        logging.info(f"Rebalance for epoch {epoch}: {ranges_gained} ranges gained, {ranges_lost} lost, "
+                     f"{len(transfers)} to stream")
+        self.rebalancer.submit(epoch, transfers, ranges_gained, ranges_lost)
+
+    def exposed_rebalance_status(self):
+        '''
+            Progress of streaming ranges to their new owners
+
+            Returns:
+                dict: State of the current rebalance and counters since start
+        '''
+        return self.rebalancer.stats()
+
+    # Receive the ring segments this server replicates, each with all of its replicas, which
+    # anti-entropy keeps a Merkle tree for and syncs with the other replicas
+    def exposed_set_replica_ranges(self, ranges, epoch):
+        logging.info(f"Received {len(ranges)} replica ranges for epoch {epoch}")
+        self.owned_ranges = SegmentIndex([(start, end) for start, end, _ in ranges])
+        self.anti_entropy.set_ranges((self.host, self.port), ranges)
+
+    def exposed_merkle_roots(self, segments):
+        '''
+            Root hash of the Merkle tree of each given ring segment
+
+            Args:
+                segments (tuple): (start, end) of the segments
+
+            Returns:
+                tuple: Root per segment, None for a segment this server has no tree for,
+                    or None if this server is not active
+        '''
+        if not self.active:
+            return None
+        return self.anti_entropy.roots(segments)
+
+    def exposed_merkle_nodes(self, segment, indices):
+        '''
+            Hashes of the given nodes of a segment's Merkle tree, numbered heap-style from the root at 1
+
+            Returns:
+                tuple: Hash per node, or None if this server has no tree for the segment
+        '''
+        if not self.active:
+            return None
+        return self.anti_entropy.nodes(segment, indices)
+
+    def exposed_merkle_leaf_versions(self, segment, leaves):
+        '''
+            Keys in the given leaves of a segment's Merkle tree with the version stored for each
+
+            Returns:
+                tuple: (key, version) pairs, or None if this server has no tree for the segment
+        '''
+        if not self.active:
+            return None
+        return self.anti_entropy.leaf_versions(segment, leaves)
+
+    def exposed_hot_keys(self):
+        '''
+            The keys this node coordinated the most reads for recently
+
+            Returns:
+                tuple: (key, estimated recent reads, whether it is hot) per key, hottest first
+        '''
+        return self.hot_keys.hot_keys()
+
     def exposed_toggle_server(self):
         self.active = not self.active
+
+    # For testing: simulates a slow node by delaying every read and write it serves
+    def exposed_set_slowdown(self, seconds):
+        self.slowdown = seconds
+
+    def _slow_down(self):
+        if self.slowdown:
+            time.sleep(self.slowdown)
     
+    def exposed_metrics(self):
+        '''
+            Counters for monitoring the node
+
+            Returns:
+                dict: Metrics grouped by subsystem
+        '''
+        return {
+            "connection_pool": self.pool.stats(),
+            "storage": self.store.stats(),
+            "failure_detector": self.detector.view(),
+            "read_repair": dict(self.read_repairs),
+            "hinted_handoff": self.hints.stats(),
+            "anti_entropy": self.anti_entropy.stats(),
+            "rebalance": self.rebalancer.stats(),
+            "replication": self.replicator.stats(),
+            "compression": self.codec.stats(),
+            "hot_keys": self.hot_keys.stats(),
+            "read_cache": self.read_cache.stats(),
+            "peer_load": self.peer_load.stats(),
+            "hedging": self.hedger.stats(),
+            "binary_server": self.binary_server.stats() if self.binary_server else None,
+        }
+
     def exposed_ping(self):
         '''
             To simulate a server down scenario
@@ -505,5 +1143,13 @@ if __name__ == "__main__":
     port = 9000
     service = KeyValueStoreService()
     server = ThreadedServer(service=service, port=port)
+    # Pooled connections carry many small requests, so replies must not wait on Nagle's algorithm
+    server.listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    binary_config = service.config["binary_server"]
+    if binary_config["enabled"]:
+        service.binary_server = AsyncNodeServer(service, port=binary_config["port"], workers=binary_config["workers"])
+        service.binary_server.start()
+        print(f"KV Store Node serving the binary protocol on port {binary_config['port']}...")
     print(f"KV Store Node running on port {port}...")
     server.start()
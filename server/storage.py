@@ -0,0 +1,180 @@
+import os
+import logging
+import threading
+from collections.abc import MutableMapping
+from persistence import PersistenceEngine
+
+
+# Interface every storage backend of KeyValueStoreService implements.
+# Backends behave like a dict (get, in, [], del, keys, items, len) and persist their own writes,
+# so the service code does not change with the backend that is configured.
+class StorageBackend(MutableMapping):
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "keys": len(self)}
+
+
+# In-memory dict made durable by the write-ahead log of the persistence engine
+class DictStore(StorageBackend):
+    def __init__(self, persistence: PersistenceEngine):
+        self.persistence = persistence
+        self.data = self.persistence.load()
+        self.persistence.start(snapshot_source=lambda: dict(self.data))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.persistence.log_put(key, value)
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.persistence.log_delete(key)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(list(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def close(self) -> None:
+        self.persistence.close()
+
+
+# Splits the key space of a backend into shards with a lock each, so that operations on keys
+# of different shards never wait for one another. Every operation takes just the lock of the
+# key's shard, which makes get, put, delete and compare_and_set atomic per key. Callers that
+# need several steps on one key to be atomic hold lock_for(key) around them; the locks are
+# re-entrant, so the store's own operations can be used inside.
+class ShardedStore(StorageBackend):
+    def __init__(self, backend: StorageBackend, shards=16):
+        self.backend = backend
+        self.locks = [threading.RLock() for _ in range(shards)]
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def __getitem__(self, key):
+        with self.lock_for(key):
+            return self.backend[key]
+
+    def __setitem__(self, key, value):
+        with self.lock_for(key):
+            self.backend[key] = value
+
+    def __delitem__(self, key):
+        with self.lock_for(key):
+            del self.backend[key]
+
+    def __contains__(self, key):
+        return key in self.backend
+
+    def __iter__(self):
+        return iter(self.backend)
+
+    def __len__(self):
+        return len(self.backend)
+
+    def get(self, key, default=None):
+        with self.lock_for(key):
+            return self.backend.get(key, default)
+
+    def put(self, key, value):
+        """
+        Stores the value and returns the one it replaced, None if the key was new.
+        """
+        with self.lock_for(key):
+            previous = self.backend.get(key, None)
+            self.backend[key] = value
+            return previous
+
+    def delete(self, key):
+        """
+        Removes the key and returns its value, None if it was not stored.
+        """
+        with self.lock_for(key):
+            previous = self.backend.get(key, None)
+            if previous is not None:
+                del self.backend[key]
+            return previous
+
+    def compare_and_set(self, key, expected, value) -> bool:
+        """
+        Stores the value only if the key's current value equals expected, None meaning absent.
+
+        Returns:
+            bool: Whether the value was stored
+        """
+        with self.lock_for(key):
+            if self.backend.get(key, None) != expected:
+                return False
+            self.backend[key] = value
+            return True
+
+    def close(self) -> None:
+        self.backend.close()
+
+    def stats(self) -> dict:
+        return dict(self.backend.stats(), shards=len(self.locks))
+
+
+def create_storage(config: dict, base_path: str) -> StorageBackend:
+    """
+    Builds the storage backend selected in the server config.
+
+    Args:
+        config (dict): The parsed server_config.yml
+        base_path (str): Directory that relative data directories are resolved against
+
+    Returns:
+        ShardedStore: The opened backend, with its on-disk state already recovered, behind
+            the per-shard locks
+    """
+    return ShardedStore(_open_backend(config, base_path), shards=config["storage"]["shards"])
+
+
+def _open_backend(config: dict, base_path: str) -> StorageBackend:
+    backend = config["storage"]["backend"]
+    logging.info(f"Opening {backend} storage backend")
+
+    if backend == "dict":
+        persistence_config = config["persistence"]
+        return DictStore(PersistenceEngine(
+            directory=os.path.join(base_path, persistence_config["dir"]),
+            fsync=persistence_config["fsync"],
+            fsync_interval_ms=persistence_config["fsync_interval_ms"],
+            snapshot_interval=persistence_config["snapshot_interval"],
+            snapshot_min_records=persistence_config["snapshot_min_records"],
+            legacy_backup=os.path.join(base_path, persistence_config["legacy_backup"]),
+        ))
+    if backend == "bitcask":
+        from bitcask import BitcaskStore
+        bitcask_config = config["storage"]["bitcask"]
+        return BitcaskStore(
+            directory=os.path.join(base_path, bitcask_config["dir"]),
+            max_file_size=bitcask_config["max_file_size"],
+            fsync=bitcask_config["fsync"],
+            merge_interval=bitcask_config["merge_interval"],
+            merge_dead_ratio=bitcask_config["merge_dead_ratio"],
+        )
+    if backend == "lsm":
+        from lsm import LSMStore
+        lsm_config = config["storage"]["lsm"]
+        return LSMStore(
+            directory=os.path.join(base_path, lsm_config["dir"]),
+            memtable_size=lsm_config["memtable_size"],
+            block_size=lsm_config["block_size"],
+            bloom_bits_per_key=lsm_config["bloom_bits_per_key"],
+            compaction_threshold=lsm_config["compaction_threshold"],
+            tier_ratio=lsm_config["tier_ratio"],
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
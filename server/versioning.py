@@ -0,0 +1,62 @@
+import time
+import threading
+
+# Version of a key that was never written; every real version compares greater
+ZERO_VERSION = (0, 0, "")
+
+
+def version_of(record):
+    """
+    Version of a stored (version, value) record, ZERO_VERSION for a missing one.
+    """
+    return ZERO_VERSION if record is None else tuple(record[0])
+
+
+def is_newer(record, other) -> bool:
+    return version_of(record) > version_of(other)
+
+
+def newest(records):
+    """
+    Picks the record with the highest version.
+
+    Returns:
+        tuple: The newest (version, value) record, or None if every record is missing
+    """
+    winner = None
+    for record in records:
+        if is_newer(record, winner):
+            winner = record
+    return winner
+
+
+# Hybrid logical clock used to stamp every write with a version.
+# A version is (wall_ms, logical, node_id): the wall clock in milliseconds, a counter that
+# orders events within the same millisecond or while the wall clock lags behind a version
+# seen from another node, and the stamping node's id to break ties between coordinators.
+# Versions are plain tuples so they compare with < and travel over rpyc by value.
+class HybridLogicalClock:
+    def __init__(self, node_id=""):
+        self.node_id = node_id
+        self.lock = threading.Lock()
+        self.wall = 0
+        self.logical = 0
+
+    def now(self) -> tuple:
+        physical = int(time.time() * 1000)
+        with self.lock:
+            if physical > self.wall:
+                self.wall, self.logical = physical, 0
+            else:
+                self.logical += 1
+            return (self.wall, self.logical, self.node_id)
+
+    def observe(self, version) -> None:
+        """
+        Moves the clock past a version received from another node, so that writes stamped
+        here afterwards order after it even if this node's wall clock is behind.
+        """
+        wall, logical = version[0], version[1]
+        with self.lock:
+            if (wall, logical) > (self.wall, self.logical):
+                self.wall, self.logical = wall, logical
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import pandas as pd
+
+# Add the server directory to sys.path to import the value codec
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server')))
+from compression import ValueCodec, train_dictionary
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet"]
+
+
+class CompressionBenchmark:
+    def __init__(self, value_count=5000, value_sizes=(100, 1000, 4000), training_count=1000):
+        """
+        Measures how much the node's value codec shrinks values, and what it costs in CPU,
+        for the settings a node can be configured with.
+
+        Args:
+            value_count: Values compressed per value size and setting
+            value_sizes: Approximate sizes of the values in bytes
+            training_count: Extra values the dictionary is trained on, never part of the measurement
+        """
+        self.value_count = value_count
+        self.value_sizes = value_sizes
+        self.training_count = training_count
+        self.summary_data = []
+
+    # Repetitive text values like the ones of test/performance.py, and JSON documents that
+    # share their structure but not their content
+    def _values(self, kind, size, count):
+        values = []
+        for i in range(count):
+            if kind == 'padded':
+                values.append(f"value_{'A' * (size - 6)}_{i}")
+            else:
+                document = {"id": i, "events": []}
+                while len(json.dumps(document)) < size:
+                    document["events"].append({
+                        "type": random.choice(WORDS),
+                        "user": f"user_{random.randint(0, 10 ** 6)}",
+                        "timestamp": random.randint(1600000000, 1700000000),
+                        "tags": random.sample(WORDS, 3),
+                    })
+                values.append(json.dumps(document))
+        return values
+
+    def _measure(self, kind, size, label, codec, values):
+        start_time = time.perf_counter()
+        compressed = [codec.compress(value) for value in values]
+        compress_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        restored = [codec.decompress(value) for value in compressed]
+        decompress_time = time.perf_counter() - start_time
+        assert restored == values
+
+        stats = codec.stats()
+        self.summary_data.append({
+            'Values': kind,
+            'Size (bytes)': size,
+            'Setting': label,
+            'Compressed (%)': 100 * stats['compressed'] / len(values),
+            'Ratio': stats['ratio'],
+            'Compress (us/value)': compress_time / len(values) * 1e6,
+            'Decompress (us/value)': decompress_time / len(values) * 1e6,
+        })
+        print(f"  {kind} {size}B {label}: ratio {stats['ratio']:.2f}, "
+              f"compress {compress_time / len(values) * 1e6:.1f} us, decompress {decompress_time / len(values) * 1e6:.1f} us")
+
+    def run(self):
+        for kind in ('padded', 'json'):
+            for size in self.value_sizes:
+                print(f"Benchmarking {kind} values of {size} bytes...")
+                values = self._values(kind, size, self.value_count)
+                dictionary = train_dictionary(self._values(kind, size, self.training_count))
+                settings = [
+                    ('off', ValueCodec(enabled=False)),
+                    ('zlib-1', ValueCodec(level=1)),
+                    ('zlib-6', ValueCodec(level=6)),
+                    ('zlib-9', ValueCodec(level=9)),
+                    ('zlib-6, threshold 0', ValueCodec(level=6, threshold=0)),
+                    ('zlib-6 + dictionary, threshold 0', ValueCodec(level=6, threshold=0, dictionary=dictionary)),
+                ]
+                for label, codec in settings:
+                    self._measure(kind, size, label, codec, values)
+
+    def generate_report(self, output_dir=path+"/results"):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        df = pd.DataFrame(self.summary_data)
+        with open(f'{output_dir}/compression_summary.md', 'w') as f:
+            f.write(df.to_markdown())
+        print(f"Compression report generated in {output_dir}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='KV Store Value Compression Benchmark')
+    parser.add_argument('--values', type=int, default=5000, help='Values per value size and setting')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 4000], help='Value sizes in bytes')
+    parser.add_argument('--training', type=int, default=1000, help='Values the dictionary is trained on')
+    args = parser.parse_args()
+
+    benchmark = CompressionBenchmark(value_count=args.values, value_sizes=args.sizes, training_count=args.training)
+    benchmark.run()
+    benchmark.generate_report()
@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import rpyc
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from rpyc.utils.server import ThreadedServer
+
+# Add the server directory to sys.path to import the storage layer
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server')))
+from storage import DictStore, ShardedStore
+from persistence import PersistenceEngine
+from versioning import is_newer
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+
+# Minimal node service doing what KeyValueStoreService does on a replica write and a local
+# read: a last-writer-wins put that holds only the lock of the key's shard, and a get
+class StoreService(rpyc.Service):
+    def __init__(self, store):
+        self.store = store
+
+    def exposed_put(self, key, record):
+        with self.store.lock_for(key):
+            current = self.store.get(key, None)
+            if is_newer(record, current):
+                self.store[key] = record
+        return 0 if current is not None else 1
+
+    def exposed_fetch(self, key):
+        return self.store.get(key, None)
+
+
+class ConcurrencyBenchmark:
+    def __init__(self, client_count=16, ops=2000, value_size=100, port=18861):
+        """
+        Benchmarks concurrent writes to different keys through the ThreadedServer of a node,
+        once per shard count of the store, so the cost of writes serializing on one lock shows.
+
+        Args:
+            client_count: Concurrent clients, each with its own connection and handler thread
+            ops: Operations per client and workload
+            value_size: Size of values in bytes
+            port: Port the benchmark server listens on
+        """
+        self.client_count = client_count
+        self.ops = ops
+        self.value = 'A' * value_size
+        self.port = port
+        self.summary_data = []
+
+    def _serve(self, store):
+        server = ThreadedServer(StoreService(store), port=self.port)
+        server.listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.5)
+        return server
+
+    def _run_clients(self, operation):
+        latencies = [[] for _ in range(self.client_count)]
+
+        def client(index):
+            conn = rpyc.connect('localhost', self.port)
+            barrier.wait()
+            for i in range(self.ops):
+                op_start = time.perf_counter()
+                operation(conn.root, index, i)
+                latencies[index].append((time.perf_counter() - op_start) * 1000)
+            conn.close()
+
+        barrier = threading.Barrier(self.client_count + 1)
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(self.client_count)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start_time = time.time()
+        for thread in threads:
+            thread.join()
+        return [latency for client_latencies in latencies for latency in client_latencies], time.time() - start_time
+
+    def _record(self, shards, workload, latencies, elapsed):
+        self.summary_data.append({
+            'Shards': shards,
+            'Clients': self.client_count,
+            'Workload': workload,
+            'Count': len(latencies),
+            'Avg Latency (ms)': np.mean(latencies),
+            'P99 (ms)': np.percentile(latencies, 99),
+            'Throughput (ops/sec)': len(latencies) / elapsed if elapsed > 0 else 0,
+        })
+        print(f"  {workload}: {len(latencies) / elapsed:.0f} ops/sec, p99 {np.percentile(latencies, 99):.3f} ms")
+
+    def run(self, shards):
+        print(f"Benchmarking a store with {shards} shards and {self.client_count} clients...")
+        directory = tempfile.mkdtemp(prefix="kv_shards_")
+        try:
+            store = ShardedStore(DictStore(PersistenceEngine(directory)), shards=shards)
+            server = self._serve(store)
+
+            # Every client writes its own keys, so no two writes ever touch the same key
+            def put(root, client, i):
+                root.put(f"key_{client}_{i}", ((time.time_ns(), 0, "bench"), self.value))
+
+            latencies, elapsed = self._run_clients(put)
+            self._record(shards, 'put (distinct keys)', latencies, elapsed)
+
+            def mixed(root, client, i):
+                key = f"key_{client}_{i}"
+                if i % 2:
+                    root.put(key, ((time.time_ns(), 0, "bench"), self.value))
+                else:
+                    root.fetch(key)
+
+            latencies, elapsed = self._run_clients(mixed)
+            self._record(shards, '50/50 get/put', latencies, elapsed)
+
+            server.close()
+            store.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def generate_report(self, output_dir=path+"/results"):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        df = pd.DataFrame(self.summary_data)
+        with open(f'{output_dir}/concurrency_summary.md', 'w') as f:
+            f.write(df.to_markdown())
+        print(f"Concurrency report generated in {output_dir}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='KV Store Concurrent Write Benchmark')
+    parser.add_argument('--shards', nargs='+', type=int, default=[1, 16], help='Shard counts to compare')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--ops', type=int, default=2000, help='Operations per client and workload')
+    parser.add_argument('--value-size', type=int, default=100, help='Size of values in bytes')
+    parser.add_argument('--port', type=int, default=18861, help='Port of the benchmark server')
+    args = parser.parse_args()
+
+    # rpyc logs every connection at INFO; keep that out of the timings
+    logging.disable(logging.INFO)
+
+    benchmark = ConcurrencyBenchmark(client_count=args.clients, ops=args.ops, value_size=args.value_size, port=args.port)
+    for shards in args.shards:
+        benchmark.run(shards)
+    benchmark.generate_report()
@@ -0,0 +1,136 @@
+import os
+import time
+import rpyc
+import random
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+
+class LatencyBenchmark:
+    def __init__(self, lb_host='localhost', lb_port=5000, slow_node='localhost:9001', slowdown=0.05,
+                 client_count=8, ops=500, key_count=1000, value_size=100, label='default'):
+        """
+        Measures get and put latency through the load balancer with all nodes healthy, then
+        with one node slowed down, to show how much a slow coordinator or replica costs.
+        Run it once per load balancer and node configuration to compare, e.g. with
+        peer_selection.latency_aware on and off.
+
+        Args:
+            lb_host: Host of the load balancer
+            lb_port: Port of the load balancer
+            slow_node: host:port of the node to slow down, as the load balancer reaches it
+            slowdown: Seconds the slow node adds to every read and write it serves
+            client_count: Concurrent clients, each with its own connection
+            ops: Operations per client and workload
+            key_count: Number of unique keys
+            value_size: Size of values in bytes
+            label: Name of the configuration in the report
+        """
+        self.lb_host = lb_host
+        self.lb_port = lb_port
+        self.slow_host, slow_port = slow_node.split(':')
+        self.slow_port = int(slow_port)
+        self.slowdown = slowdown
+        self.client_count = client_count
+        self.ops = ops
+        self.keys = [f"latency_{i}" for i in range(key_count)]
+        self.value = 'A' * value_size
+        self.label = label
+        self.summary_data = []
+
+    def _set_slowdown(self, seconds):
+        conn = rpyc.connect(self.slow_host, self.slow_port)
+        conn.root.set_slowdown(seconds)
+        conn.close()
+
+    def _run(self, phase, workload, operation):
+        latencies = [[] for _ in range(self.client_count)]
+        failures = [0] * self.client_count
+
+        def client(index):
+            conn = rpyc.connect(self.lb_host, self.lb_port, config={"sync_request_timeout": 60})
+            for _ in range(self.ops):
+                key = random.choice(self.keys)
+                op_start = time.perf_counter()
+                ok = operation(conn.root, key)
+                latencies[index].append((time.perf_counter() - op_start) * 1000)
+                failures[index] += not ok
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(self.client_count)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+
+        latencies = [latency for client_latencies in latencies for latency in client_latencies]
+        self.summary_data.append({
+            'Configuration': self.label,
+            'Phase': phase,
+            'Workload': workload,
+            'Count': len(latencies),
+            'Failures': sum(failures),
+            'Avg Latency (ms)': np.mean(latencies),
+            'P50 (ms)': np.percentile(latencies, 50),
+            'P99 (ms)': np.percentile(latencies, 99),
+            'Throughput (ops/sec)': len(latencies) / elapsed if elapsed > 0 else 0,
+        })
+        print(f"  {phase} {workload}: avg {np.mean(latencies):.1f} ms, p50 {np.percentile(latencies, 50):.1f} ms, "
+              f"p99 {np.percentile(latencies, 99):.1f} ms")
+
+    def _workloads(self, phase):
+        self._run(phase, 'put', lambda root, key: root.exposed_put(key, self.value) in (0, 1))
+        self._run(phase, 'get', lambda root, key: tuple(root.exposed_get(key))[1] == 0)
+
+    def run(self):
+        print(f"Loading {len(self.keys)} keys...")
+        conn = rpyc.connect(self.lb_host, self.lb_port)
+        for key in self.keys:
+            conn.root.exposed_put(key, self.value)
+        conn.close()
+
+        print("Benchmarking with all nodes healthy...")
+        self._workloads('healthy')
+        print(f"Benchmarking with {self.slow_host}:{self.slow_port} slowed down by {self.slowdown * 1000:.0f} ms...")
+        self._set_slowdown(self.slowdown)
+        try:
+            self._workloads('one slow node')
+        finally:
+            self._set_slowdown(0)
+
+    def generate_report(self, output_dir=path+"/results"):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        df = pd.DataFrame(self.summary_data)
+        report = f'{output_dir}/latency_summary.md'
+        # Appended, so runs with different configurations end up side by side
+        with open(report, 'a') as f:
+            f.write(df.to_markdown() + "\n\n")
+        print(f"Latency report appended to {report}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='KV Store Latency Benchmark with a Slow Node')
+    parser.add_argument('--lb-host', default='localhost', help='Host of the load balancer')
+    parser.add_argument('--lb-port', type=int, default=5000, help='Port of the load balancer')
+    parser.add_argument('--slow-node', default='localhost:9001', help='host:port of the node to slow down')
+    parser.add_argument('--slowdown', type=float, default=0.05, help='Seconds added to every request of the slow node')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--ops', type=int, default=500, help='Operations per client and workload')
+    parser.add_argument('--keys', type=int, default=1000, help='Number of unique keys')
+    parser.add_argument('--value-size', type=int, default=100, help='Size of values in bytes')
+    parser.add_argument('--label', default='default', help='Name of the configuration in the report')
+    args = parser.parse_args()
+
+    benchmark = LatencyBenchmark(lb_host=args.lb_host, lb_port=args.lb_port, slow_node=args.slow_node,
+                                 slowdown=args.slowdown, client_count=args.clients, ops=args.ops,
+                                 key_count=args.keys, value_size=args.value_size, label=args.label)
+    benchmark.run()
+    benchmark.generate_report()
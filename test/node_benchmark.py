@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import rpyc
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+# Add the server directory to sys.path to import the binary protocol client
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server')))
+from binary_protocol import NodeConnection, OP_PUT
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+
+class NodeBenchmark:
+    def __init__(self, host='localhost', rpyc_port=9001, binary_port=9101, client_count=8,
+                 in_flight=256, ops=20000, value_size=100, batch_size=100):
+        """
+        Compares the throughput of a single storage node over rpyc and over the binary protocol.
+        Runs replica-level puts and fetches against one running node, so no ring is needed.
+
+        Args:
+            host: Host of the node
+            rpyc_port: Port of the node's rpyc server
+            binary_port: Port of the node's binary protocol server
+            client_count: rpyc client threads, and binary protocol connections
+            in_flight: Requests kept in flight over the binary protocol connections
+            ops: Operations per workload
+            value_size: Size of values in bytes
+            batch_size: Puts per frame in the batch workload
+        """
+        self.host = host
+        self.rpyc_port = rpyc_port
+        self.binary_port = binary_port
+        self.client_count = client_count
+        self.in_flight = in_flight
+        self.ops = ops
+        self.batch_size = batch_size
+        self.keys = [f"bench_{i}" for i in range(self.ops)]
+        self.value = 'A' * value_size
+        self.summary_data = []
+
+    def _record_of(self):
+        return ((time.time_ns() // 1000000, 0, "bench"), self.value)
+
+    def _record(self, transport, workload, count, latencies, elapsed):
+        self.summary_data.append({
+            'Transport': transport,
+            'Workload': workload,
+            'Count': count,
+            'Avg Latency (ms)': np.mean(latencies),
+            'P99 (ms)': np.percentile(latencies, 99),
+            'Throughput (ops/sec)': count / elapsed if elapsed > 0 else 0,
+        })
+        print(f"  {transport} {workload}: {count / elapsed:,.0f} ops/sec, p99 {np.percentile(latencies, 99):.3f} ms")
+
+    '''
+        rpyc: one blocking client per thread, like the load balancer's pooled connections
+    '''
+
+    def _run_rpyc(self, workload, operation):
+        latencies = [[] for _ in range(self.client_count)]
+        share = self.ops // self.client_count
+
+        def client(index):
+            conn = rpyc.connect(self.host, self.rpyc_port)
+            for key in self.keys[index * share:(index + 1) * share]:
+                op_start = time.perf_counter()
+                operation(conn.root, key)
+                latencies[index].append((time.perf_counter() - op_start) * 1000)
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(self.client_count)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+        latencies = [latency for client_latencies in latencies for latency in client_latencies]
+        self._record('rpyc', workload, len(latencies), latencies, elapsed)
+
+    def run_rpyc(self):
+        print(f"Benchmarking rpyc on {self.host}:{self.rpyc_port} with {self.client_count} clients...")
+        self._run_rpyc('put', lambda root, key: root.put(key, self._record_of()))
+        self._run_rpyc('fetch', lambda root, key: root.fetch(key, True))
+
+    '''
+        Binary protocol: requests pipelined over a few connections from one event loop
+    '''
+
+    async def _run_binary(self, workload, operation, keys_per_call=1):
+        conns = [await NodeConnection.connect(self.host, self.binary_port) for _ in range(self.client_count)]
+        semaphore = asyncio.Semaphore(self.in_flight)
+        latencies = []
+
+        async def call(index, keys):
+            async with semaphore:
+                op_start = time.perf_counter()
+                await operation(conns[index % len(conns)], keys)
+                latencies.append((time.perf_counter() - op_start) * 1000)
+
+        chunks = [self.keys[i:i + keys_per_call] for i in range(0, len(self.keys), keys_per_call)]
+        start_time = time.time()
+        await asyncio.gather(*(call(index, keys) for index, keys in enumerate(chunks)))
+        elapsed = time.time() - start_time
+        for conn in conns:
+            await conn.close()
+        self._record('binary', workload, len(self.keys), latencies, elapsed)
+
+    async def _binary_workloads(self):
+        await self._run_binary('put', lambda conn, keys: conn.put(keys[0], self._record_of()))
+        await self._run_binary('fetch', lambda conn, keys: conn.fetch(keys[0], True))
+        await self._run_binary(f'put (batches of {self.batch_size})',
+                               lambda conn, keys: conn.batch([(OP_PUT, (key, self._record_of(), None, None)) for key in keys]),
+                               keys_per_call=self.batch_size)
+
+    def run_binary(self):
+        print(f"Benchmarking the binary protocol on {self.host}:{self.binary_port} with "
+              f"{self.client_count} connections and {self.in_flight} requests in flight...")
+        asyncio.run(self._binary_workloads())
+
+    def generate_report(self, output_dir=path+"/results"):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        df = pd.DataFrame(self.summary_data)
+        with open(f'{output_dir}/node_summary.md', 'w') as f:
+            f.write(df.to_markdown())
+        print(f"Node report generated in {output_dir}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='KV Store Node Transport Benchmark')
+    parser.add_argument('--host', default='localhost', help='Host of the node')
+    parser.add_argument('--rpyc-port', type=int, default=9001, help="Port of the node's rpyc server")
+    parser.add_argument('--binary-port', type=int, default=9101, help="Port of the node's binary protocol server")
+    parser.add_argument('--clients', type=int, default=8, help='rpyc client threads and binary protocol connections')
+    parser.add_argument('--in-flight', type=int, default=256, help='Requests in flight over the binary protocol')
+    parser.add_argument('--ops', type=int, default=20000, help='Operations per workload')
+    parser.add_argument('--value-size', type=int, default=100, help='Size of values in bytes')
+    parser.add_argument('--batch-size', type=int, default=100, help='Puts per frame in the batch workload')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    benchmark = NodeBenchmark(host=args.host, rpyc_port=args.rpyc_port, binary_port=args.binary_port,
+                              client_count=args.clients, in_flight=args.in_flight, ops=args.ops,
+                              value_size=args.value_size, batch_size=args.batch_size)
+    benchmark.run_rpyc()
+    benchmark.run_binary()
+    benchmark.generate_report()
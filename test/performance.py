@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import random
+import asyncio
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,11 +12,12 @@ import pandas as pd
 # Add the parent directory to sys.path to import client.py
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from client.client import KVClient
+from client.async_client import AsyncKVClient
 
 path = os.path.dirname(os.path.abspath(__file__))
 
 class PerformanceTester:
-    def __init__(self, client_count=1, key_count=100, value_size=100):
+    def __init__(self, client_count=1, key_count=100, value_size=100, async_in_flight=0):
         """
         Initialize performance tester with configuration parameters.
         
@@ -23,8 +25,11 @@ class PerformanceTester:
             client_count: Number of concurrent clients to simulate            
             key_count: Number of unique keys to use in the test
             value_size: Size of values in bytes
+            async_in_flight: If set, drive the load from one AsyncKVClient with up to this many
+                requests in flight over client_count connections instead of one thread per client
         """
         self.client_count = client_count
+        self.async_in_flight = async_in_flight
         self.key_count = key_count
         self.value_size = value_size
         self.clients = []
@@ -47,6 +52,8 @@ class PerformanceTester:
     def _init_clients(self):
         """Initialize KVClient instances"""
         print("Initializing clients...")
+        if self.async_in_flight:
+            self.async_client = AsyncKVClient(connections=self.client_count, max_in_flight=self.async_in_flight)
         for _ in range(self.client_count):
             try:
                 client = KVClient()
@@ -119,6 +126,25 @@ class PerformanceTester:
             return self._perform_get(client, key)
         return {'latency': 0, 'status': -1, 'value': None}
     
+    async def _perform_async(self, op_type, key):
+        """Perform one operation on the async client and measure latency"""
+        start_time = time.time()
+        try:
+            if op_type == 'put':
+                status = await self.async_client.kv_put(key, self.values[self.keys.index(key)])
+            else:
+                _, status = await self.async_client.kv_get(key)
+        except asyncio.TimeoutError:
+            status = -1
+        latency = (time.time() - start_time) * 1000  # converting to ms
+        return {'latency': latency, 'status': status}
+
+    def _run_async(self, op_type, keys):
+        """Run all operations at once on the async client, which caps how many are in flight"""
+        async def run_all():
+            return await asyncio.gather(*[self._perform_async(op_type, key) for key in keys])
+        return asyncio.run(run_all())
+
     def _run_workload(self, distribution, op_type, total_ops=1000):
         """
         Run a specific workload and measure performance
@@ -152,15 +178,19 @@ class PerformanceTester:
         # Execute operations in parallel
         latencies = []
         start_time = time.time()
-        with ThreadPoolExecutor(max_workers=self.client_count) as executor:
-            if op_type == 'put':
-                for result in executor.map(self._worker_put, tasks):
-                    if result['status'] != -1:
-                        latencies.append(result['latency'])
-            else:
-                for result in executor.map(self._worker_get, tasks):
-                    if result['status'] != -1:
-                        latencies.append(result['latency'])
+        if self.async_in_flight:
+            latencies = [result['latency'] for result in self._run_async(op_type, workload)
+                         if result['status'] != -1]
+        else:
+            with ThreadPoolExecutor(max_workers=self.client_count) as executor:
+                if op_type == 'put':
+                    for result in executor.map(self._worker_put, tasks):
+                        if result['status'] != -1:
+                            latencies.append(result['latency'])
+                else:
+                    for result in executor.map(self._worker_get, tasks):
+                        if result['status'] != -1:
+                            latencies.append(result['latency'])
         
         end_time = time.time()
         
@@ -306,6 +336,9 @@ if __name__ == "__main__":
     parser.add_argument('--keys', type=int, default=1000, help='Number of unique keys')
     parser.add_argument('--value-size', type=int, default=100, help='Size of values in bytes')
     parser.add_argument('--ops', type=int, default=1000, help='Operations per test')
+    parser.add_argument('--async-in-flight', type=int, default=0,
+                        help='Drive the load from one AsyncKVClient with this many requests in flight, '
+                             'using --clients connections')
     args = parser.parse_args()
     
     print(f"Starting performance test with {args.clients} clients, {args.keys} keys, {args.ops} ops per test")
@@ -313,7 +346,8 @@ if __name__ == "__main__":
     tester = PerformanceTester(
         client_count=args.clients,        
         key_count=args.keys,
-        value_size=args.value_size
+        value_size=args.value_size,
+        async_in_flight=args.async_in_flight
     )
     
     try:
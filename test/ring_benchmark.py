@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import pandas as pd
+
+# Add the loadBalancer directory to sys.path to import the request router
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'loadBalancer')))
+from consistentHashing import consistentHashing
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+
+class RingBenchmark:
+    def __init__(self, node_count=1000, vnode_count=256, lookups=200000):
+        """
+        Benchmarks ring construction and key lookups of the load balancer in-process, without
+        any storage node behind it.
+
+        Args:
+            node_count: Number of servers on the ring
+            vnode_count: Virtual nodes per server
+            lookups: Key lookups to time
+        """
+        self.node_count = node_count
+        self.vnode_count = vnode_count
+        self.lookups = lookups
+        self.keys = [f"key_{random.getrandbits(64)}" for _ in range(self.lookups)]
+        self.summary_data = []
+
+    def _record(self, operation, count, elapsed):
+        self.summary_data.append({
+            'Nodes': self.node_count,
+            'VNodes per node': self.vnode_count,
+            'Operation': operation,
+            'Count': count,
+            'Total (s)': elapsed,
+            'Per op (us)': elapsed / count * 1e6,
+            'Ops/sec': count / elapsed,
+        })
+        if count == 1:
+            print(f"  {operation}: {elapsed:.2f} s")
+        else:
+            print(f"  {operation}: {count / elapsed:,.0f} ops/sec")
+
+    def run(self):
+        print(f"Building a ring of {self.node_count} nodes x {self.vnode_count} vnodes...")
+        router = consistentHashing()
+        router.vNode = self.vnode_count
+        router.server_list = [f"10.0.{i // 250}.{i % 250}:9000" for i in range(self.node_count)]
+
+        start_time = time.perf_counter()
+        router._createRing()
+        self._record("create ring", 1, time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        router._createRoutingTable()
+        self._record("create preference lists", 1, time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        for key in self.keys:
+            router._findCoordinatorIndex(key)
+        self._record("coordinator lookup", self.lookups, time.perf_counter() - start_time)
+
+        # What a request pays before it is sent: the lookup plus fetching the translated list
+        start_time = time.perf_counter()
+        for key in self.keys:
+            router.preferenceLists[router._findCoordinatorIndex(key)]
+        self._record("lookup + preference list", self.lookups, time.perf_counter() - start_time)
+
+    def generate_report(self, output_dir=path+"/results"):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        df = pd.DataFrame(self.summary_data)
+        with open(f'{output_dir}/ring_summary.md', 'w') as f:
+            f.write(df.to_markdown())
+        print(f"Ring report generated in {output_dir}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Load Balancer Ring Lookup Benchmark')
+    parser.add_argument('--nodes', type=int, default=1000, help='Number of servers on the ring')
+    parser.add_argument('--vnodes', type=int, default=256, help='Virtual nodes per server')
+    parser.add_argument('--lookups', type=int, default=200000, help='Key lookups to time')
+    args = parser.parse_args()
+
+    # The router logs at DEBUG into LB.log; keep that out of the timings
+    logging.disable(logging.INFO)
+
+    benchmark = RingBenchmark(node_count=args.nodes, vnode_count=args.vnodes, lookups=args.lookups)
+    benchmark.run()
+    benchmark.generate_report()
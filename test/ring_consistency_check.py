@@ -0,0 +1,105 @@
+import os
+import sys
+import random
+import logging
+import argparse
+
+# Add the loadBalancer directory to sys.path to import the request router
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'loadBalancer')))
+from consistentHashing import consistentHashing
+
+
+class RingConsistencyCheck:
+    def __init__(self, node_count=20, vnode_count=64, changes=50, seed=0):
+        """
+        Checks offline that adding and removing servers one at a time, which only recomputes
+        the affected preference lists, leaves the same preference lists and routing tables as
+        building the ring from scratch for the resulting servers.
+
+        Args:
+            node_count: Number of servers on the ring to start with
+            vnode_count: Virtual nodes per server
+            changes: Random additions and removals to apply
+            seed: Seed of the random changes, to reproduce a failing sequence
+        """
+        self.node_count = node_count
+        self.vnode_count = vnode_count
+        self.changes = changes
+        self.random = random.Random(seed)
+        self.next_server = node_count
+        self.mismatches = 0
+
+    def _router(self, server_list):
+        router = consistentHashing()
+        router.vNode = self.vnode_count
+        router.server_list = list(server_list)
+        # Nothing is pushed to the servers, there are none
+        router._pushRoutingUpdates = lambda updates: None
+        router._pushReplicaRanges = lambda ranges: None
+        router._startRebalance = lambda segments: None
+        router.detector.set_peers = lambda peers: None
+        return router
+
+    def _server(self):
+        server = f"10.0.{self.next_server // 250}.{self.next_server % 250}:9000"
+        self.next_server += 1
+        return server
+
+    def _compare(self, step, router):
+        rebuilt = self._router(router.server_list)
+        rebuilt._createRing()
+        rebuilt._createRoutingTable()
+        problems = list()
+        if router.ringHashes != rebuilt.ringHashes or router.ringVNodes != rebuilt.ringVNodes:
+            problems.append("ring")
+        if router.preferenceLists != rebuilt.preferenceLists:
+            problems.append("preference lists")
+        if router.routingTables != rebuilt.routingTables:
+            problems.append("routing tables")
+        if problems:
+            self.mismatches += 1
+            print(f"  {step}: {', '.join(problems)} differ from a full rebuild")
+
+    def run(self):
+        print(f"Starting from {self.node_count} nodes x {self.vnode_count} vnodes...")
+        router = self._router(self._server() for _ in range(self.node_count))
+        router._createRing()
+        router._createRoutingTable()
+
+        for change in range(self.changes):
+            # Shrinking below preferenceListSize servers exercises the full rebuild path as well
+            if len(router.server_list) > 1 and self.random.random() < 0.5:
+                server = self.random.choice(router.server_list)
+                host, port = server.split(':')
+                status = router.exposed_remove_node(host, port)
+                step = f"remove {server}"
+            else:
+                server = self._server()
+                host, port = server.split(':')
+                status = router.exposed_add_node(host, port)
+                step = f"add {server}"
+            if status != 0:
+                self.mismatches += 1
+                print(f"  {step}: returned {status}")
+                continue
+            self._compare(f"change {change + 1}, {step}", router)
+
+        print(f"{self.changes} changes, {len(router.server_list)} nodes left, {self.mismatches} mismatches")
+        return self.mismatches == 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Load Balancer Incremental Ring Update Check')
+    parser.add_argument('--nodes', type=int, default=20, help='Number of servers to start with')
+    parser.add_argument('--vnodes', type=int, default=64, help='Virtual nodes per server')
+    parser.add_argument('--changes', type=int, default=50, help='Random additions and removals to apply')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random changes')
+    args = parser.parse_args()
+
+    # The router logs at DEBUG into LB.log; keep that out of the way
+    logging.disable(logging.INFO)
+
+    check = RingConsistencyCheck(node_count=args.nodes, vnode_count=args.vnodes, changes=args.changes,
+                                 seed=args.seed)
+    sys.exit(0 if check.run() else 1)
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Add the server directory to sys.path to import the storage backends
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'server')))
+from storage import DictStore
+from bitcask import BitcaskStore
+from lsm import LSMStore
+from persistence import PersistenceEngine
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+
+class StorageBenchmark:
+    def __init__(self, key_count=100000, value_size=100, ops=100000):
+        """
+        Benchmarks the storage backends of a node in-process, without the network in the way.
+
+        Args:
+            key_count: Number of unique keys to load
+            value_size: Size of values in bytes
+            ops: Operations per workload
+        """
+        self.key_count = key_count
+        self.value_size = value_size
+        self.ops = ops
+        self.keys = [f"key_{i}" for i in range(self.key_count)]
+        self.values = [f"value_{'A' * (self.value_size - 6)}_{i}" for i in range(self.key_count)]
+        self.summary_data = []
+
+    def _open(self, backend, directory):
+        if backend == "dict":
+            return DictStore(PersistenceEngine(directory))
+        if backend == "bitcask":
+            return BitcaskStore(directory)
+        if backend == "lsm":
+            return LSMStore(directory)
+        raise ValueError(f"Unknown backend: {backend}")
+
+    def _measure(self, backend, workload, operation):
+        latencies = []
+        start_time = time.time()
+        for args in workload:
+            op_start = time.perf_counter()
+            operation(*args)
+            latencies.append((time.perf_counter() - op_start) * 1000)
+        elapsed = time.time() - start_time
+
+        self.summary_data.append({
+            'Backend': backend,
+            'Workload': self.current_workload,
+            'Count': len(latencies),
+            'Avg Latency (ms)': np.mean(latencies),
+            'P99 (ms)': np.percentile(latencies, 99),
+            'Throughput (ops/sec)': len(latencies) / elapsed if elapsed > 0 else 0,
+        })
+        print(f"  {self.current_workload}: {len(latencies) / elapsed:.0f} ops/sec, "
+              f"p99 {np.percentile(latencies, 99):.4f} ms")
+
+    def run_backend(self, backend):
+        print(f"Benchmarking {backend} backend...")
+        directory = tempfile.mkdtemp(prefix=f"kv_{backend}_")
+        try:
+            store = self._open(backend, directory)
+
+            def put(key, value):
+                store[key] = value
+
+            self.current_workload = 'load'
+            self._measure(backend, zip(self.keys, self.values), put)
+
+            self.current_workload = 'write-heavy'
+            workload = []
+            for _ in range(self.ops):
+                index = random.randint(0, self.key_count - 1)
+                workload.append((self.keys[index], self.values[index]))
+            self._measure(backend, workload, put)
+
+            self.current_workload = 'read hit'
+            workload = [(self.keys[random.randint(0, self.key_count - 1)],) for _ in range(self.ops)]
+            self._measure(backend, workload, store.get)
+
+            # What a non-owning replica sees for a fetch of a key it does not hold
+            self.current_workload = 'read miss'
+            workload = [(f"missing_{i}",) for i in range(self.ops)]
+            self._measure(backend, workload, store.get)
+
+            print(f"  stats: {store.stats()}")
+            store.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def generate_report(self, output_dir=path+"/results"):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        df = pd.DataFrame(self.summary_data)
+        with open(f'{output_dir}/storage_summary.md', 'w') as f:
+            f.write(df.to_markdown())
+        print(f"Storage report generated in {output_dir}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='KV Store Storage Backend Benchmark')
+    parser.add_argument('--backends', nargs='+', default=['dict', 'bitcask', 'lsm'], help='Backends to compare')
+    parser.add_argument('--keys', type=int, default=100000, help='Number of unique keys')
+    parser.add_argument('--value-size', type=int, default=100, help='Size of values in bytes')
+    parser.add_argument('--ops', type=int, default=100000, help='Operations per workload')
+    args = parser.parse_args()
+
+    benchmark = StorageBenchmark(key_count=args.keys, value_size=args.value_size, ops=args.ops)
+    for backend in args.backends:
+        benchmark.run_backend(backend)
+    benchmark.generate_report()